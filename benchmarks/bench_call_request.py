@@ -0,0 +1,97 @@
+"""
+Сравнение кодирования параметров CallRequest с прежней рекурсивной реализацией.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_call_request
+"""
+import timeit
+import urllib.parse
+
+from crest.models import CallRequest
+
+
+def legacy_form_data(params, convention="%s"):
+    """
+    Прежняя рекурсивная реализация CallRequest.form_data
+    """
+    if not params:
+        return ""
+
+    output = []
+    for key, value in params.items():
+        if isinstance(value, dict):
+            output.append(legacy_form_data(value, convention % key + "[%s]"))
+        elif isinstance(value, list):
+            new_params = {str(i): element for i, element in enumerate(value)}
+            output.append(legacy_form_data(new_params, convention % key + "[%s]"))
+        else:
+            key = urllib.parse.quote(key)
+            val = urllib.parse.quote(str(value))
+            output.append(convention % key + "=" + val)
+
+    return "&".join(output)
+
+
+def robot_add_params() -> dict:
+    """
+    Параметры bizproc.robot.add, близкие к регистрации робота при установке приложения
+    """
+    properties = {
+        f"property{index}": {
+            "Name": {"ru": f"Параметр {index}", "en": f"Property {index}"},
+            "Description": {"ru": "Описание параметра робота", "en": "Robot property description"},
+            "Type": "string",
+            "Required": "Y",
+            "Multiple": "N",
+            "Default": "{{Ответственный}}",
+            "Options": {str(option): f"Вариант {option}" for option in range(5)},
+        }
+        for index in range(20)
+    }
+    return {
+        "CODE": "ktalk_meeting",
+        "HANDLER": "https://example.com/robot/create-meeting",
+        "AUTH_USER_ID": 1,
+        "USE_SUBSCRIPTION": "Y",
+        "NAME": {"ru": "Создать встречу в Толк", "en": "Create Talk meeting"},
+        "PROPERTIES": properties,
+        "RETURN_PROPERTIES": {"url": {"Name": {"ru": "Ссылка"}, "Type": "string"}},
+    }
+
+
+def batch_params(size: int = 50) -> dict:
+    """
+    Параметры batch из size команд crm.activity.add
+    """
+    requests = {
+        f"request{index}": CallRequest(method="crm.activity.add", params={
+            "fields": {
+                "OWNER_TYPE_ID": 2,
+                "OWNER_ID": index,
+                "SUBJECT": f"Встреча {index}",
+                "DESCRIPTION": "Ссылка на встречу: https://example.ktalk.ru/room",
+                "COMMUNICATIONS": [{"VALUE": "client@example.com", "ENTITY_ID": index, "ENTITY_TYPE_ID": 3}],
+            }
+        })
+        for index in range(size)
+    }
+    return {"halt": 0, "cmd": {name: request.get_path() for name, request in requests.items()}}
+
+
+def run(number: int = 200) -> None:
+    for name, params in (("bizproc.robot.add", robot_add_params()), ("batch x50", batch_params())):
+        request = CallRequest(method=name, params=params)
+        assert request.form_data() == legacy_form_data(params)
+
+        legacy = timeit.timeit(lambda: legacy_form_data(params), number=number)
+        encoded = timeit.timeit(lambda: CallRequest(method=name, params=params).get_path(), number=number)
+        cached = timeit.timeit(lambda: request.get_path(auth="access_token"), number=number)
+        print(
+            f"{name}: прежняя {legacy / number * 1e6:.0f} мкс, "
+            f"новая {encoded / number * 1e6:.0f} мкс, "
+            f"с кэшем {cached / number * 1e6:.1f} мкс"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,99 @@
+"""
+Сравнение чтения моделей из базы данных: прежний путь (сущности ORM -> __dict__ / to_dict()
+-> валидация pydantic) и запрос столбцов с model_construct из src.db.requests.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_db_mapping
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+
+from src.db.requests import _get_columns, _select_user_auths, _to_model
+from src.db.schemes import Base, PortalScheme, UserScheme, UserAuthScheme
+from src.models import UserModel, UserAuthModel
+
+
+MEMBER_ID = "benchmark"
+
+
+async def prepare(session_factory, users: int) -> None:
+    async with session_factory() as session:
+        session.add(PortalScheme(member_id=MEMBER_ID, client_endpoint="https://example.bitrix24.ru/rest/", scope="crm"))
+        session.add_all(
+            UserScheme(user_id=user_id, member_id=MEMBER_ID, name=f"Name{user_id}", last_name="", is_admin=False)
+            for user_id in range(users)
+        )
+        session.add_all(
+            UserAuthScheme(
+                user_id=user_id, member_id=MEMBER_ID, access_token="a" * 70, refresh_token="r" * 70,
+                updated_at=datetime.now(timezone.utc)
+            )
+            for user_id in range(users)
+        )
+        await session.commit()
+
+
+async def legacy_get_user(session, user_id: int) -> UserModel:
+    result = await session.execute(
+        select(UserScheme).where(and_(UserScheme.user_id == user_id, UserScheme.member_id == MEMBER_ID))
+    )
+    return UserModel(**result.scalar().__dict__)
+
+
+async def get_user(session, user_id: int) -> UserModel:
+    result = await session.execute(
+        select(*_get_columns(UserScheme, UserModel))
+        .where(and_(UserScheme.user_id == user_id, UserScheme.member_id == MEMBER_ID))
+    )
+    return _to_model(UserModel, result.first())
+
+
+async def legacy_get_user_auths(session) -> list[UserAuthModel]:
+    result = await session.execute(select(UserAuthScheme).options(joinedload(UserAuthScheme.portal)))
+    return [UserAuthModel(**user_auth.to_dict()) for user_auth in result.scalars()]
+
+
+async def get_user_auths(session) -> list[UserAuthModel]:
+    result = await session.execute(_select_user_auths())
+    return [_to_model(UserAuthModel, row) for row in result]
+
+
+async def measure(session_factory, read, number: int) -> float:
+    started = time.perf_counter()
+    for index in range(number):
+        # Новая сессия на каждый запрос, как у обработчиков FastAPI
+        async with session_factory() as session:
+            await read(session, index)
+    return (time.perf_counter() - started) / number
+
+
+async def run(users: int = 1000, number: int = 500) -> None:
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await prepare(session_factory, users)
+
+    async with session_factory() as session:
+        assert await legacy_get_user(session, 1) == await get_user(session, 1)
+        legacy, new = await legacy_get_user_auths(session), await get_user_auths(session)
+        assert [(auth.user_id, auth.client_endpoint) for auth in legacy] == [(auth.user_id, auth.client_endpoint) for auth in new]
+
+    legacy = await measure(session_factory, lambda session, index: legacy_get_user(session, index % users), number)
+    new = await measure(session_factory, lambda session, index: get_user(session, index % users), number)
+    print(f"get_user: прежний {legacy * 1e6:.0f} мкс, новый {new * 1e6:.0f} мкс")
+
+    legacy = await measure(session_factory, lambda session, index: legacy_get_user_auths(session), number // 50)
+    new = await measure(session_factory, lambda session, index: get_user_auths(session), number // 50)
+    print(f"{users} user_auth с порталом: прежний {legacy * 1e3:.1f} мс, новый {new * 1e3:.1f} мс")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
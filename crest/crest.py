@@ -1,7 +1,29 @@
-from httpx import AsyncClient, HTTPStatusError
-from typing import Any
-from crest.models import CallRequest, AuthTokens
+import asyncio
+import json
+import re
+import time
+from importlib.util import find_spec
+from httpx import AsyncClient, AsyncBaseTransport, Limits, Response, Timeout, TransportError
+from typing import Any, AsyncIterator
+from crest.models import CallRequest, AuthTokens, encode_params
 from crest.limits_manager import LimitsManager
+from crest.exceptions import BitrixError
+from crest.token_manager import TokenManager
+from crest.retry import RetryPolicy, get_response_json
+from crest.metrics import CRestMetrics
+
+
+# Размер страницы списочных методов Bitrix24
+PAGE_SIZE = 50
+BATCH_RESULT_KEYS = ("result", "result_error", "result_total", "result_next", "result_time")
+BATCH_REFERENCE = re.compile(r"\$result\[(\w+)\]")
+
+# Способы передачи параметров: в строке запроса, в теле формой или в теле JSON
+TRANSPORT_MODES = ("query", "form", "json")
+# Объём закодированных команд одного batch по умолчанию. Для строки запроса
+# оставляет запас под адрес портала и токен до типичного лимита URL в 8 КБ
+MAX_BATCH_QUERY_BYTES = 7000
+MAX_BATCH_BODY_BYTES = 1024 * 1024
 
 
 class CRestBitrix24:
@@ -13,6 +35,20 @@ class CRestBitrix24:
         client_id: str | None = None,
         client_secret: str | None = None,
         batch_size: int = 50,
+        batch_concurrency: int = 4,
+        timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        transport: AsyncBaseTransport | None = None,
+        limits_manager: LimitsManager | None = None,
+        token_manager: TokenManager | None = None,
+        transport_mode: str = "query",
+        max_batch_bytes: int | None = None,
+        retry_policy: RetryPolicy | None = None,
+        metrics: CRestMetrics | None = None,
     ) -> None:
         if client_id and client_secret:
             self.mode = "application"
@@ -27,13 +63,77 @@ class CRestBitrix24:
         self.CLIENT_ID = client_id
         self.CLIENT_SECRET = client_secret
         self.BATCH_SIZE = batch_size
+        self.BATCH_CONCURRENCY = batch_concurrency
+
+        # query - параметры в URL (как раньше), form и json - в теле POST запроса,
+        # без ограничения длины URL. Запросы к oauth.bitrix.info всегда идут в URL
+        if transport_mode not in TRANSPORT_MODES:
+            raise ValueError(
+                f"Неизвестный способ передачи параметров {transport_mode}, доступны: {', '.join(TRANSPORT_MODES)}"
+            )
+        self.TRANSPORT_MODE = transport_mode
+        self.MAX_BATCH_BYTES = max_batch_bytes or (
+            MAX_BATCH_QUERY_BYTES if transport_mode == "query" else MAX_BATCH_BODY_BYTES
+        )
+
+        # По умолчанию лимиты порталов общие для всех экземпляров в процессе
+        if limits_manager:
+            self.limits_manager = limits_manager
+        self.token_manager = token_manager or TokenManager()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # По умолчанию метрики пишутся в общий реестр процесса (crest.metrics.registry)
+        self.metrics = metrics or CRestMetrics()
+
+        if http2 and not find_spec("h2"):
+            raise ImportError(
+                "Для работы по HTTP/2 необходимо установить пакет h2 (pip install httpx[http2])"
+            )
+
+        # Параметры общего пула соединений. Клиент создаётся один раз на процесс
+        # и переиспользует keep-alive соединения к порталам между вызовами
+        self.TIMEOUT = Timeout(timeout, connect=connect_timeout)
+        self.LIMITS = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.HTTP2 = http2
+        self._transport = transport
+        self._client: AsyncClient | None = None
+
+    @property
+    def client(self) -> AsyncClient:
+        """
+        Общий HTTP клиент с пулом соединений.
+        Создаётся при первом обращении и пересоздаётся после close()
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient(
+                timeout=self.TIMEOUT,
+                limits=self.LIMITS,
+                http2=self.HTTP2,
+                transport=self._transport,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        """
+        Закрыть пул соединений. Вызывается при завершении работы сервера
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def call(
         self,
         request: CallRequest,
         client_endpoint: str = None,
         auth_tokens: AuthTokens = None,
+        transport_mode: str | None = None,
     ) -> Any:
+        """
+        transport_mode - способ передачи параметров этого вызова вместо TRANSPORT_MODE
+        """
         if self.mode == "webhook":
             client_endpoint = self.CLIENT_WEBHOOK
         elif self.mode == "application" and not auth_tokens:
@@ -45,7 +145,9 @@ class CRestBitrix24:
                 "В режиме работы с приложениями необходимо задать client_endpoint"
             )
 
-        response = await self._call_curl(request, client_endpoint, auth_tokens)
+        if auth_tokens:
+            self.token_manager.touch(auth_tokens)
+        response = await self._call_curl(request, client_endpoint, auth_tokens, transport_mode=transport_mode)
         return response
 
     async def call_batch(
@@ -54,65 +156,291 @@ class CRestBitrix24:
         halt: bool = False,
         client_endpoint: str = None,
         auth_tokens: AuthTokens = None,
-    ) -> Any:
-        responses = []
+        concurrency: int | None = None,
+        transport_mode: str | None = None,
+    ) -> dict:
+        """
+        Выполнить запросы через метод batch пакетами не более BATCH_SIZE команд
+        и MAX_BATCH_BYTES байт закодированных команд.
+        transport_mode - способ передачи пакетов вместо TRANSPORT_MODE: для команд
+        с длинными параметрами в режиме query в пакет помещается всего несколько команд,
+        в теле запроса (form, json) - BATCH_SIZE
+
+        Пакеты отправляются параллельно, не более concurrency (BATCH_CONCURRENCY)
+        одновременно, каждый пакет проходит через лимиты портала.
+        Запросы, связанные ссылками вида $result[request0], попадают в один пакет.
+        При halt пакеты отправляются по очереди и после первой ошибки
+        оставшиеся пакеты не отправляются.
+
+        Возвращает объединённый ответ в формате метода batch, где ключи - request{index}:
+            {"result": {"result": {...}, "result_error": {...}, "result_total": {...},
+                        "result_next": {...}, "result_time": {...}}}
+        """
+        if transport_mode in (None, self.TRANSPORT_MODE):
+            transport_mode, max_bytes = self.TRANSPORT_MODE, self.MAX_BATCH_BYTES
+        else:
+            max_bytes = MAX_BATCH_QUERY_BYTES if transport_mode == "query" else MAX_BATCH_BODY_BYTES
+        chunks = self._split_batch(request_batch, halt, max_bytes)
+        semaphore = asyncio.Semaphore(1 if halt else concurrency or self.BATCH_CONCURRENCY)
+        responses: dict[int, tuple[list[str], Any]] = {}
+        halted = False
+
+        async def send_chunk(number: int, chunk: dict[str, CallRequest]) -> None:
+            nonlocal halted
+            async with semaphore:
+                if halted:
+                    return
+                batch_request = CallRequest(
+                    method="batch",
+                    params={
+                        "halt": int(halt),
+                        "cmd": {name: request.get_path() for name, request in chunk.items()},
+                    },
+                )
+                response = await self.call(batch_request, client_endpoint, auth_tokens, transport_mode)
+                responses[number] = (list(chunk), response)
+                if halt and self._has_batch_errors(response):
+                    halted = True
+
+        await asyncio.gather(*(send_chunk(number, chunk) for number, chunk in enumerate(chunks)))
+        return self._merge_batch_responses([responses[number] for number in sorted(responses)])
+
+    async def iterate(
+        self,
+        method: str,
+        params: dict | None = None,
+        client_endpoint: str = None,
+        auth_tokens: AuthTokens = None,
+        fast: bool = False,
+        prefetch: bool = False,
+        id_field: str = "ID",
+    ) -> AsyncIterator[Any]:
+        """
+        Перебрать все элементы списочного метода (*.list, *.get) с учётом постраничной навигации.
+        Методы без навигации (нет поля next) отдают одну страницу.
+
+        fast - быстрый режим без подсчёта total: страницы запрашиваются по фильтру
+            ">ID": <последний ID> с сортировкой по ID и start=-1.
+            Подходит для методов, принимающих параметры order и filter.
+        prefetch - после первой страницы (когда известен total) загрузить
+            остальные страницы параллельно через call_batch.
+
+        Пример:
+            async for deal in CRest.iterate("crm.deal.list", {"select": ["ID", "TITLE"]}, ...):
+                ...
+        """
+        params = dict(params or {})
+        if fast:
+            async for item in self._iterate_by_id(method, params, client_endpoint, auth_tokens, id_field):
+                yield item
+            return
+
+        response = await self._get_page(method, params, client_endpoint, auth_tokens)
+        for item in _get_page_items(response["result"]):
+            yield item
+
+        if prefetch and "next" in response and "total" in response:
+            step = response["next"]
+            requests = [
+                CallRequest(method=method, params={**params, "start": start})
+                for start in range(response["next"], response["total"], step)
+            ]
+            batch = await self.call_batch(requests, client_endpoint=client_endpoint, auth_tokens=auth_tokens)
+            errors = batch["result"]["result_error"]
+            if errors:
+                raise BitrixError.from_response(next(iter(errors.values())), method)
+            for result in batch["result"]["result"].values():
+                for item in _get_page_items(result):
+                    yield item
+            return
+
+        while "next" in response:
+            params["start"] = response["next"]
+            response = await self._get_page(method, params, client_endpoint, auth_tokens)
+            for item in _get_page_items(response["result"]):
+                yield item
+
+    async def _iterate_by_id(
+        self,
+        method: str,
+        params: dict,
+        client_endpoint: str,
+        auth_tokens: AuthTokens,
+        id_field: str,
+    ) -> AsyncIterator[Any]:
+        base_filter = params.get("filter", {})
+        params["order"] = {id_field: "ASC"}
+        params["start"] = -1
+        last_id = 0
+
+        while True:
+            params["filter"] = {**base_filter, f">{id_field}": last_id}
+            response = await self._get_page(method, params, client_endpoint, auth_tokens)
+            items = _get_page_items(response["result"])
+            for item in items:
+                yield item
+            if len(items) < PAGE_SIZE:
+                return
+            last_id = int(items[-1][id_field])
+
+    async def _get_page(
+        self, method: str, params: dict, client_endpoint: str, auth_tokens: AuthTokens
+    ) -> dict:
+        response = await self.call(CallRequest(method=method, params=params), client_endpoint, auth_tokens)
+        if "error" in response:
+            raise BitrixError.from_response(response, method)
+        return response
 
-        batch_size = self.BATCH_SIZE
-        total_requests = len(request_batch)
+    def _split_batch(
+        self, request_batch: list[CallRequest], halt: bool = False, max_bytes: int | None = None
+    ) -> list[dict[str, CallRequest]]:
+        """
+        Разбить запросы на пакеты не более BATCH_SIZE команд и max_bytes (MAX_BATCH_BYTES) байт.
+        Команды, ссылающиеся друг на друга через $result[...], остаются в одном пакете.
+        Группа больше max_bytes отправляется отдельным пакетом.
+        Без halt группа добавляется в первый пакет, где для неё есть место,
+        с halt - только в последний, чтобы сохранить порядок выполнения
+        """
+        max_bytes = max_bytes or self.MAX_BATCH_BYTES
+        names = [f"request{index}" for index in range(len(request_batch))]
+        indexes = {name: index for index, name in enumerate(names)}
 
-        for start in range(0, total_requests, batch_size):
-            # пакет с методом batch
-            batch_CallRequest = CallRequest(method="batch")
-            parameters = {"halt": int(halt), "cmd": {}}
+        # Объединяем связанные ссылками запросы в группы (система непересекающихся множеств)
+        parents = list(range(len(request_batch)))
 
-            # Добавляем параметры в пакет выше
-            for count in range(batch_size):
-                index = start + count
-                if index >= total_requests:
+        def find(index: int) -> int:
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        for index, request in enumerate(request_batch):
+            for reference in _get_batch_references(request.params):
+                if reference in indexes:
+                    parents[find(index)] = find(indexes[reference])
+
+        groups: dict[int, list[int]] = {}
+        for index in range(len(request_batch)):
+            groups.setdefault(find(index), []).append(index)
+
+        sizes = [_get_command_size(name, request) for name, request in zip(names, request_batch)]
+        # [индексы запросов, размер в байтах]
+        chunks: list[list] = []
+        for group in groups.values():
+            if len(group) > self.BATCH_SIZE:
+                raise ValueError(
+                    f"Связанных через $result запросов больше, чем помещается в один пакет ({self.BATCH_SIZE})"
+                )
+            group_size = sum(sizes[index] for index in group)
+            candidates = chunks[-1:] if halt else chunks
+            for chunk in candidates:
+                if len(chunk[0]) + len(group) <= self.BATCH_SIZE and chunk[1] + group_size <= max_bytes:
+                    chunk[0].extend(group)
+                    chunk[1] += group_size
                     break
-                parameters["cmd"][f"request{index}"] = request_batch[index].get_path()
+            else:
+                chunks.append([list(group), group_size])
+
+        return [
+            {names[index]: request_batch[index] for index in sorted(chunk)}
+            for chunk, _ in chunks
+        ]
+
+    def _has_batch_errors(self, response: Any) -> bool:
+        if not isinstance(response, dict) or "error" in response:
+            return True
+        return bool((response.get("result") or {}).get("result_error"))
+
+    def _merge_batch_responses(self, responses: list[tuple[list[str], Any]]) -> dict:
+        merged = {key: {} for key in BATCH_RESULT_KEYS}
+        for names, response in responses:
+            if not isinstance(response, dict) or "error" in response:
+                # Пакет не выполнен целиком: ошибка относится ко всем его командам
+                error = response if isinstance(response, dict) else {"error": str(response)}
+                for name in names:
+                    merged["result_error"][name] = error
+                continue
 
-            # Назначение параметров запроса и отправка
-            batch_CallRequest.params = parameters
-            response = await self.call(batch_CallRequest, client_endpoint, auth_tokens)
-            responses.append(response)
+            result = response.get("result") or {}
+            for key in BATCH_RESULT_KEYS:
+                # PHP отдаёт пустой ассоциативный массив как []
+                merged[key].update(result.get(key) or {})
 
-        return responses
+        for key in BATCH_RESULT_KEYS:
+            merged[key] = dict(sorted(merged[key].items(), key=lambda item: _get_request_index(item[0])))
+        return {"result": merged}
 
-    # @limits_manager
+    @limits_manager
     async def _call_curl(
-        self, request: CallRequest, client_endpoint: str, auth_tokens: AuthTokens = None
+        self, request: CallRequest, client_endpoint: str, auth_tokens: AuthTokens = None,
+        transport_mode: str | None = None
     ) -> Any:
-        copy_request = request.model_copy()
+        # Изменяющие методы и обмен токенов не повторяются, если портал мог успеть их выполнить
+        idempotent = self.retry_policy.is_idempotent(request.get_methods().values())
+        started_at = time.monotonic()
+        retries = 0
+        refreshed = False
 
-        if auth_tokens:
-            copy_request.params["auth"] = auth_tokens.access_token
+        def on_retry() -> None:
+            nonlocal retries
+            retries += 1
 
-        async def perform_request():
-            url = client_endpoint + copy_request.get_path()
+        async def perform_request() -> Response:
+            # Токен добавляется к закэшированным параметрам, request не изменяется
+            auth = auth_tokens.access_token if auth_tokens else None
+            return await self.retry_policy.run(
+                lambda: self._post(request, client_endpoint, auth, transport_mode or self.TRANSPORT_MODE),
+                idempotent=idempotent,
+                # QUERY_LIMIT_EXCEEDED повторяет LimitsManager с учётом лимита портала
+                retry_response=lambda response: not _is_limit_exceeded(response),
+                on_retry=on_retry,
+            )
 
-            async with AsyncClient() as client:
-                response = await client.post(url=url)
-                response.raise_for_status()
-                return response.json()
+        def observe(status: int | str, result: Any) -> None:
+            self.metrics.observe_call(
+                request, client_endpoint, status, time.monotonic() - started_at, result, retries, refreshed
+            )
 
         try:
-            return await perform_request()
-
-        except HTTPStatusError as e:
-            if e.response.status_code == 414:
-                raise HTTPStatusError('Слишком длинный URI')
-            elif e.response.json().get("error") == "expired_token":
-                new_auth = await self.refresh_token(
-                    refresh_token=auth_tokens.refresh_token
-                )
-                auth_tokens.access_token = new_auth["access_token"]
-                auth_tokens.refresh_token = new_auth["refresh_token"]
+            response = await perform_request()
+            if response.is_error and auth_tokens and get_response_json(response).get("error") == "expired_token":
+                refreshed = True
+                await self.token_manager.refresh(self, auth_tokens)
+                response = await perform_request()
+        except TransportError as e:
+            result = {
+                "error": "CONNECTION_ERROR",
+                "error_description": f"{type(e).__name__}: {e}",
+            }
+            observe("connection_error", result)
+            return result
 
-                copy_request.params["auth"] = auth_tokens.access_token
-                return await perform_request()
-            else:
-                return e.response.json()
+        result = get_response_json(response)
+        observe(response.status_code, result)
+        if response.status_code in (413, 414):
+            raise BitrixError(
+                "REQUEST_TOO_LARGE",
+                "Слишком длинный запрос, используйте transport_mode form или json, либо уменьшите пакет",
+                request.method
+            )
+        return result
+
+    async def _post(self, request: CallRequest, client_endpoint: str, auth: str | None, transport_mode: str):
+        if transport_mode == "query" or not request.method:
+            return await self.client.post(url=client_endpoint + request.get_path(auth=auth))
+
+        url = client_endpoint + request.method
+        if transport_mode == "form":
+            return await self.client.post(
+                url=url,
+                content=request.get_query(auth).encode(),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+        return await self.client.post(
+            url=url,
+            content=json.dumps(request.get_json(auth), ensure_ascii=False, default=str).encode(),
+            headers={"Content-Type": "application/json"},
+        )
 
     async def refresh_token(self, refresh_token: str):
         if self.mode != "application":
@@ -150,3 +478,50 @@ class CRestBitrix24:
 
         response = await self._call_curl(callRequest, client_endpoint=url)
         return response
+
+
+def _is_limit_exceeded(response: Response) -> bool:
+    return get_response_json(response).get("error") == "QUERY_LIMIT_EXCEEDED"
+
+
+def _get_command_size(name: str, request: CallRequest) -> int:
+    """
+    Размер команды в закодированном виде (cmd[name]=...&). Для JSON тела это оценка сверху
+    """
+    return len(encode_params({"cmd": {name: request.get_path()}})) + 1
+
+
+def _get_batch_references(params: Any) -> set[str]:
+    """
+    Имена команд пакета, на результаты которых ссылаются параметры ($result[name])
+    """
+    if isinstance(params, dict):
+        params = list(params.values())
+    if isinstance(params, list):
+        return set().union(*(_get_batch_references(value) for value in params))
+    if isinstance(params, str) and "$result" in params:
+        return set(BATCH_REFERENCE.findall(params))
+    return set()
+
+
+def _get_request_index(name: str) -> int:
+    try:
+        return int(name.removeprefix("request"))
+    except ValueError:
+        return -1
+
+
+def _get_page_items(result: Any) -> list:
+    """
+    Элементы страницы. Часть методов отдаёт список внутри словаря,
+    например {"tasks": [...]} или {"items": [...]}
+    """
+    if not result:
+        return []
+    if isinstance(result, list):
+        return result
+    if isinstance(result, dict) and len(result) == 1:
+        value = next(iter(result.values()))
+        if isinstance(value, list):
+            return value
+    return [result]
@@ -0,0 +1,18 @@
+class BitrixError(Exception):
+    """
+    Ошибка, которую вернул портал Bitrix24 в ответе REST метода
+    """
+
+    def __init__(self, error: str, description: str = "", method: str = "") -> None:
+        self.error = error
+        self.description = description
+        self.method = method
+        super().__init__(f"{method}: {error} {description}".strip(": "))
+
+    @classmethod
+    def from_response(cls, response: dict, method: str = "") -> "BitrixError":
+        return cls(
+            error=str(response.get("error", "")),
+            description=str(response.get("error_description", "")),
+            method=method,
+        )
@@ -1,46 +1,164 @@
+import asyncio
 import collections
+import time
 from functools import wraps
-from datetime import timedelta, datetime, timezone
-import json
+from typing import Any
+
+from crest.models import CallRequest
 
 
 class LimitsManager:
-    def __init__(self) -> None:
-        self._request_history = collections.deque()
+    """
+    Ограничитель запросов к порталам Bitrix24 по алгоритму leaky bucket.
+
+    Лимиты считаются отдельно для каждого портала (client_endpoint):
+    - rate запросов в секунду при накопленном запасе burst запросов;
+    - operating_limit секунд времени выполнения (response["time"]["operating"])
+      на каждый метод за окно operating_window секунд.
+
+    При исчерпании лимита вызов ожидает своей очереди, а не завершается
+    ошибкой QUERY_LIMIT_EXCEEDED. Очередь одного портала не задерживает
+    запросы к другим порталам.
+
+    Состояние портала, к которому не было запросов дольше, чем опустошается
+    ведро (burst / rate) и окно operating_window, удаляется: число порталов
+    в долго работающем процессе не ограничено.
+    """
+
+    def __init__(
+        self,
+        rate: float = 2,
+        burst: int = 50,
+        operating_limit: float = 480,
+        operating_window: float = 600,
+        max_limit_retries: int = 3,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.operating_limit = operating_limit
+        self.operating_window = operating_window
+        self.max_limit_retries = max_limit_retries
+
+        # портал -> (заполненность ведра, время последнего обновления)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._locks: dict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        # (портал, метод) -> история (время, operating)
+        self._operating: dict[tuple[str, str], collections.deque] = collections.defaultdict(collections.deque)
+        self._evicted_at = time.monotonic()
 
     def __call__(self, func):
         @wraps(func)
         async def func_wrapper(*args, **kwargs):
-            response = await func(*args, **kwargs)
-            print("Limits manager here")
-            method, operating = self._get_data_from_args(args, response)
+            # Менеджер, заданный экземпляру CRest, имеет приоритет над общим
+            manager: LimitsManager = getattr(args[0], "limits_manager", self) if args else self
+            request, client_endpoint = manager._get_data_from_args(args, kwargs)
+
+            # Запросы к серверу авторизации не относятся к лимитам портала
+            if not request or not request.method or not client_endpoint:
+                return await func(*args, **kwargs)
 
-            print(f"Method '{method}' has operating {operating}")
+            for _ in range(manager.max_limit_retries + 1):
+                await manager.acquire(client_endpoint, request)
+                response = await func(*args, **kwargs)
+                manager.record(client_endpoint, request, response)
+                if not manager._is_limit_exceeded(response):
+                    break
+                manager.saturate(client_endpoint)
             return response
 
         return func_wrapper
 
-    def _get_data_from_args(self, args, response) -> tuple:
-        method = None
-        operating = None
-        if not self._is_batch(response=response):
-            try:
-                method = args[1].method if args else None
-                operating = response["time"]["operating"]
-            except:
-                pass
-        else:
-            # print(f"Args: {args}, kwargs: {kwargs}")
-            result_time = response["result"]["result_time"]
-            first_request_key = next(iter(result_time))
-            operating = result_time[first_request_key]['operating']
-        return method, operating
-
-    def _is_batch(self, response: dict) -> bool:
-        try:  # обрабатываем ситуации, где нет ответа с результатом. Например, refresh_token
-            # у батча данная запись - словарь
-            if isinstance(response["result"], int):
-                return False
-            return True
-        except:
-            return False
+    async def acquire(self, key: str, request: CallRequest) -> None:
+        """
+        Дождаться возможности выполнить запрос к порталу key
+        """
+        self._evict_idle(time.monotonic())
+        for method in self._get_methods(request).values():
+            await self._wait_operating(key, method)
+
+        async with self._locks[key]:
+            while True:
+                now = time.monotonic()
+                level = self._get_level(key, now)
+                if level + 1 <= self.burst:
+                    self._buckets[key] = (level + 1, now)
+                    return
+                await asyncio.sleep((level + 1 - self.burst) / self.rate)
+
+    def record(self, key: str, request: CallRequest, response: Any) -> None:
+        """
+        Учесть время выполнения методов из ответа портала
+        """
+        now = time.monotonic()
+        for method, operating in self._get_operating(request, response):
+            if operating:
+                self._operating[(key, method)].append((now, operating))
+
+    def saturate(self, key: str) -> None:
+        """
+        Портал ответил QUERY_LIMIT_EXCEEDED: считаем ведро заполненным
+        """
+        self._buckets[key] = (self.burst, time.monotonic())
+
+    def _get_level(self, key: str, now: float) -> float:
+        level, updated_at = self._buckets.get(key, (0, now))
+        return max(0.0, level - (now - updated_at) * self.rate)
+
+    def _evict_idle(self, now: float) -> None:
+        """
+        Удалить опустевшие ведра и истёкшую историю operating.
+        Проверка не чаще, чем ведро опустошается, чтобы не перебирать порталы на каждом запросе
+        """
+        idle = self.burst / self.rate
+        if now - self._evicted_at < idle:
+            return
+        self._evicted_at = now
+
+        for key, (_, updated_at) in list(self._buckets.items()):
+            lock = self._locks.get(key)
+            if now - updated_at >= idle and not (lock and lock.locked()):
+                del self._buckets[key]
+                self._locks.pop(key, None)
+        for key, history in list(self._operating.items()):
+            while history and history[0][0] <= now - self.operating_window:
+                history.popleft()
+            if not history:
+                del self._operating[key]
+
+    async def _wait_operating(self, key: str, method: str) -> None:
+        history = self._operating.get((key, method))
+        while history:
+            now = time.monotonic()
+            while history and history[0][0] <= now - self.operating_window:
+                history.popleft()
+            if sum(operating for _, operating in history) < self.operating_limit:
+                return
+            await asyncio.sleep(history[0][0] + self.operating_window - now)
+
+    def _get_data_from_args(self, args, kwargs) -> tuple[CallRequest | None, str | None]:
+        # сигнатура: _call_curl(self, request, client_endpoint, auth_tokens=None, transport_mode=None)
+        request = kwargs.get("request", args[1] if len(args) > 1 else None)
+        client_endpoint = kwargs.get("client_endpoint", args[2] if len(args) > 2 else None)
+        return request, client_endpoint
+
+    def _get_methods(self, request: CallRequest) -> dict[str, str]:
+        return request.get_methods()
+
+    def _get_operating(self, request: CallRequest, response: Any) -> list[tuple[str, float]]:
+        if not isinstance(response, dict):
+            return []
+        if not self._is_batch(request):
+            return [(request.method, response.get("time", {}).get("operating", 0))]
+
+        result_time = (response.get("result") or {}).get("result_time") or {}
+        return [
+            (method, result_time[name].get("operating", 0))
+            for name, method in self._get_methods(request).items()
+            if name in result_time
+        ]
+
+    def _is_batch(self, request: CallRequest) -> bool:
+        return request.method == "batch"
+
+    def _is_limit_exceeded(self, response: Any) -> bool:
+        return isinstance(response, dict) and response.get("error") == "QUERY_LIMIT_EXCEEDED"
@@ -0,0 +1,239 @@
+import math
+from bisect import bisect_left
+from typing import Any, Iterable
+from urllib.parse import urlsplit
+
+from crest.models import CallRequest
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 20, 30, 40, 50)
+
+
+class Counter:
+    """
+    Счётчик с метками, формат Prometheus: <name>{label="value"} <значение>
+    """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _get_label_values(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: Any) -> float:
+        return self._values.get(_get_label_values(self.labelnames, labels), 0)
+
+    def collect(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram:
+    """
+    Гистограмма с накопительными корзинами (_bucket), суммой (_sum) и количеством (_count)
+    """
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> (количество в каждой корзине, сумма, общее количество)
+        self._values: dict[tuple, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _get_label_values(self.labelnames, labels)
+        counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        index = bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        self._values[key] = (counts, total + value, count + 1)
+
+    def get_count(self, **labels: Any) -> int:
+        values = self._values.get(_get_label_values(self.labelnames, labels))
+        return values[2] if values else 0
+
+    def collect(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса. Отдаются в текстовом формате Prometheus через render()
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def _get_or_create(self, metric_class, name: str, documentation: str, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = metric_class(name, documentation, labelnames, **kwargs)
+            self._metrics[name] = metric
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"Метрика {name} уже зарегистрирована с типом {metric.type}")
+        return metric
+
+
+# Общий реестр процесса, его отдаёт /metrics
+registry = MetricsRegistry()
+
+
+class CRestMetrics:
+    """
+    Метрики вызовов CRestBitrix24 по методам и порталам (хост client_endpoint):
+    время ответа, time.operating и time.processing Bitrix24, размер batch,
+    ошибки, повторы и обновления токенов
+    """
+
+    def __init__(self, metrics_registry: MetricsRegistry | None = None) -> None:
+        self.registry = metrics_registry or registry
+        labels = ("method", "portal")
+        self.requests = self.registry.counter(
+            "bitrix_requests_total", "Запросы к Bitrix24", labels + ("status",)
+        )
+        self.duration = self.registry.histogram(
+            "bitrix_request_duration_seconds", "Полное время запроса к Bitrix24, включая повторы", labels
+        )
+        self.operating = self.registry.histogram(
+            "bitrix_operating_seconds", "time.operating из ответа Bitrix24", labels
+        )
+        self.processing = self.registry.histogram(
+            "bitrix_processing_seconds", "time.processing из ответа Bitrix24", labels
+        )
+        self.batch_size = self.registry.histogram(
+            "bitrix_batch_commands", "Количество команд в запросе batch", ("portal",), BATCH_SIZE_BUCKETS
+        )
+        self.errors = self.registry.counter(
+            "bitrix_errors_total", "Ошибки в ответах Bitrix24", labels + ("error",)
+        )
+        self.retries = self.registry.counter(
+            "bitrix_retries_total", "Повторы запросов к Bitrix24 при временных сбоях", labels
+        )
+        self.refreshes = self.registry.counter(
+            "bitrix_token_refreshes_total", "Обновления токенов после ответа expired_token", ("portal",)
+        )
+
+    def observe_call(
+        self,
+        request: CallRequest,
+        client_endpoint: str,
+        status: int | str,
+        duration: float,
+        response: Any,
+        retries: int = 0,
+        refreshed: bool = False,
+    ) -> None:
+        method = request.method or "oauth"
+        portal = get_portal(client_endpoint)
+
+        self.requests.inc(method=method, portal=portal, status=status)
+        self.duration.observe(duration, method=method, portal=portal)
+        if retries:
+            self.retries.inc(retries, method=method, portal=portal)
+        if refreshed:
+            self.refreshes.inc(portal=portal)
+        if not isinstance(response, dict):
+            return
+
+        if "error" in response:
+            self.errors.inc(method=method, portal=portal, error=response["error"])
+        time = response.get("time")
+        if isinstance(time, dict):
+            self.operating.observe(float(time.get("operating", 0)), method=method, portal=portal)
+            self.processing.observe(float(time.get("processing", 0)), method=method, portal=portal)
+
+        if request.method == "batch":
+            self._observe_batch(request, portal, response)
+
+    def _observe_batch(self, request: CallRequest, portal: str, response: dict) -> None:
+        methods = request.get_methods()
+        self.batch_size.observe(len(methods), portal=portal)
+
+        result = response.get("result")
+        if not isinstance(result, dict):
+            return
+        # Время выполнения и ошибки отдельных команд учитываются по их методам
+        for name, time in (result.get("result_time") or {}).items():
+            if name in methods and isinstance(time, dict):
+                self.operating.observe(float(time.get("operating", 0)), method=methods[name], portal=portal)
+        for name, error in (result.get("result_error") or {}).items():
+            if name in methods:
+                code = error.get("error", "") if isinstance(error, dict) else str(error)
+                self.errors.inc(method=methods[name], portal=portal, error=code)
+
+
+def get_portal(client_endpoint: str) -> str:
+    """
+    Хост портала без пути: путь вебхука содержит секретный ключ
+    """
+    return urlsplit(client_endpoint or "").hostname or ""
+
+
+def _get_label_values(labelnames: tuple[str, ...], labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple) -> str:
+    if not labelnames:
+        return ""
+    labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values))
+    return "{" + labels + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
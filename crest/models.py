@@ -1,54 +1,130 @@
-import urllib
-from pydantic import BaseModel
+from datetime import datetime
+from functools import lru_cache
+from urllib.parse import quote
+from pydantic import BaseModel, PrivateAttr
 from typing import Dict
 
 
 class CallRequest(BaseModel):
     method: str = ""  # пример crm.contact.add
     # пример {"FIELDS[NAME]": "test", "FIELDS[LAST_NAME]": "test"}
+    # После первого get_path параметры не изменяются на месте: закодированная строка кэшируется.
+    # Присваивание method или params сбрасывает кэш
     params: Dict = {}
 
-    def get_path(self):
+    _form_data: str | None = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ("method", "params"):
+            self._form_data = None
+
+    def get_path(self, auth: str | None = None):
         """
-        Возвращает путь, сформированный из метода и обработанных параметров (qs)
+        Возвращает путь, сформированный из метода и обработанных параметров (qs).
+        auth - токен доступа, добавляется последним параметром без изменения params
         Пример: crm.contact.add?FIELDS[NAME]=test&FIELDS[LAST_NAME]=test
         """
-        return f"{self.method}?{self.form_data()}"
+        return f"{self.method}?{self.get_query(auth)}"
+
+    def get_query(self, auth: str | None = None):
+        """
+        Параметры (qs) вместе с токеном доступа: для строки запроса или тела
+        application/x-www-form-urlencoded
+        """
+        if auth is None:
+            return self.form_data()
+        if "auth" in self.params:
+            return encode_params({**self.params, "auth": auth})
+        if not self.params:
+            return f"auth={_quote_value(auth)}"
+        return f"{self.form_data()}&auth={_quote_value(auth)}"
+
+    def get_json(self, auth: str | None = None) -> dict:
+        """
+        Параметры для тела application/json
+        """
+        if auth is None:
+            return self.params
+        return {**self.params, "auth": auth}
+
+    def get_methods(self) -> dict[str, str]:
+        """
+        Методы, вызываемые запросом. Для batch - методы всех команд по их ключам
+        """
+        if self.method != "batch":
+            return {self.method: self.method}
+        return {
+            name: str(cmd).split("?", 1)[0]
+            for name, cmd in self.params.get("cmd", {}).items()
+        }
 
     def form_data(self, convention="%s"):
         """
         Возвращает преобразованные параметры (qs) в виде строки
         Пример: FIELDS[NAME]=test&FIELDS[LAST_NAME]=test
         """
+        if convention != "%s":
+            return encode_params(self.params, convention)
+        if self._form_data is None:
+            self._form_data = encode_params(self.params)
+        return self._form_data
+
 
-        return self._format_params_recursion(self.params, convention)
+# Имена параметров и короткие значения (коды, Y/N, идентификаторы) повторяются
+# от запроса к запросу, их кодирование кэшируется
+_quote_cached = lru_cache(maxsize=4096)(quote)
+_QUOTE_CACHED_LENGTH = 64
 
-    def _format_params_recursion(self, params, convention):
-        if not params:
-            return ""
 
-        output = []
-        for key, value in params.items():
+def _quote_value(value) -> str:
+    value = str(value)
+    if len(value) <= _QUOTE_CACHED_LENGTH:
+        return _quote_cached(value)
+    return quote(value)
+
+
+def encode_params(params: dict, convention: str = "%s") -> str:
+    """
+    Кодирует параметры во вложенную строку запроса в стиле PHP (http_build_query).
+    Вложенные словари и списки раскрываются в ключи вида FIELDS[NAME] и IDS[0],
+    пустые словари и списки дают пустой элемент (как и прежняя рекурсивная реализация)
+    """
+    if not params:
+        return ""
+
+    head, tail = convention.split("%s", 1)
+    output = []
+    # (начало имени, конец имени, итератор по элементам) для каждого уровня вложенности
+    stack = [(head, tail, iter(params.items()))]
+    while stack:
+        head, tail, items = stack[-1]
+        for key, value in items:
             if isinstance(value, dict):
-                output.append(
-                    self._format_params_recursion(
-                        value, convention % key + "[%s]")
-                )
+                children = iter(value.items())
             elif isinstance(value, list):
-                new_params = {str(i): element for i,
-                              element in enumerate(value)}
-                output.append(
-                    self._format_params_recursion(
-                        new_params, convention % key + "[%s]")
-                )
+                children = iter(enumerate(value))
             else:
-                key = urllib.parse.quote(key)
-                val = urllib.parse.quote(str(value))
-                output.append(convention % key + "=" + val)
+                output.append(f"{head}{_quote_cached(str(key))}{tail}={_quote_value(value)}")
+                continue
+
+            if not value:
+                output.append("")
+                continue
+            stack.append((f"{head}{key}{tail}[", "]", children))
+            break
+        else:
+            stack.pop()
 
-        return "&".join(output)
+    return "&".join(output)
 
 
 class AuthTokens(BaseModel):
     access_token: str
     refresh_token: str
+    # Владелец токенов и время их получения. Нужны для согласованного обновления
+    # токенов между запросами и процессами (см. TokenManager)
+    member_id: str | None = None
+    user_id: int | None = None
+    updated_at: datetime | None = None
+    expires_at: datetime | None = None
@@ -0,0 +1,160 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Iterable
+
+from httpx import (
+    ConnectError,
+    ConnectTimeout,
+    PoolTimeout,
+    Response,
+    TransportError,
+)
+
+
+# Запрос не дошёл до сервера - повтор безопасен для любого метода
+NOT_SENT_ERRORS = (ConnectError, ConnectTimeout, PoolTimeout)
+# Сервер отклонил запрос, не выполняя его
+NOT_EXECUTED_STATUSES = (429,)
+
+
+class RetryPolicy:
+    """
+    Повтор запросов при временных сбоях: 429, 502, 503, 504, ошибки соединения и таймауты.
+
+    Задержка растёт экспоненциально (base_delay * 2^попытка, не более max_delay)
+    со случайным разбросом (full jitter), заголовок Retry-After имеет приоритет.
+    Все попытки одного вызова укладываются в deadline секунд.
+
+    После таймаута чтения или 502/504 повторяются только запросы на чтение (read_methods:
+    окончание, начинающееся с точки, или точное имя метода; batch - если все его команды
+    на чтение). Остальные, в том числе обмен refresh_token (запрос без метода),
+    повторяются только если запрос точно не был выполнен: ошибка соединения или 429.
+    Повтор мог бы создать сущность дважды или аннулировать уже выданную пару токенов.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10,
+        deadline: float = 30,
+        retry_statuses: Iterable[int] = (429, 502, 503, 504),
+        read_methods: Iterable[str] = (
+            ".get", ".list", ".fields", "user.current", "user.admin", "profile", "scope", "methods", "app.info",
+        ),
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = tuple(retry_statuses)
+        self.read_suffixes = tuple(method for method in read_methods if method.startswith("."))
+        self.read_names = frozenset(method for method in read_methods if not method.startswith("."))
+
+    def is_idempotent(self, methods: Iterable[str]) -> bool:
+        """
+        Можно ли повторять запрос, вызывающий методы methods
+        """
+        return all(
+            method and (method in self.read_names or method.endswith(self.read_suffixes))
+            for method in methods
+        )
+
+    def get_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """
+        Задержка перед повтором номер attempt (с нуля)
+        """
+        if retry_after is not None:
+            return min(retry_after, self.deadline)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(
+        self,
+        send: Callable[[], Awaitable[Response]],
+        idempotent: bool = True,
+        retry_response: Callable[[Response], bool] | None = None,
+        on_retry: Callable[[], None] | None = None,
+    ) -> Response:
+        """
+        Выполнить send с повторами. Возвращает последний ответ,
+        ошибку соединения пробрасывает, если повторы исчерпаны.
+
+        retry_response - дополнительная проверка ответа: False отменяет повтор
+        on_retry - вызывается перед каждым повтором (для метрик)
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                response = await send()
+            except TransportError as e:
+                if not self._can_retry_error(e, idempotent):
+                    raise
+                delay = self.get_delay(attempt)
+                if not self._has_attempt(attempt, delay, deadline):
+                    raise
+            else:
+                if not self._can_retry_response(response, idempotent, retry_response):
+                    return response
+                delay = self.get_delay(attempt, get_retry_after(response))
+                if not self._has_attempt(attempt, delay, deadline):
+                    return response
+
+            if on_retry:
+                on_retry()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _can_retry_error(self, error: TransportError, idempotent: bool) -> bool:
+        return idempotent or isinstance(error, NOT_SENT_ERRORS)
+
+    def _can_retry_response(
+        self,
+        response: Response,
+        idempotent: bool,
+        retry_response: Callable[[Response], bool] | None,
+    ) -> bool:
+        if response.status_code not in self.retry_statuses:
+            return False
+        if not idempotent and response.status_code not in NOT_EXECUTED_STATUSES:
+            return False
+        return retry_response is None or retry_response(response)
+
+    def _has_attempt(self, attempt: int, delay: float, deadline: float) -> bool:
+        return attempt + 1 < self.max_attempts and time.monotonic() + delay < deadline
+
+
+def get_retry_after(response: Response) -> float | None:
+    """
+    Значение заголовка Retry-After в секундах (число секунд или HTTP дата)
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_response_json(response: Response) -> dict:
+    """
+    Тело ответа как JSON. HTML страницы ошибок прокси и пустые ответы
+    превращаются в ошибку в формате Bitrix24
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return data
+    return {
+        "error": f"HTTP_{response.status_code}",
+        "error_description": response.text[:200] if data is None else str(data)[:200],
+    }
@@ -0,0 +1,160 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Protocol
+
+from crest.models import AuthTokens
+from crest.exceptions import BitrixError
+
+if TYPE_CHECKING:
+    from crest.crest import CRestBitrix24
+
+
+class TokenStorage(Protocol):
+    """
+    Постоянное хранилище токенов, общее для всех процессов приложения
+    """
+
+    async def load(self, tokens: AuthTokens) -> AuthTokens | None:
+        """
+        Актуальная пара токенов пользователя tokens.member_id/tokens.user_id
+        """
+
+    async def save(self, previous: AuthTokens, new: AuthTokens) -> bool:
+        """
+        Записать новую пару, если в хранилище всё ещё previous (compare-and-swap
+        по updated_at). Возвращает False, если запись уже изменил другой процесс
+        """
+
+
+class TokenManager:
+    """
+    Обновление OAuth токенов без гонок.
+
+    Одновременные обновления токенов одного пользователя (member_id, user_id)
+    объединяются в один запрос к oauth.bitrix.info: Bitrix24 аннулирует
+    использованный refresh_token, поэтому параллельные обновления ломают
+    все пары, кроме одной.
+
+    С хранилищем (storage) новые токены сохраняются в базу, а перед обновлением
+    проверяется, не обновил ли их уже другой процесс.
+    """
+
+    def __init__(
+        self,
+        storage: TokenStorage | None = None,
+        expiry_margin: float = 60,
+        reload_timeout: float = 5,
+    ) -> None:
+        self.storage = storage
+        self.expiry_margin = expiry_margin
+        # сколько ждать записи токенов процессом, который обновил их первым
+        self.reload_timeout = reload_timeout
+
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        # последняя полученная пара и момент, до которого она действительна
+        self._latest: dict[tuple, tuple[AuthTokens, float]] = {}
+        # (member_id, user_id) -> время последнего запроса с токенами пользователя
+        self._last_used: dict[tuple, float] = {}
+
+    def touch(self, tokens: AuthTokens) -> None:
+        """
+        Отметить использование токенов пользователя
+        """
+        if tokens.member_id and tokens.user_id is not None:
+            self._last_used[(tokens.member_id, tokens.user_id)] = time.monotonic()
+
+    def is_active(self, member_id: str, user_id: int, within: float) -> bool:
+        """
+        Использовались ли токены пользователя этим процессом за последние within секунд
+        """
+        last_used = self._last_used.get((member_id, user_id))
+        return last_used is not None and time.monotonic() - last_used <= within
+
+    async def refresh(self, crest: "CRestBitrix24", tokens: AuthTokens) -> AuthTokens:
+        """
+        Обновить просроченные токены. tokens изменяется на месте и возвращается
+        """
+        key = self._get_key(tokens)
+
+        latest = self._latest.get(key)
+        if latest and latest[0].access_token != tokens.access_token and time.monotonic() < latest[1]:
+            # Токены уже обновил другой запрос этого процесса
+            return self._apply(tokens, latest[0])
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(crest, tokens.model_copy()))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        return self._apply(tokens, await asyncio.shield(future))
+
+    async def _refresh(self, crest: "CRestBitrix24", tokens: AuthTokens) -> AuthTokens:
+        key = self._get_key(tokens)
+        stored = await self._load_updated(tokens)
+        if stored:
+            return stored
+
+        response = await crest.refresh_token(refresh_token=tokens.refresh_token)
+        if "access_token" not in response:
+            # refresh_token мог быть использован другим процессом между чтением и запросом.
+            # Ждём, пока тот процесс запишет новую пару
+            stored = await self._wait_updated(tokens)
+            if stored:
+                return stored
+            raise BitrixError.from_response(response, "oauth/token")
+
+        expires_in = float(response.get("expires_in", 3600))
+        updated_at = datetime.now(timezone.utc)
+        new_tokens = tokens.model_copy(update={
+            "access_token": response["access_token"],
+            "refresh_token": response["refresh_token"],
+            "updated_at": updated_at,
+            "expires_at": updated_at + timedelta(seconds=expires_in),
+        })
+        self._latest[key] = (new_tokens, time.monotonic() + expires_in - self.expiry_margin)
+
+        if self._is_stored(tokens):
+            # Если запись изменил другой процесс (например, повторный вход пользователя),
+            # его пару не затираем: полученные токены всё равно действительны
+            await self.storage.save(tokens, new_tokens)
+        return new_tokens
+
+    async def _load_updated(self, tokens: AuthTokens) -> AuthTokens | None:
+        """
+        Пара из хранилища, если её уже обновил другой процесс
+        """
+        if not self._is_stored(tokens):
+            return None
+        stored = await self.storage.load(tokens)
+        if stored and stored.access_token != tokens.access_token:
+            return stored
+        return None
+
+    async def _wait_updated(self, tokens: AuthTokens) -> AuthTokens | None:
+        if not self._is_stored(tokens):
+            return None
+        deadline = time.monotonic() + self.reload_timeout
+        delay = 0.05
+        while True:
+            stored = await self._load_updated(tokens)
+            if stored or time.monotonic() >= deadline:
+                return stored
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    def _is_stored(self, tokens: AuthTokens) -> bool:
+        return bool(self.storage and tokens.member_id and tokens.user_id is not None)
+
+    def _get_key(self, tokens: AuthTokens) -> tuple:
+        if tokens.member_id and tokens.user_id is not None:
+            return (tokens.member_id, tokens.user_id)
+        return (tokens.refresh_token,)
+
+    def _apply(self, tokens: AuthTokens, new_tokens: AuthTokens) -> AuthTokens:
+        tokens.access_token = new_tokens.access_token
+        tokens.refresh_token = new_tokens.refresh_token
+        tokens.updated_at = new_tokens.updated_at
+        tokens.expires_at = new_tokens.expires_at
+        return tokens
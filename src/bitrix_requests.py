@@ -1,3 +1,6 @@
+from typing import Any
+
+from crest.exceptions import BitrixError
 from crest.models import AuthTokens, CallRequest
 from src.models import UserModel, UserAuthModel
 from src.ktalk.models import MeetingModel
@@ -12,6 +15,7 @@ CALENDAR_NAME = 'Календарь встреч КТолк'
 CALENDAR_ID = int
 CALENDAR_EVENT_ID = int
 CHAT_ID = str  # Строка! формата chatXXX. Общий чат вроде всегда chat2
+ROBOT_CODE = 'ktalk_robot'
 
 
 class MessageText:
@@ -129,24 +133,21 @@ async def get_ktalk_company_calendar(
         **user_auth.model_dump()
     )
 
-    call = CallRequest(
-        method="calendar.section.get",
-        params={
-            "type": "company_calendar",
-            "ownerId": 0
-        }
-    )
-    result = await crest.call(
-        request=call,
-        client_endpoint=user_auth.client_endpoint,
-        auth_tokens=tokens)
-
     if not calendar_id and not calendar_name:
         logger.error(
             "Ошибка. Чтобы получить календарь, необходимо передать calendar_name и/или calendar_id")
         return None
 
-    for calendar in result['result']:
+    calendars = crest.iterate(
+        method="calendar.section.get",
+        params={
+            "type": "company_calendar",
+            "ownerId": 0
+        },
+        client_endpoint=user_auth.client_endpoint,
+        auth_tokens=tokens
+    )
+    async for calendar in calendars:
         if calendar_id and calendar_name:
             if calendar['ID'] == str(calendar_id) and calendar['NAME'] == calendar_name:
                 return BitrixCalendarModel(**calendar)
@@ -167,12 +168,34 @@ async def create_ktalk_calendar_event(
     created_meeting_information: KTalkBackAnswerModel,
     user_auth: UserAuthModel
 ) -> CALENDAR_EVENT_ID:
-    description = f"{meeting.description}\n\nСсылка на встречу: {created_meeting_information.url}\nПин-код: {meeting.pinCode}".lstrip()
-
     tokens = AuthTokens(
         **user_auth.model_dump()
     )
-    call = CallRequest(
+    call = get_calendar_event_request(
+        calendar_id=calendar_id,
+        meeting=meeting,
+        created_meeting_information=created_meeting_information
+    )
+    logger.debug(call)
+    result = await crest.call(
+        request=call,
+        client_endpoint=user_auth.client_endpoint,
+        auth_tokens=tokens
+    )
+    _raise_for_error(result, call.method)
+    return result['result']
+
+
+def get_calendar_event_request(
+    calendar_id: CALENDAR_ID,
+    meeting: MeetingModel,
+    created_meeting_information: KTalkBackAnswerModel
+) -> CallRequest:
+    """
+    Запрос calendar.event.add для встречи в календаре компании
+    """
+    description = f"{meeting.description}\n\nСсылка на встречу: {created_meeting_information.url}\nПин-код: {meeting.pinCode}".lstrip()
+    return CallRequest(
         method='calendar.event.add',
         params={
             'type': 'company_calendar',
@@ -184,13 +207,6 @@ async def create_ktalk_calendar_event(
             'description': description
         }
     )
-    logger.debug(call)
-    result = await crest.call(
-        request=call,
-        client_endpoint=user_auth.client_endpoint,
-        auth_tokens=tokens
-    )
-    return result['result']
 
 
 async def get_calendar_event(
@@ -202,21 +218,17 @@ async def get_calendar_event(
     tokens = AuthTokens(
         **user_auth.model_dump()
     )
-    call = CallRequest(
+    meetings = crest.iterate(
         method='calendar.event.get',
         params={
             'type': 'company_calendar',
             'ownerId': "0",
             'section': [calendar_id],
-        }
-    )
-    result = await crest.call(
-        request=call,
+        },
         client_endpoint=user_auth.client_endpoint,
         auth_tokens=tokens
     )
-    for meeting in result['result']:
-        print(f"{calendar_event_id} - {meeting['ID']}")
+    async for meeting in meetings:
         if meeting['ID'] == str(calendar_event_id):
             return (meeting)
     return None
@@ -232,10 +244,33 @@ async def send_notification_to_blogpost(
         **user_auth.model_dump()
     )
 
-    base_domain = _get_base_domain_from_client_endpoint(user_auth.client_endpoint)
-
     logger.debug(created_meeting_information.url)
 
+    call = get_blogpost_request(
+        meeting=meeting,
+        created_meeting_information=created_meeting_information,
+        client_endpoint=user_auth.client_endpoint
+    )
+
+    result = await crest.call(
+        request=call,
+        auth_tokens=tokens,
+        client_endpoint=user_auth.client_endpoint
+    )
+    _raise_for_error(result, call.method)
+    return result
+
+
+def get_blogpost_request(
+    meeting: MeetingModel,
+    created_meeting_information: KTalkBackAnswerModel,
+    client_endpoint: str
+) -> CallRequest:
+    """
+    Запрос log.blogpost.add с уведомлением о встрече
+    """
+    base_domain = _get_base_domain_from_client_endpoint(client_endpoint)
+
     message_text = MessageText.format(
         subject=meeting.subject,
         description=meeting.description,
@@ -244,7 +279,7 @@ async def send_notification_to_blogpost(
         calendar_url=base_domain + '/calendar'
     )
 
-    call = CallRequest(
+    return CallRequest(
         method="log.blogpost.add",
         params={
             "POST_TITLE": f"Тема: {meeting.subject}",
@@ -252,13 +287,53 @@ async def send_notification_to_blogpost(
         }
     )
 
-    result = await crest.call(
-        request=call,
+
+async def call_batch_results(
+    crest: CRestBitrix24,
+    requests: list[CallRequest],
+    user_auth: UserAuthModel
+) -> list[tuple[Any, str | None]]:
+    """
+    Выполнить запросы через batch (без halt: ошибка одного запроса не отменяет остальные).
+    Возвращает (результат, ошибка) каждого запроса в порядке requests, ошибка пакета,
+    не выполненного целиком, относится ко всем его запросам.
+    Пакеты передаются в теле запроса (form): с длинными параметрами в URL помещается
+    всего несколько команд, и вместо одного пакета на 50 команд отправлялись бы десятки
+    """
+    if not requests:
+        return []
+    tokens = AuthTokens(
+        **user_auth.model_dump()
+    )
+    response = await crest.call_batch(
+        request_batch=requests,
+        client_endpoint=user_auth.client_endpoint,
         auth_tokens=tokens,
-        client_endpoint=user_auth.client_endpoint
+        transport_mode="form"
     )
-    
-    return result
+    results = response["result"]["result"] or {}
+    errors = response["result"]["result_error"] or {}
+
+    answer = []
+    for index in range(len(requests)):
+        name = f"request{index}"
+        if name in errors:
+            error = errors[name]
+            message = error.get("error_description") or error.get("error") if isinstance(error, dict) else error
+            answer.append((None, str(message)))
+        elif name in results:
+            answer.append((results[name], None))
+        else:
+            answer.append((None, "Запрос не выполнен"))
+    return answer
+
+
+def _raise_for_error(result: dict, method: str) -> None:
+    """
+    crest.call возвращает ошибку портала в ответе, а не исключением
+    """
+    if isinstance(result, dict) and "error" in result:
+        raise BitrixError.from_response(result, method)
 
 
 def _get_base_domain_from_client_endpoint(cliend_endpoint: str) -> str:
@@ -270,61 +345,74 @@ async def create_robot_request(
     user_auth: UserAuthModel,
     application_domain: str
 ) -> dict:
-    req = CallRequest(
-        method="bizproc.robot.add",
-        params={
-            'CODE': 'ktalk_robot',
-            'HANDLER': f'https://{application_domain}/create-external-meeting',
-            'AUTH_USER_ID': 1,
-            'NAME': 'Робот КТолк',
-            "PROPERTIES": {
-                "subject": {
-                    "name": "Тема встречи",
-                    "type": "string",
-                    "required": "Y"
-                },
-                "description": {
-                    "name": "Текст приглашения",
-                    "type": "string",
-                    "required": "Y"
-                },
-                "start": {
-                    "name": "Дата и время начала",
-                    "type": "datetime",
-                    "required": "Y"
-                },
-                "end": {
-                    "name": "Дата и время окончания",
-                    "type": "datetime",
-                    "required": "Y"
-                },
-                "timezone": {
-                    "name": "Разница от МСК (например, -2, 0 или 6)",
-                    "type": "int",
-                    "required": "Y"
-                },
-                "allowAnonymous": {
-                    "name": "Подключение внешних пользователей",
-                    "type": "bool",
-                    "required": "Y"
-                },
-                "enableSip": {
-                    "name": "Подключение по звонку",
-                    "type": "bool",
-                    "required": "Y"
-                },
-                "enableAutoRecording": {
-                    "name": "Автоматическая запись встречи",
-                    "type": "bool",
-                    "required": "Y"
-                },
-                "pinCode": {
-                    "name": "Pin-код (от 4 до 6 цифр)",
-                    "type": "int",
-                    "required": "N"
-                }
+    fields = {
+        'HANDLER': f'https://{application_domain}/create-external-meeting',
+        'AUTH_USER_ID': 1,
+        'NAME': 'Робот КТолк',
+        "PROPERTIES": {
+            "subject": {
+                "name": "Тема встречи",
+                "type": "string",
+                "required": "Y"
+            },
+            "description": {
+                "name": "Текст приглашения",
+                "type": "string",
+                "required": "Y"
+            },
+            "start": {
+                "name": "Дата и время начала",
+                "type": "datetime",
+                "required": "Y"
+            },
+            "end": {
+                "name": "Дата и время окончания",
+                "type": "datetime",
+                "required": "Y"
+            },
+            "timezone": {
+                "name": "Разница от МСК (например, -2, 0 или 6)",
+                "type": "int",
+                "required": "Y"
+            },
+            "allowAnonymous": {
+                "name": "Подключение внешних пользователей",
+                "type": "bool",
+                "required": "Y"
+            },
+            "enableSip": {
+                "name": "Подключение по звонку",
+                "type": "bool",
+                "required": "Y"
+            },
+            "enableAutoRecording": {
+                "name": "Автоматическая запись встречи",
+                "type": "bool",
+                "required": "Y"
+            },
+            "pinCode": {
+                "name": "Pin-код (от 4 до 6 цифр)",
+                "type": "int",
+                "required": "N"
+            }
+        },
+        # Робот выполняется в фоне (src/tasks/robot_jobs.py), бизнес-процесс
+        # ждёт результат из bizproc.event.send
+        "USE_SUBSCRIPTION": "Y",
+        "RETURN_PROPERTIES": {
+            "url": {
+                "name": "Ссылка на встречу",
+                "type": "string"
+            },
+            "error": {
+                "name": "Ошибка",
+                "type": "string"
             }
         }
+    }
+    req = CallRequest(
+        method="bizproc.robot.add",
+        params={'CODE': ROBOT_CODE, **fields}
     )
     result = await CRest.call(
         request=req,
@@ -337,11 +425,51 @@ async def create_robot_request(
         if result['error'] == 'ERROR_METHOD_NOT_FOUND':
             logger.warning("Не удалось создать робота из-за тарифа портала")
         elif result['error'] == 'ERROR_ACTIVITY_ALREADY_INSTALLED':
-            logger.warning("Робот уже установлен")
+            # Робот, установленный прежней версией, не ждёт bizproc.event.send
+            # и не возвращает url и error: обновляем его описание
+            logger.info("Робот уже установлен, обновляем его настройки")
+            return await CRest.call(
+                request=CallRequest(
+                    method="bizproc.robot.update",
+                    params={'CODE': ROBOT_CODE, 'FIELDS': fields}
+                ),
+                client_endpoint=user_auth.client_endpoint,
+                auth_tokens=AuthTokens(
+                    **user_auth.model_dump()
+                )
+            )
         return result
     return result
 
 
+async def send_robot_result(
+    crest: CRestBitrix24,
+    user_auth: UserAuthModel,
+    event_token: str,
+    answer: KTalkBackAnswerModel
+) -> dict:
+    """
+    Вернуть бизнес-процессу результат робота по event_token из его вызова.
+    Ошибка портала - BitrixError: бизнес-процесс результат не получил
+    """
+    req = CallRequest(
+        method="bizproc.event.send",
+        params={
+            "EVENT_TOKEN": event_token,
+            "RETURN_VALUES": {"url": answer.url, "error": answer.error},
+            "LOG_MESSAGE": f"Ошибка создания встречи КТолк: {answer.error}" if answer.error
+            else f"Создана встреча КТолк: {answer.url}",
+        }
+    )
+    result = await crest.call(
+        request=req,
+        client_endpoint=user_auth.client_endpoint,
+        auth_tokens=AuthTokens(**user_auth.model_dump())
+    )
+    _raise_for_error(result, req.method)
+    return result
+
+
 async def delete_robot_request(
     crest: CRestBitrix24,
     user_auth: UserAuthModel
@@ -349,7 +477,7 @@ async def delete_robot_request(
     req = CallRequest(
         method="bizproc.robot.delete",
         params={
-            "CODE": "ktalk_robot"
+            "CODE": ROBOT_CODE
         }
     )
     result = await crest.call(
@@ -0,0 +1,189 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from importlib.util import find_spec
+from typing import Any, Protocol, TypeVar
+
+from pydantic import BaseModel
+
+from crest.metrics import registry
+from src.logger.custom_logger import logger
+
+
+Model = TypeVar("Model", bound=BaseModel)
+
+PORTAL = "portal"
+KTALK_SPACE = "ktalk_space"
+USER_AUTH = "user_auth"
+NAMESPACES = (PORTAL, KTALK_SPACE, USER_AUTH)
+
+
+class CacheBackend(Protocol):
+    """
+    Хранилище кэша. Значения - словари, пригодные для JSON
+    """
+
+    async def get(self, key: str) -> dict | None: ...
+
+    async def set(self, key: str, value: dict, ttl: float) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+    async def delete_prefix(self, prefix: str) -> None: ...
+
+
+class MemoryCacheBackend:
+    """
+    Кэш процесса: TTL и вытеснение давно не использованных записей (LRU)
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        # ключ -> (значение, момент истечения)
+        self._data: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+
+    async def get(self, key: str) -> dict | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item[0]
+
+    async def set(self, key: str, value: dict, ttl: float) -> None:
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def delete_prefix(self, prefix: str) -> None:
+        for key in [key for key in self._data if key.startswith(prefix)]:
+            del self._data[key]
+
+
+class RedisCacheBackend:
+    """
+    Общий кэш процессов uvicorn в Redis: сброс записи виден всем процессам.
+    client - redis.asyncio.Redis или совместимый объект
+    """
+
+    def __init__(self, client: Any, namespace: str = "ktalk:") -> None:
+        self.client = client
+        self.namespace = namespace
+
+    async def get(self, key: str) -> dict | None:
+        value = await self.client.get(self.namespace + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: dict, ttl: float) -> None:
+        await self.client.set(self.namespace + key, json.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.namespace + key)
+
+    async def delete_prefix(self, prefix: str) -> None:
+        keys = [key async for key in self.client.scan_iter(match=f"{self.namespace}{prefix}*")]
+        if keys:
+            await self.client.delete(*keys)
+
+
+class DBCache:
+    """
+    Read-through кэш моделей из базы данных (порталы, пространства КТолк, авторизация).
+    Отдаёт копии моделей, чтобы изменения у вызывающего не попадали в кэш.
+    Не кэширует отсутствие записи. ttl = 0 отключает кэш
+    """
+
+    def __init__(self, backend: CacheBackend | None = None, ttl: float = 60) -> None:
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self._requests = registry.counter(
+            "db_cache_requests_total", "Обращения к кэшу базы данных", ("namespace", "result")
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def get(self, namespace: str, key: str, model: type[Model]) -> Model | None:
+        if not self.enabled:
+            return None
+        try:
+            value = await self.backend.get(f"{namespace}:{key}")
+        except Exception as e:
+            logger.warning(f"Кэш недоступен, чтение из базы данных: {e}")
+            value = None
+        self._requests.inc(namespace=namespace, result="hit" if value is not None else "miss")
+        return model(**value) if value is not None else None
+
+    async def set(self, namespace: str, key: str, value: BaseModel) -> None:
+        if not self.enabled:
+            return
+        data = value.model_dump(mode="json")
+        # Поля с exclude=True (например, UserAuthModel.client_endpoint) тоже сохраняются
+        for name, field in type(value).model_fields.items():
+            if field.exclude:
+                data[name] = getattr(value, name)
+        try:
+            await self.backend.set(f"{namespace}:{key}", data, self.ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось записать в кэш: {e}")
+
+    async def invalidate(self, namespace: str, key: str) -> None:
+        """
+        Сбросить запись namespace:key
+        """
+        try:
+            await self.backend.delete(f"{namespace}:{key}")
+        except Exception as e:
+            logger.error(f"Не удалось сбросить кэш {namespace}:{key}: {e}")
+
+    async def invalidate_prefix(self, namespace: str, prefix: str = "") -> None:
+        """
+        Сбросить записи namespace, ключи которых начинаются с prefix
+        """
+        try:
+            await self.backend.delete_prefix(f"{namespace}:{prefix}")
+        except Exception as e:
+            logger.error(f"Не удалось сбросить кэш {namespace}:{prefix}*: {e}")
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Попадания и промахи по namespace
+        """
+        return {
+            namespace: {
+                result: int(self._requests.get(namespace=namespace, result=result))
+                for result in ("hit", "miss")
+            }
+            for namespace in NAMESPACES
+        }
+
+
+def configure_cache(db_cache: DBCache) -> None:
+    """
+    Настройка кэша из переменных окружения:
+    DB_CACHE_TTL - время жизни записи, сек. (0 - кэш отключён),
+    DB_CACHE_MAXSIZE - размер кэша процесса,
+    DB_CACHE_REDIS_URL - общий кэш процессов в Redis (требуется пакет redis)
+    """
+    db_cache.ttl = float(os.getenv("DB_CACHE_TTL", 60))
+    redis_url = os.getenv("DB_CACHE_REDIS_URL")
+    if not redis_url:
+        db_cache.backend = MemoryCacheBackend(int(os.getenv("DB_CACHE_MAXSIZE", 1024)))
+        return
+
+    if not find_spec("redis"):
+        raise ImportError("Для DB_CACHE_REDIS_URL необходимо установить пакет redis (pip install redis)")
+    from redis.asyncio import Redis
+    db_cache.backend = RedisCacheBackend(Redis.from_url(redis_url))
+
+
+# Кэш процесса, настраивается в lifespan
+cache = DBCache()
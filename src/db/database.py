@@ -1,27 +1,156 @@
 import os
 from typing import AsyncGenerator
 
-from src.db.schemes import Base
+from sqlalchemy import Select, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from sqlalchemy import event
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from src.db.migrations import upgrade
+from src.db.unit_of_work import READ_ONLY, WRITING, read_only, unit_of_work
 
 
-engine = create_async_engine(url=os.getenv("DATABASE_URI"), echo=False)
-session_factory = async_sessionmaker(autocommit=False, bind=engine)
+def get_engine_options(url: str) -> dict:
+    """
+    Настройки пула соединений из переменных окружения:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT - размер пула, дополнительные соединения
+    сверх него и ожидание свободного соединения, сек.,
+    DB_POOL_RECYCLE - пересоздание соединения старше N сек. (-1 - не пересоздавать),
+    DB_POOL_PRE_PING - проверка соединения перед выдачей из пула.
+    Для SQLite пул не настраивается
+    """
+    if _is_sqlite(url):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+    }
 
-@event.listens_for(engine.sync_engine, 'connect')
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute('pragma foreign_keys=ON')
-    cursor.close()
+
+def get_sqlite_pragmas(url: str) -> list[str]:
+    """
+    pragma для каждого соединения SQLite. Если включён SQLITE_TUNED (по умолчанию),
+    файловая база работает в режиме WAL: чтение не блокирует запись.
+    SQLITE_BUSY_TIMEOUT - ожидание блокировки другим процессом, сек.,
+    SQLITE_MMAP_SIZE - объём файла, читаемый через mmap, байт
+    """
+    pragmas = ["foreign_keys=ON"]
+    if not _is_sqlite_tuned(url):
+        return pragmas
+    return pragmas + [
+        "journal_mode=WAL",
+        "synchronous=NORMAL",
+        f"busy_timeout={int(float(os.getenv('SQLITE_BUSY_TIMEOUT', 5)) * 1000)}",
+        f"mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+    ]
+
+
+def create_engine(url: str, **kwargs) -> AsyncEngine:
+    """
+    Движок базы данных: SQLite (aiosqlite) или PostgreSQL (asyncpg).
+    Если передан poolclass, настройки пула из окружения не применяются
+    """
+    options = {} if "poolclass" in kwargs else get_engine_options(url)
+    engine = create_async_engine(url=url, echo=False, **options, **kwargs)
+    if engine.dialect.name == "sqlite":
+        pragmas = get_sqlite_pragmas(url)
+
+        # SQLite не проверяет внешние ключи без pragma на каждом соединении
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(f"pragma {pragma}")
+            cursor.close()
+
+    return engine
+
+
+class RoutingSession(Session):
+    """
+    Сессия SQLite в режиме WAL: SELECT выполняются через пул читающих соединений
+    (info["reader"]), а запись - через движок сессии с единственным соединением.
+    Процесс пишет по очереди, не конкурируя за блокировку базы сам с собой.
+    После первой записи в транзакции SELECT тоже идут через соединение записи,
+    чтобы видеть её изменения
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        reader = self.info.get("reader")
+        if reader is not None and (self.info.get(READ_ONLY) or self._is_read(clause)):
+            return reader.sync_engine
+        return super().get_bind(mapper, clause=clause, **kw)
+
+    def _is_read(self, clause) -> bool:
+        return isinstance(clause, Select) and not self._flushing and not self.info.get(WRITING)
+
+
+def create_session_factory(url: str) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
+    """
+    Движок для записи и миграций и фабрика сессий.
+    Для SQLite в режиме WAL запись идёт через одно соединение (очередь ожидания -
+    SQLITE_WRITE_TIMEOUT сек.), чтение - через SQLITE_READ_CONNECTIONS соединений
+    """
+    if not _is_sqlite_tuned(url):
+        engine = create_engine(url)
+        return engine, async_sessionmaker(autocommit=False, bind=engine)
+
+    # aiosqlite по умолчанию открывает соединение на каждый запрос (NullPool)
+    engine = create_engine(
+        url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0,
+        pool_timeout=float(os.getenv("SQLITE_WRITE_TIMEOUT", 30))
+    )
+    reader = create_engine(
+        url, poolclass=AsyncAdaptedQueuePool, pool_size=int(os.getenv("SQLITE_READ_CONNECTIONS", 5)), max_overflow=0
+    )
+    return engine, async_sessionmaker(
+        autocommit=False, bind=engine, sync_session_class=RoutingSession, info={"reader": reader}
+    )
+
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _is_sqlite_tuned(url: str) -> bool:
+    if not _is_sqlite(url) or make_url(url).database in (None, "", ":memory:"):
+        return False
+    return os.getenv("SQLITE_TUNED", "true").lower() in ("1", "true", "yes")
+
+
+engine, session_factory = create_session_factory(os.getenv("DATABASE_URI"))
 
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with session_factory() as session:
+    """
+    Сессия запроса: изменения фиксируются одной транзакцией после обработчика,
+    при ошибке откатываются
+    """
+    async with unit_of_work(session_factory) as session:
+        yield session
+
+
+async def get_read_session() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Сессия запроса только для чтения
+    """
+    async with read_only(session_factory) as session:
         yield session
 
 
 async def run_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    await upgrade(engine)
+
+
+async def close_db(db_engine: AsyncEngine | None = None, db_session_factory: async_sessionmaker | None = None):
+    """
+    Закрыть соединения движка и пула чтения фабрики сессий
+    """
+    await (db_engine or engine).dispose()
+    reader = (db_session_factory or session_factory).kw.get("info", {}).get("reader")
+    if reader is not None:
+        await reader.dispose()
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Awaitable, Callable, TypeVar
+
+from pydantic import BaseModel
+
+from crest.metrics import registry
+from src.db.cache import CacheBackend, MemoryCacheBackend, RedisCacheBackend
+from src.logger.custom_logger import logger
+
+
+Model = TypeVar("Model", bound=BaseModel)
+
+# Области ключей
+ROBOT = "robot"
+INTERNAL_MEETING = "internal_meeting"
+
+
+class IdempotencyKeyReusedError(Exception):
+    """
+    Ключ уже использован для запроса с другими данными
+    """
+
+
+class IdempotencyStore:
+    """
+    Повторный запрос с тем же ключом получает результат первого, а не выполняется заново.
+    Результат хранится ttl секунд в хранилище кэша (в Redis - общий для процессов),
+    одновременный повтор в этом же процессе ждёт завершения первого запроса.
+    Ключ привязан к отпечатку данных запроса: повтор с другими данными отклоняется.
+    ttl = 0 отключает хранение
+    """
+
+    def __init__(self, backend: CacheBackend | None = None, ttl: float = 3600) -> None:
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self._requests = registry.counter(
+            "idempotency_requests_total", "Запросы с ключом идемпотентности", ("scope", "result")
+        )
+        # Выполняемые запросы: ключ -> (отпечаток, результат)
+        self._running: dict[str, tuple[str, asyncio.Future]] = {}
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        request: dict,
+        execute: Callable[[], Awaitable[Model]],
+        model: type[Model],
+        store: Callable[[Model], bool] = lambda result: True,
+    ) -> tuple[Model, bool]:
+        """
+        Выполнить execute один раз для ключа scope:key. Возвращает результат и признак повтора.
+        store - сохранять ли результат (неудачный запрос можно повторить с тем же ключом)
+        """
+        if self.ttl <= 0:
+            return await execute(), False
+        key = f"idempotency:{scope}:{key}"
+        fingerprint = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+        running = self._running.get(key)
+        if running:
+            self._check(key, fingerprint, running[0])
+            self._requests.inc(scope=scope, result="waited")
+            return model(**(await asyncio.shield(running[1])).model_dump()), True
+
+        stored = await self._get(key)
+        if stored:
+            self._check(key, fingerprint, stored["fingerprint"])
+            self._requests.inc(scope=scope, result="replayed")
+            return model(**stored["result"]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._running[key] = (fingerprint, future)
+        try:
+            result = await execute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получают ожидающие повторы, без них оно не считается необработанным
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            if store(result):
+                await self._set(key, {"fingerprint": fingerprint, "result": result.model_dump(mode="json")})
+        finally:
+            self._running.pop(key, None)
+        self._requests.inc(scope=scope, result="executed")
+        return result, False
+
+    def _check(self, key: str, fingerprint: str, stored: str) -> None:
+        if fingerprint != stored:
+            raise IdempotencyKeyReusedError(f"Ключ {key} уже использован для другого запроса")
+
+    async def _get(self, key: str) -> dict | None:
+        try:
+            return await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Хранилище ключей идемпотентности недоступно: {e}")
+            return None
+
+    async def _set(self, key: str, value: dict) -> None:
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить результат запроса {key}: {e}")
+
+
+def configure_idempotency(store: IdempotencyStore, cache_backend: CacheBackend) -> None:
+    """
+    Настройка из переменных окружения: IDEMPOTENCY_TTL - хранение результата, сек. (0 - отключено),
+    IDEMPOTENCY_MAXSIZE - число результатов в памяти процесса.
+    Если кэш базы данных в Redis, результаты хранятся там же
+    """
+    store.ttl = float(os.getenv("IDEMPOTENCY_TTL", 3600))
+    if isinstance(cache_backend, RedisCacheBackend):
+        store.backend = cache_backend
+    else:
+        store.backend = MemoryCacheBackend(int(os.getenv("IDEMPOTENCY_MAXSIZE", 4096)))
+
+
+# Хранилище процесса, настраивается в lifespan
+idempotency = IdempotencyStore()
@@ -0,0 +1,102 @@
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Column, Connection, Integer, MetaData, Table, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.logger.custom_logger import logger
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    Изменение схемы базы данных. upgrade выполняется в общей транзакции
+    на синхронном соединении (conn.run_sync)
+    """
+    revision: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+# Номер ревизии схемы хранится в отдельной таблице, вне Base.metadata
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", version_metadata,
+    Column("revision", Integer, nullable=False),
+)
+
+# Ключ pg_advisory_xact_lock: миграции не выполняются параллельно несколькими процессами
+LOCK_KEY = 7_340_214
+
+# Ревизия, соответствующая схеме, которую создавал Base.metadata.create_all до миграций
+BASELINE_REVISION = 1
+
+
+def get_migrations() -> list[Migration]:
+    from src.db.migrations import v0001_initial, v0002_users_synced_at, v0003_token_expiry, v0004_robot_job
+    return [
+        v0001_initial.migration,
+        v0002_users_synced_at.migration,
+        v0003_token_expiry.migration,
+        v0004_robot_job.migration,
+    ]
+
+
+async def upgrade(engine: AsyncEngine, migrations: list[Migration] | None = None) -> list[int]:
+    """
+    Применить к базе данных недостающие миграции. Возвращает номера применённых ревизий
+    """
+    async with engine.begin() as conn:
+        return await conn.run_sync(_upgrade, migrations or get_migrations())
+
+
+def get_revision(conn: Connection) -> int | None:
+    """
+    Текущая ревизия схемы, None - миграции не применялись
+    """
+    if not inspect(conn).has_table(schema_version.name):
+        return None
+    return conn.execute(select(schema_version.c.revision)).scalar()
+
+
+def add_column(conn: Connection, table_name: str, column: Column) -> None:
+    """
+    ALTER TABLE ... ADD COLUMN. Столбец без значения по умолчанию должен допускать NULL
+    """
+    if column.name in {item["name"] for item in inspect(conn).get_columns(table_name)}:
+        return
+    preparer = conn.dialect.identifier_preparer
+    ddl = (
+        f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column.name)} "
+        f"{column.type.compile(dialect=conn.dialect)}"
+    )
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.execute(text(ddl))
+
+
+def _upgrade(conn: Connection, migrations: list[Migration]) -> list[int]:
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+
+    revision = get_revision(conn)
+    if revision is None:
+        schema_version.create(conn, checkfirst=True)
+        if inspect(conn).has_table("portal"):
+            # База создана create_all до появления миграций
+            logger.info(f"Существующая схема базы данных отмечена ревизией {BASELINE_REVISION}")
+            revision = BASELINE_REVISION
+        else:
+            revision = 0
+        conn.execute(schema_version.insert().values(revision=revision))
+
+    applied = []
+    for migration in sorted(migrations, key=lambda migration: migration.revision):
+        if migration.revision <= revision:
+            continue
+        logger.info(f"Миграция базы данных {migration.revision}: {migration.description}")
+        migration.upgrade(conn)
+        revision = migration.revision
+        conn.execute(schema_version.update().values(revision=revision))
+        applied.append(revision)
+    return applied
@@ -0,0 +1,65 @@
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Connection,
+    DateTime,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Integer,
+    MetaData,
+    String,
+    Table,
+)
+
+from src.db.migrations import Migration
+
+
+def upgrade(conn: Connection) -> None:
+    # Снимок схемы на момент ревизии: дальнейшие изменения src/db/schemes.py
+    # оформляются новыми миграциями, а не правкой этой
+    metadata = MetaData()
+    Table(
+        "portal", metadata,
+        Column("member_id", String, primary_key=True),
+        Column("client_endpoint", String, nullable=False),
+        Column("scope", String, nullable=False),
+    )
+    Table(
+        "ktalk_space", metadata,
+        Column("member_id", String, ForeignKey(
+            "portal.member_id", onupdate="CASCADE", ondelete="CASCADE"
+        ), unique=True, primary_key=True),
+        Column("space", String, nullable=False),
+        Column("api_key", String, nullable=False),
+        Column("admin_email", String, nullable=False),
+    )
+    Table(
+        "user", metadata,
+        Column("user_id", Integer, primary_key=True),
+        Column("member_id", String, ForeignKey(
+            "portal.member_id", onupdate="CASCADE", ondelete="CASCADE"
+        ), primary_key=True),
+        Column("name", String, nullable=False),
+        Column("last_name", String, nullable=False),
+        Column("is_admin", Boolean, nullable=False),
+    )
+    Table(
+        "user_auth", metadata,
+        Column("member_id", String, primary_key=True),
+        Column("user_id", Integer, primary_key=True),
+        Column("access_token", String, nullable=False),
+        Column("refresh_token", String, nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False),
+        ForeignKeyConstraint(
+            ["user_id", "member_id"], ["user.user_id", "user.member_id"],
+            name="fk_user_auth_user", onupdate="CASCADE", ondelete="CASCADE"
+        ),
+        ForeignKeyConstraint(
+            ["member_id"], ["portal.member_id"],
+            name="fk_user_auth_portal", onupdate="CASCADE", ondelete="CASCADE"
+        ),
+    )
+    metadata.create_all(conn)
+
+
+migration = Migration(revision=1, description="Порталы, пространства КТолк, пользователи и токены", upgrade=upgrade)
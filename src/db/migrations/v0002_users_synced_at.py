@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Connection, DateTime
+
+from src.db.migrations import Migration, add_column
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, "portal", Column("users_synced_at", DateTime(timezone=True), nullable=True))
+
+
+migration = Migration(revision=2, description="Время последней синхронизации пользователей портала", upgrade=upgrade)
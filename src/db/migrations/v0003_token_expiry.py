@@ -0,0 +1,26 @@
+from sqlalchemy import Column, Connection, DateTime, Index, MetaData, Table
+
+from src.db.migrations import Migration, add_column
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, "user_auth", Column("expires_at", DateTime(timezone=True), nullable=True))
+
+    # Существующим токенам время истечения не заполняется: до этой ревизии updated_at
+    # записывался локальным временем сервера без часового пояса, а SQLite читает его как UTC,
+    # и расчёт от updated_at сдвинулся бы на смещение сервера. Токены с неизвестным временем
+    # истечения не выбираются фоновым обновлением и обновляются при первом использовании
+    # (expired_token), после чего expires_at записывается
+
+    metadata = MetaData()
+    user_auth_table = Table("user_auth", metadata, autoload_with=conn)
+    user_table = Table("user", metadata, autoload_with=conn)
+    Index("ix_user_auth_expires_at", user_auth_table.c.expires_at).create(conn, checkfirst=True)
+    Index("ix_user_member_id", user_table.c.member_id).create(conn, checkfirst=True)
+
+
+migration = Migration(
+    revision=3,
+    description="Время истечения токенов и индексы для выборки токенов и пользователей портала",
+    upgrade=upgrade,
+)
@@ -0,0 +1,27 @@
+from sqlalchemy import JSON, Column, Connection, DateTime, Index, Integer, MetaData, String, Table
+
+from src.db.migrations import Migration
+
+
+def upgrade(conn: Connection) -> None:
+    metadata = MetaData()
+    Table(
+        "robot_job", metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("event_token", String, nullable=False, unique=True),
+        Column("member_id", String, nullable=False),
+        Column("user_id", Integer, nullable=False),
+        Column("payload", JSON, nullable=False),
+        Column("status", String, nullable=False),
+        Column("attempts", Integer, nullable=False),
+        Column("result", JSON, nullable=True),
+        Column("error", String, nullable=True),
+        Column("run_after", DateTime(timezone=True), nullable=False),
+        Column("created_at", DateTime(timezone=True), nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False),
+        Index("ix_robot_job_status_run_after", "status", "run_after"),
+    )
+    metadata.create_all(conn, checkfirst=True)
+
+
+migration = Migration(revision=4, description="Очередь выполнения роботов Bitrix24", upgrade=upgrade)
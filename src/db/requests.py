@@ -1,10 +1,25 @@
-from src.models import PortalModel, UserModel, UserAuthModel, KtalkSpaceModel
-from src.db.schemes import PortalScheme, UserScheme, UserAuthScheme, KtalkSpaceScheme
-from sqlalchemy import select, update, delete, and_
-from sqlalchemy.orm import joinedload
+from datetime import datetime, timedelta
+from functools import partial
+from typing import AsyncIterator, TypeVar
+from pydantic import BaseModel
+from src.models import ACCESS_TOKEN_LIFETIME, PortalModel, UserModel, UserAuthModel, KtalkSpaceModel, MeetingContextModel, MeetingContextMiss
+from src.models import RobotJobModel, RobotJobStatus
+from src.db.schemes import PortalScheme, UserScheme, UserAuthScheme, KtalkSpaceScheme, RobotJobScheme, utcnow
+from sqlalchemy import Row, Select, select, update, delete, and_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
+from src.utils import as_utc
 from src.logger.custom_logger import logger
+from src.db.cache import cache, PORTAL, KTALK_SPACE, USER_AUTH
+from src.db.unit_of_work import after_commit, commit
+
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+# Строк в одном INSERT при массовой записи (ограничение SQLite на число параметров запроса)
+UPSERT_CHUNK_SIZE = 500
 
 
 async def add_portal(session: AsyncSession, portal: PortalModel) -> None:
@@ -13,7 +28,7 @@ async def add_portal(session: AsyncSession, portal: PortalModel) -> None:
     """
     try:
         session.add(PortalScheme(**portal.model_dump()))
-        await session.commit()
+        await commit(session)
     except IntegrityError:
         logger.error(f"Портал с member_id '{portal['member_id']}' уже существует")
         raise
@@ -23,13 +38,18 @@ async def get_portal(session: AsyncSession, member_id: str) -> PortalModel | Non
     """
     Получить портал из базы данных, либо None, если его нет
     """
-    result = await session.execute(select(PortalScheme).where(PortalScheme.member_id == member_id))
-    portal_scheme = result.scalar()
-    if portal_scheme:
-        return PortalModel(**portal_scheme.__dict__)
+    cached = await cache.get(PORTAL, member_id, PortalModel)
+    if cached:
+        return cached
+    result = await session.execute(
+        select(*_get_columns(PortalScheme, PortalModel)).where(PortalScheme.member_id == member_id)
+    )
+    row = result.first()
+    if row:
+        portal = _to_model(PortalModel, row)
+        await cache.set(PORTAL, member_id, portal)
+        return portal
     return None
-    # код ниже вызывает ошибку, связанную с тем, что одновременно у sqlite может быть только одно соединение (втф)
-    # return PortalModel(**result.scalar().__dict__) if result.scalar() else None
 
 
 async def refresh_portal(session: AsyncSession, portal: PortalModel) -> None:
@@ -37,13 +57,17 @@ async def refresh_portal(session: AsyncSession, portal: PortalModel) -> None:
     Обновить данные портала в базе данных
     """
     await session.execute(update(PortalScheme).where(PortalScheme.member_id == portal.member_id).values(**portal.model_dump()))
-    await session.commit()
+    await commit(session)
+    await after_commit(session, partial(cache.invalidate, PORTAL, portal.member_id))
+    # client_endpoint портала входит в закэшированные данные авторизации
+    await after_commit(session, partial(cache.invalidate_prefix, USER_AUTH, f"{portal.member_id}:"))
 
 
 async def add_ktalk_space(session: AsyncSession, ktalk_space: KtalkSpaceModel):
     try:
         session.add(KtalkSpaceScheme(**ktalk_space.model_dump()))
-        await session.commit()
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, KTALK_SPACE, ktalk_space.member_id))
     except IntegrityError as e:
         logger.error(f"Ошибка при добавлении пространства КТолк: {e}")
         raise
@@ -51,12 +75,17 @@ async def add_ktalk_space(session: AsyncSession, ktalk_space: KtalkSpaceModel):
 
 async def get_ktalk_space(session: AsyncSession, portal: PortalModel) -> KtalkSpaceModel | None:
     try:
-        result = await session.execute(select(KtalkSpaceScheme).where(
+        cached = await cache.get(KTALK_SPACE, portal.member_id, KtalkSpaceModel)
+        if cached:
+            return cached
+        result = await session.execute(select(*_get_columns(KtalkSpaceScheme, KtalkSpaceModel)).where(
             KtalkSpaceScheme.member_id == portal.member_id
         ))
-        ktalk_space = result.scalar()
-        if ktalk_space:
-            return KtalkSpaceModel(**ktalk_space.__dict__)
+        row = result.first()
+        if row:
+            ktalk_space = _to_model(KtalkSpaceModel, row)
+            await cache.set(KTALK_SPACE, portal.member_id, ktalk_space)
+            return ktalk_space
         return None
     except Exception as e:
         logger.error(f"Ошибка при получении пространства КТолк: {e}")
@@ -71,7 +100,8 @@ async def refresh_ktalk_space(session: AsyncSession, ktalk_space: KtalkSpaceMode
             )
         )
         await session.execute(statement=stmt)
-        await session.commit()
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, KTALK_SPACE, ktalk_space.member_id))
     except Exception as e:
         logger.error(f"Ошибка при обновлении пространства КТолк: {e}")
         await session.rollback()
@@ -79,22 +109,10 @@ async def refresh_ktalk_space(session: AsyncSession, ktalk_space: KtalkSpaceMode
 
 
 async def add_user(session: AsyncSession, user: UserModel) -> None:
-    try:
-        session.add(UserScheme(**user.model_dump()))
-        await session.commit()
-    except IntegrityError as e:
-        await session.rollback()
-        error_msg = str(e.orig)
-
-        if "UNIQUE constraint failed" in error_msg or "PRIMARY KEY constraint failed" in error_msg:
-            logger.info(
-                f"Пользователь {user} уже существует. Запуск обновления"
-            )
-            await refresh_user(session, user)
-        elif "FOREIGN KEY constraint failed" in error_msg:
-            raise 
-        else:
-            raise 
+    """
+    Добавить пользователя, либо обновить, если он уже существует
+    """
+    await upsert_users(session, [user])
 
 
 async def refresh_user(session: AsyncSession, user: UserModel) -> None:
@@ -104,7 +122,7 @@ async def refresh_user(session: AsyncSession, user: UserModel) -> None:
                                      UserScheme.member_id == user.member_id).values(**user.model_dump())
         )
         await session.execute(statement=stmt)
-        await session.commit()
+        await commit(session)
     except Exception as e:
         logger.error(f"Ошибка при обновлении пользователя: {e}")
         await session.rollback()  # Сбрасываем состояние транзакции в случае ошибки
@@ -113,63 +131,110 @@ async def refresh_user(session: AsyncSession, user: UserModel) -> None:
 
 async def get_user(session: AsyncSession, user_id: int, member_id: str) -> UserModel | None:
     try:
-        result = await session.execute(select(UserScheme).where(and_(UserScheme.user_id == user_id, UserScheme.member_id == member_id)))
-        user_scheme = result.scalar()
-        if user_scheme:
-            return UserModel(**user_scheme.__dict__)
-            # return UserModel.model_validate(user_scheme)
-        return None
+        result = await session.execute(
+            select(*_get_columns(UserScheme, UserModel))
+            .where(and_(UserScheme.user_id == user_id, UserScheme.member_id == member_id))
+        )
+        row = result.first()
+        return _to_model(UserModel, row) if row else None
     except Exception as e:
         logger.error(f"Ошибка при получении пользователя: {e}")
         raise
 
 
-async def set_user_auth(session: AsyncSession, auth: UserAuthModel):
+async def set_user_auth(session: AsyncSession, auth: UserAuthModel, expected_updated_at: datetime | None = None) -> bool:
     """
     Основной метод для работы с авторизацией.
     При отсутствии данных авторизации - добавляет в базу данных,
     При наличии данных - обновляет
+
+    С expected_updated_at выполняет compare-and-swap: обновляет запись,
+    только если её updated_at не изменился с момента чтения.
+    Возвращает False, если запись уже изменил другой процесс
     """
     try:
-        existing = await get_user_auth(session, UserModel(user_id=auth.user_id, member_id=auth.member_id, name="", last_name="", is_admin=False))
-        if existing:
-            await _refresh_user_auth(session, auth)
-        else:
-            await _add_user_auth(session, auth)
+        if expected_updated_at is not None:
+            return await _compare_and_set_user_auth(session, auth, expected_updated_at)
+
+        await upsert_user_auths(session, [auth])
+        return True
     except Exception as e:
         logger.error(f"Ошибка при установке токена пользователя: {e}")
         raise
 
+
+async def _compare_and_set_user_auth(session: AsyncSession, auth: UserAuthModel, expected_updated_at: datetime) -> bool:
+    try:
+        stmt = (
+            update(UserAuthScheme).where(UserAuthScheme.user_id == auth.user_id,
+                                         UserAuthScheme.member_id == auth.member_id,
+                                         UserAuthScheme.updated_at == expected_updated_at).values(
+                                             **_get_user_auth_values(auth)
+                                         )
+        )
+        result = await session.execute(statement=stmt)
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, USER_AUTH, _get_user_auth_key(auth.member_id, auth.user_id)))
+        return result.rowcount == 1
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении токена пользователя: {e}")
+        await session.rollback()
+        raise
+
 async def _add_user_auth(session: AsyncSession, auth: UserAuthModel):
     try:
-        session.add(UserAuthScheme(**auth.model_dump()))
-        await session.commit()
+        session.add(UserAuthScheme(**_get_user_auth_values(auth)))
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, USER_AUTH, _get_user_auth_key(auth.member_id, auth.user_id)))
     except IntegrityError as e:
         logger.error(f"Ошибка при добавлении данных авторизации пользователя: {e}")
         await session.rollback()
         raise
 
-async def get_user_auth(session: AsyncSession, user: UserModel) -> UserAuthModel | None:
+async def get_users(session: AsyncSession, member_id: str) -> list[UserModel]:
+    """
+    Пользователи портала
+    """
+    result = await session.execute(
+        select(*_get_columns(UserScheme, UserModel))
+        .where(UserScheme.member_id == member_id)
+        .order_by(UserScheme.user_id)
+    )
+    return [_to_model(UserModel, row) for row in result]
+
+
+async def get_user_auth(session: AsyncSession, user: UserModel, use_cache: bool = True) -> UserAuthModel | None:
+    """
+    Данные авторизации пользователя вместе с client_endpoint портала.
+    use_cache=False читает из базы, минуя кэш (например, для сверки токенов между процессами)
+    """
+    key = _get_user_auth_key(user.member_id, user.user_id)
+    if use_cache:
+        cached = await cache.get(USER_AUTH, key, UserAuthModel)
+        if cached:
+            return cached
     try:
         result = await session.execute(
-            select(UserAuthScheme)
-            .options(joinedload(UserAuthScheme.portal))  # Подгружаем portal
-            .where(
+            _select_user_auths().where(
                 and_(
                     UserAuthScheme.user_id == user.user_id,
                     UserAuthScheme.member_id == user.member_id
                 )
             )
         )
-        user_token_scheme = result.scalars().first()
-        if user_token_scheme:
-            return UserAuthModel(**user_token_scheme.to_dict())
+        row = result.first()
+        if row:
+            user_auth = _to_model(UserAuthModel, row)
+            await cache.set(USER_AUTH, key, user_auth)
+            return user_auth
         return None
     except Exception as e:
         logger.error(f"Ошибка при получении данных авторизации пользователя: {e}")
         raise
 
-async def get_user_auth_without_model(session: AsyncSession, member_id: str, user_id: str) -> UserAuthModel | None:
+async def get_user_auth_without_model(
+    session: AsyncSession, member_id: str, user_id: str, use_cache: bool = True
+) -> UserAuthModel | None:
     temp_user_model = UserModel(
         member_id=member_id,
         user_id=user_id,
@@ -177,18 +242,82 @@ async def get_user_auth_without_model(session: AsyncSession, member_id: str, use
         last_name="",
         is_admin=False
     )
-    return await get_user_auth(session=session, user=temp_user_model)    
+    return await get_user_auth(session=session, user=temp_user_model, use_cache=use_cache)
+
+
+def _get_user_auth_key(member_id: str, user_id: int) -> str:
+    return f"{member_id}:{user_id}"
+
+
+def _get_user_auth_values(auth: UserAuthModel) -> dict:
+    """
+    Значения строки user_auth. Не заданное или устаревшее (не позже updated_at)
+    время истечения считается от updated_at
+    """
+    values = auth.model_dump()
+    updated_at = as_utc(values["updated_at"])
+    if values["expires_at"] is None or as_utc(values["expires_at"]) <= updated_at:
+        values["expires_at"] = updated_at + ACCESS_TOKEN_LIFETIME
+    return values
+
+
+def _select_expiring_user_auths(expires_before: datetime, updated_after: datetime | None, limit: int | None) -> Select:
+    # Выборка и сортировка по индексу ix_user_auth_expires_at
+    stmt = (
+        _select_user_auths()
+        .where(UserAuthScheme.expires_at <= expires_before)
+        .order_by(UserAuthScheme.expires_at)
+        .limit(limit)
+    )
+    if updated_after is not None:
+        stmt = stmt.where(UserAuthScheme.updated_at > updated_after)
+    return stmt
+
+
+def _get_columns(scheme: type, model: type[Model], prefix: str = "") -> list:
+    """
+    Столбцы таблицы, соответствующие полям модели, с метками prefix + имя поля.
+    Запрос столбцов вместо сущностей не создаёт объекты ORM
+    """
+    columns = scheme.__table__.columns
+    return [columns[name].label(prefix + name) for name in model.model_fields if name in columns]
+
+
+def _to_model(model: type[Model], row: Row, prefix: str = "", **values) -> Model:
+    """
+    Модель из строки результата _get_columns без валидации:
+    типы значений из базы данных уже соответствуют полям моделей
+    """
+    mapping = row._mapping
+    for name in model.model_fields:
+        if prefix + name in mapping:
+            values.setdefault(name, mapping[prefix + name])
+    return model.model_construct(**values)
+
+
+def _select_user_auths() -> Select:
+    """
+    Данные авторизации вместе с client_endpoint портала
+    """
+    return (
+        select(
+            *_get_columns(UserAuthScheme, UserAuthModel),
+            PortalScheme.client_endpoint.label("client_endpoint"),
+        )
+        .join(PortalScheme, PortalScheme.member_id == UserAuthScheme.member_id)
+    )
 
 async def _refresh_user_auth(session: AsyncSession, auth: UserAuthModel):
     try:
         stmt = (
             update(UserAuthScheme).where(UserAuthScheme.user_id == auth.user_id,
                                           UserAuthScheme.member_id == auth.member_id).values(
-                                              **auth.model_dump()
+                                              **_get_user_auth_values(auth)
                                           )
         )
         await session.execute(statement=stmt)
-        await session.commit()
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, USER_AUTH, _get_user_auth_key(auth.member_id, auth.user_id)))
     except Exception as e:
         logger.error(f"Ошибка при обновлении токена пользователя: {e}")
         await session.rollback()
@@ -198,8 +327,323 @@ async def _delete_user_auth(session: AsyncSession, auth: UserAuthModel):
     try:
         await session.execute(delete(UserAuthScheme).where(UserAuthScheme.user_id == auth.user_id,
                                                             UserAuthScheme.member_id == auth.member_id))
-        await session.commit()        
+        await commit(session)
+        await after_commit(session, partial(cache.invalidate, USER_AUTH, _get_user_auth_key(auth.member_id, auth.user_id)))
     except Exception as e:
         logger.error(f"Ошибка при удалении токеа пользователя: {e}")
         await session.rollback()
         raise
+
+
+async def get_expiring_user_auths(
+    session: AsyncSession,
+    expires_before: datetime,
+    updated_after: datetime | None = None,
+    limit: int | None = None
+) -> list[UserAuthModel]:
+    """
+    Данные авторизации, access_token которых истекает раньше expires_before,
+    в порядке истечения. updated_after отсекает записи с уже недействительным refresh_token
+    """
+    try:
+        result = await session.execute(_select_expiring_user_auths(expires_before, updated_after, limit))
+        return [_to_model(UserAuthModel, row) for row in result]
+    except Exception as e:
+        logger.error(f"Ошибка при получении истекающих токенов: {e}")
+        raise
+
+
+async def get_meeting_context(session: AsyncSession, member_id: str, user_id: int) -> MeetingContextModel:
+    """
+    Портал, пространство КТолк, пользователь и его авторизация одним запросом.
+    Отсутствующие части перечислены в missing
+    """
+    user_id = int(user_id)
+    try:
+        stmt = (
+            select(
+                *_get_columns(PortalScheme, PortalModel, "portal_"),
+                *_get_columns(KtalkSpaceScheme, KtalkSpaceModel, "ktalk_space_"),
+                *_get_columns(UserScheme, UserModel, "user_"),
+                *_get_columns(UserAuthScheme, UserAuthModel, "user_auth_"),
+            )
+            .outerjoin(KtalkSpaceScheme, KtalkSpaceScheme.member_id == PortalScheme.member_id)
+            .outerjoin(UserScheme, and_(
+                UserScheme.member_id == PortalScheme.member_id,
+                UserScheme.user_id == user_id
+            ))
+            .outerjoin(UserAuthScheme, and_(
+                UserAuthScheme.member_id == PortalScheme.member_id,
+                UserAuthScheme.user_id == user_id
+            ))
+            .where(PortalScheme.member_id == member_id)
+        )
+        row = (await session.execute(stmt)).first()
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных для создания встречи: {e}")
+        raise
+
+    if row is None:
+        return MeetingContextModel(missing=list(MeetingContextMiss))
+
+    context = MeetingContextModel(portal=_to_model(PortalModel, row, "portal_"))
+    # Первичный ключ NULL - строки нет во внешнем соединении
+    if row.ktalk_space_member_id is not None:
+        context.ktalk_space = _to_model(KtalkSpaceModel, row, "ktalk_space_")
+    else:
+        context.missing.append(MeetingContextMiss.KTALK_SPACE)
+    if row.user_user_id is not None:
+        context.user = _to_model(UserModel, row, "user_")
+    else:
+        context.missing.append(MeetingContextMiss.USER)
+    if row.user_auth_user_id is not None:
+        context.user_auth = _to_model(
+            UserAuthModel, row, "user_auth_", client_endpoint=row.portal_client_endpoint
+        )
+    else:
+        context.missing.append(MeetingContextMiss.USER_AUTH)
+    return context
+
+
+async def get_portals(session: AsyncSession) -> list[PortalModel]:
+    """
+    Все подключённые порталы
+    """
+    result = await session.execute(select(*_get_columns(PortalScheme, PortalModel)).order_by(PortalScheme.member_id))
+    return [_to_model(PortalModel, row) for row in result]
+
+
+async def iterate_tenant(
+    session: AsyncSession, member_id: str, batch_size: int = UPSERT_CHUNK_SIZE
+) -> AsyncIterator[PortalModel | KtalkSpaceModel | UserModel | UserAuthModel]:
+    """
+    Все данные портала: портал, пространство КТолк, пользователи и их авторизация,
+    в порядке внешних ключей. Строки читаются с сервера пачками по batch_size
+    """
+    readers = (
+        (PortalModel, select(*_get_columns(PortalScheme, PortalModel)).where(PortalScheme.member_id == member_id)),
+        (KtalkSpaceModel, select(*_get_columns(KtalkSpaceScheme, KtalkSpaceModel))
+            .where(KtalkSpaceScheme.member_id == member_id)),
+        (UserModel, select(*_get_columns(UserScheme, UserModel))
+            .where(UserScheme.member_id == member_id).order_by(UserScheme.user_id)),
+        (UserAuthModel, _select_user_auths()
+            .where(UserAuthScheme.member_id == member_id).order_by(UserAuthScheme.user_id)),
+    )
+    for model, stmt in readers:
+        result = await session.stream(stmt.execution_options(yield_per=batch_size))
+        async for row in result:
+            yield _to_model(model, row)
+
+
+async def get_portal_user_auth(session: AsyncSession, member_id: str) -> UserAuthModel | None:
+    """
+    Данные авторизации любого пользователя портала для фоновых задач:
+    предпочтительно администратора, с самыми свежими токенами
+    """
+    try:
+        result = await session.execute(
+            _select_user_auths()
+            .join(UserScheme, and_(
+                UserScheme.member_id == UserAuthScheme.member_id,
+                UserScheme.user_id == UserAuthScheme.user_id
+            ))
+            .where(UserAuthScheme.member_id == member_id)
+            .order_by(UserScheme.is_admin.desc(), UserAuthScheme.updated_at.desc())
+            .limit(1)
+        )
+        row = result.first()
+        return _to_model(UserAuthModel, row) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных авторизации портала {member_id}: {e}")
+        raise
+
+
+async def get_users_synced_at(session: AsyncSession, member_id: str) -> datetime | None:
+    """
+    Начало последней успешной синхронизации пользователей портала
+    """
+    result = await session.execute(
+        select(PortalScheme.users_synced_at).where(PortalScheme.member_id == member_id)
+    )
+    return result.scalar()
+
+
+async def set_users_synced_at(session: AsyncSession, member_id: str, synced_at: datetime) -> None:
+    await session.execute(
+        update(PortalScheme).where(PortalScheme.member_id == member_id).values(users_synced_at=synced_at)
+    )
+    await commit(session)
+
+
+async def add_robot_job(session: AsyncSession, job: RobotJobModel) -> bool:
+    """
+    Поставить вызов робота в очередь. False - вызов с этим event_token уже в очереди
+    """
+    now = utcnow()
+    stmt = (
+        _get_insert(session)(RobotJobScheme)
+        .values(**job.model_dump(exclude={"id"}), created_at=now, updated_at=now)
+        .on_conflict_do_nothing(index_elements=["event_token"])
+    )
+    result = await session.execute(stmt)
+    await commit(session)
+    return result.rowcount == 1
+
+
+async def claim_robot_job(session: AsyncSession, lease: timedelta, limit: int = 10) -> RobotJobModel | None:
+    """
+    Взять задачу, время которой подошло: ожидающую или выполнявшуюся, чья аренда истекла
+    (обработчик упал или процесс остановлен). Задача арендуется на lease.
+    Между процессами задача делится сравнением статуса и run_after при обновлении
+    """
+    now = utcnow()
+    result = await session.execute(
+        select(*_get_columns(RobotJobScheme, RobotJobModel))
+        .where(and_(
+            RobotJobScheme.status.in_((RobotJobStatus.QUEUED, RobotJobStatus.RUNNING)),
+            RobotJobScheme.run_after <= now,
+        ))
+        .order_by(RobotJobScheme.run_after)
+        .limit(limit)
+    )
+    for row in result.all():
+        job = _to_model(RobotJobModel, row)
+        values = {"status": RobotJobStatus.RUNNING, "run_after": now + lease, "attempts": job.attempts + 1}
+        claimed = await session.execute(
+            update(RobotJobScheme)
+            .where(and_(
+                RobotJobScheme.id == job.id,
+                RobotJobScheme.status == job.status,
+                RobotJobScheme.run_after == job.run_after,
+            ))
+            .values(**values, updated_at=now)
+        )
+        await commit(session)
+        if claimed.rowcount == 1:
+            return job.model_copy(update=values)
+    return None
+
+
+async def set_robot_job_result(session: AsyncSession, job: RobotJobModel, result: dict) -> bool:
+    """
+    Сохранить промежуточный результат задачи. False - аренда задачи потеряна
+    """
+    return await _update_leased_robot_job(session, job, result=result)
+
+
+async def retry_robot_job(session: AsyncSession, job: RobotJobModel, run_after: datetime, error: str) -> bool:
+    return await _update_leased_robot_job(
+        session, job, status=RobotJobStatus.QUEUED, run_after=run_after, error=error
+    )
+
+
+async def finish_robot_job(
+    session: AsyncSession, job: RobotJobModel, status: RobotJobStatus, error: str | None = None
+) -> bool:
+    return await _update_leased_robot_job(session, job, status=status, error=error)
+
+
+async def _update_leased_robot_job(session: AsyncSession, job: RobotJobModel, **values) -> bool:
+    """
+    Обновить задачу, только если она ещё арендована этим обработчиком (статус и run_after
+    не изменились с claim_robot_job): задачу с истёкшей арендой мог взять другой обработчик
+    """
+    result = await session.execute(
+        update(RobotJobScheme)
+        .where(and_(
+            RobotJobScheme.id == job.id,
+            RobotJobScheme.status == RobotJobStatus.RUNNING,
+            RobotJobScheme.run_after == job.run_after,
+        ))
+        .values(**values, updated_at=utcnow())
+    )
+    await commit(session)
+    return result.rowcount == 1
+
+
+async def delete_robot_jobs(session: AsyncSession, finished_before: datetime) -> int:
+    """
+    Удалить завершённые задачи старше finished_before
+    """
+    result = await session.execute(
+        delete(RobotJobScheme).where(and_(
+            RobotJobScheme.status.in_((RobotJobStatus.DONE, RobotJobStatus.FAILED)),
+            RobotJobScheme.updated_at < finished_before,
+        ))
+    )
+    await commit(session)
+    return result.rowcount
+
+
+async def upsert_portals(session: AsyncSession, portals: list[PortalModel]) -> None:
+    """
+    Добавить или обновить порталы
+    """
+    await _upsert(session, PortalScheme, [portal.model_dump() for portal in portals])
+    for portal in portals:
+        await after_commit(session, partial(cache.invalidate, PORTAL, portal.member_id))
+        await after_commit(session, partial(cache.invalidate_prefix, USER_AUTH, f"{portal.member_id}:"))
+
+
+async def upsert_ktalk_spaces(session: AsyncSession, ktalk_spaces: list[KtalkSpaceModel]) -> None:
+    """
+    Добавить или обновить настройки пространств КТолк
+    """
+    await _upsert(session, KtalkSpaceScheme, [ktalk_space.model_dump() for ktalk_space in ktalk_spaces])
+    for ktalk_space in ktalk_spaces:
+        await after_commit(session, partial(cache.invalidate, KTALK_SPACE, ktalk_space.member_id))
+
+
+async def upsert_users(session: AsyncSession, users: list[UserModel], update_admin: bool = True) -> None:
+    """
+    Добавить или обновить пользователей.
+    update_admin=False сохраняет is_admin существующих пользователей
+    (у синхронизации нет сведений о правах администратора)
+    """
+    await _upsert(
+        session, UserScheme, [user.model_dump() for user in users],
+        keep=() if update_admin else ("is_admin",)
+    )
+
+
+async def upsert_user_auths(session: AsyncSession, auths: list[UserAuthModel]) -> None:
+    """
+    Добавить или обновить данные авторизации пользователей
+    """
+    await _upsert(session, UserAuthScheme, [_get_user_auth_values(auth) for auth in auths])
+    for auth in auths:
+        await after_commit(session, partial(cache.invalidate, USER_AUTH, _get_user_auth_key(auth.member_id, auth.user_id)))
+
+
+async def _upsert(session: AsyncSession, scheme: type, rows: list[dict], keep: tuple[str, ...] = ()) -> None:
+    """
+    INSERT ... ON CONFLICT (первичный ключ) DO UPDATE одним запросом на пачку строк
+    и одной фиксацией. Поддерживаются SQLite и PostgreSQL.
+    Столбцы keep у существующих строк не обновляются
+    """
+    if not rows:
+        return
+    insert = _get_insert(session)
+    primary_key = [column.name for column in scheme.__table__.primary_key]
+    try:
+        for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            stmt = insert(scheme).values(rows[start:start + UPSERT_CHUNK_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={name: stmt.excluded[name] for name in rows[0] if name not in primary_key and name not in keep}
+            )
+            await session.execute(stmt)
+        await commit(session)
+    except Exception as e:
+        logger.error(f"Ошибка при записи в таблицу {scheme.__tablename__}: {e}")
+        await session.rollback()
+        raise
+
+
+def _get_insert(session: AsyncSession):
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert
+    if dialect == "postgresql":
+        return postgresql.insert
+    raise NotImplementedError(f"UPSERT не поддерживается для базы данных {dialect}")
@@ -1,21 +1,45 @@
-from sqlalchemy import String, DateTime, Integer, Boolean, ForeignKeyConstraint, ForeignKey
+from sqlalchemy import JSON, String, DateTime, Integer, Boolean, ForeignKeyConstraint, ForeignKey, Index, TypeDecorator
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from datetime import datetime, timezone
 
+from src.utils import as_utc
+
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 
+class UTCDateTime(TypeDecorator):
+    """
+    Время в UTC. SQLite не хранит часовой пояс: время записывается в UTC
+    и при чтении возвращается с tzinfo=UTC, как из PostgreSQL
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return as_utc(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return as_utc(value) if value is not None else None
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class PortalScheme(Base):
     __tablename__ = "portal"
 
     member_id: Mapped[str] = mapped_column(String, primary_key=True)
     client_endpoint: Mapped[str] = mapped_column(String, nullable=False)
     scope: Mapped[str] = mapped_column(String, nullable=False)
+    # Начало последней синхронизации пользователей (src/tasks/user_sync.py)
+    users_synced_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
 
-    ktalk_space = relationship("KtalkSpaceScheme", back_populates="portal")
+    # У портала не больше одного пространства КТолк (member_id - первичный ключ ktalk_space)
+    ktalk_space = relationship("KtalkSpaceScheme", back_populates="portal", uselist=False)
     user = relationship("UserScheme", back_populates="portal")
     user_auth = relationship("UserAuthScheme", back_populates="portal", overlaps="user")
 
@@ -39,11 +63,12 @@ class UserScheme(Base):
     __tablename__ = "user"
 
     user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Первичный ключ начинается с user_id, для выборок по порталу нужен отдельный индекс
     member_id: Mapped[str] = mapped_column(String, ForeignKey(
         "portal.member_id",
         onupdate="CASCADE",
         ondelete="CASCADE"
-    ), primary_key=True)
+    ), primary_key=True, index=True)
     name: Mapped[str] = mapped_column(String, nullable=False)
     last_name: Mapped[str] = mapped_column(String, nullable=False)
     is_admin: Mapped[bool] = mapped_column(Boolean, nullable=False)
@@ -64,9 +89,9 @@ class UserAuthScheme(Base):
     user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     access_token: Mapped[str] = mapped_column(String, nullable=False)
     refresh_token: Mapped[str] = mapped_column(String, nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False
-    )
+    updated_at: Mapped[datetime] = mapped_column(UTCDateTime, default=utcnow, nullable=False)
+    # Истечение access_token, по нему фоновое обновление выбирает токены
+    expires_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True, index=True)
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -96,4 +121,29 @@ class UserAuthScheme(Base):
         data = {c.name: getattr(self, c.name) for c in self.__table__.columns}
         data['client_endpoint'] = self.client_endpoint
         return data
-    
\ No newline at end of file
+    
+
+
+class RobotJobScheme(Base):
+    __tablename__ = "robot_job"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # Повторный вызов робота Bitrix24 приходит с тем же event_token
+    event_token: Mapped[str] = mapped_column(String, nullable=False, unique=True)
+    member_id: Mapped[str] = mapped_column(String, nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Данные формы робота
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    status: Mapped[str] = mapped_column(String, nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Результат выполнения: при повторе после ошибки отправки в Bitrix24 встреча не создаётся заново
+    result: Mapped[dict | None] = mapped_column(JSON, nullable=True)
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Для ожидающих - время следующей попытки, для выполняемых - окончание аренды обработчиком
+    run_after: Mapped[datetime] = mapped_column(UTCDateTime, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(UTCDateTime, default=utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_robot_job_status_run_after", "status", "run_after"),
+    )
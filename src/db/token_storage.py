@@ -0,0 +1,47 @@
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from crest.models import AuthTokens
+from src.models import UserAuthModel
+from src.db.requests import get_user_auth_without_model, set_user_auth
+from src.logger.custom_logger import logger
+
+
+class UserAuthTokenStorage:
+    """
+    Хранилище токенов CRest в таблице user_auth.
+    Позволяет процессам uvicorn видеть токены, обновлённые друг другом
+    """
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession]) -> None:
+        self.session_factory = session_factory
+
+    async def load(self, tokens: AuthTokens) -> AuthTokens | None:
+        async with self.session_factory() as session:
+            # Токены могли обновить другие процессы: читаем из базы, минуя кэш
+            user_auth = await get_user_auth_without_model(
+                session=session, member_id=tokens.member_id, user_id=tokens.user_id, use_cache=False
+            )
+        if not user_auth:
+            return None
+        return AuthTokens(**user_auth.model_dump())
+
+    async def save(self, previous: AuthTokens, new: AuthTokens) -> bool:
+        auth = UserAuthModel(
+            user_id=new.user_id,
+            member_id=new.member_id,
+            client_endpoint="",  # хранится в портале, в user_auth не записывается
+            access_token=new.access_token,
+            refresh_token=new.refresh_token,
+            updated_at=new.updated_at,
+            expires_at=new.expires_at
+        )
+        async with self.session_factory() as session:
+            if previous.updated_at is None:
+                return await set_user_auth(session=session, auth=auth)
+            saved = await set_user_auth(session=session, auth=auth, expected_updated_at=previous.updated_at)
+
+        if not saved:
+            logger.warning(
+                f"Токены пользователя {new.member_id} - {new.user_id} уже обновлены другим процессом"
+            )
+        return saved
@@ -0,0 +1,176 @@
+import json
+import time
+from dataclasses import dataclass, field
+from importlib.util import find_spec
+from typing import BinaryIO, Callable, Iterator
+
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from src.models import PortalModel, KtalkSpaceModel, UserModel, UserAuthModel
+from src.db.requests import (
+    UPSERT_CHUNK_SIZE,
+    get_portals,
+    iterate_tenant,
+    upsert_portals,
+    upsert_ktalk_spaces,
+    upsert_users,
+    upsert_user_auths,
+)
+from src.db.unit_of_work import read_only
+from src.logger.custom_logger import logger
+
+
+# Таблица записи -> модель и функция записи. Порядок - порядок внешних ключей
+TABLES = {
+    "portal": (PortalModel, upsert_portals),
+    "ktalk_space": (KtalkSpaceModel, upsert_ktalk_spaces),
+    "user": (UserModel, upsert_users),
+    "user_auth": (UserAuthModel, upsert_user_auths),
+}
+# Поля с секретами, к которым применяется secret
+SECRETS = {
+    "ktalk_space": ("api_key",),
+    "user_auth": ("access_token", "refresh_token"),
+}
+FORMATS = ("ndjson", "msgpack")
+
+
+@dataclass
+class TransferStats:
+    """
+    Результат выгрузки или загрузки данных порталов
+    """
+    tenants: int = 0
+    rows: dict[str, int] = field(default_factory=lambda: dict.fromkeys(TABLES, 0))
+    bytes: int = 0
+    seconds: float = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return sum(self.rows.values()) / self.seconds if self.seconds else 0
+
+    def __str__(self) -> str:
+        rows = ", ".join(f"{table}: {count}" for table, count in self.rows.items())
+        return (
+            f"порталов {self.tenants}, строк {sum(self.rows.values())} ({rows}), "
+            f"{self.bytes / 1024 / 1024:.1f} МБ за {self.seconds:.1f} с, {self.rows_per_second:.0f} строк/с"
+        )
+
+
+async def export_tenants(
+    session_factory: async_sessionmaker[AsyncSession],
+    output: BinaryIO,
+    member_ids: list[str] | None = None,
+    fmt: str = "ndjson",
+    secret: Callable[[str], str] | None = None,
+    batch_size: int = UPSERT_CHUNK_SIZE,
+) -> TransferStats:
+    """
+    Выгрузить данные порталов (все, если member_ids не задан) построчно:
+    запись {"table": ..., "row": ...} на строку таблицы.
+    Каждый портал читается отдельной транзакцией только для чтения, строки - пачками
+    по batch_size, поэтому память не зависит от объёма данных и запись в базу не блокируется.
+    secret - преобразование секретов (api_key, токены) при выгрузке
+    """
+    dump = _get_dump(fmt)
+    stats = TransferStats()
+    started = time.perf_counter()
+    if member_ids is None:
+        async with read_only(session_factory) as session:
+            member_ids = [portal.member_id for portal in await get_portals(session)]
+
+    for member_id in member_ids:
+        async with read_only(session_factory) as session:
+            async for item in iterate_tenant(session, member_id, batch_size):
+                table = _get_table(item)
+                row = item.model_dump(mode="json")
+                for name in SECRETS.get(table, ()) if secret else ():
+                    row[name] = secret(row[name])
+                data = dump({"table": table, "row": row})
+                output.write(data)
+                stats.rows[table] += 1
+                stats.bytes += len(data)
+        stats.tenants += 1
+
+    stats.seconds = time.perf_counter() - started
+    logger.info(f"Выгрузка порталов: {stats}")
+    return stats
+
+
+async def import_tenants(
+    session_factory: async_sessionmaker[AsyncSession],
+    source: BinaryIO,
+    fmt: str = "ndjson",
+    secret: Callable[[str], str] | None = None,
+    batch_size: int = UPSERT_CHUNK_SIZE,
+) -> TransferStats:
+    """
+    Загрузить данные, выгруженные export_tenants. Строки записываются пачками по batch_size
+    через upsert: существующие строки обновляются, повторная загрузка безопасна.
+    secret - преобразование секретов (api_key, токены) при загрузке
+    """
+    stats = TransferStats()
+    started = time.perf_counter()
+    # client_endpoint данных авторизации - из портала, он выгружается раньше них
+    client_endpoints: dict[str, str] = {}
+    table, batch = None, []
+
+    for record in _get_load(fmt)(source):
+        if record["table"] != table or len(batch) >= batch_size:
+            await _save(session_factory, table, batch, stats)
+            table, batch = record["table"], []
+        row = record["row"]
+        for name in SECRETS.get(table, ()) if secret else ():
+            row[name] = secret(row[name])
+        if table == "portal":
+            client_endpoints[row["member_id"]] = row["client_endpoint"]
+            stats.tenants += 1
+        elif table == "user_auth":
+            row["client_endpoint"] = client_endpoints.get(row["member_id"], "")
+        batch.append(TABLES[table][0](**row))
+    await _save(session_factory, table, batch, stats)
+
+    stats.seconds = time.perf_counter() - started
+    logger.info(f"Загрузка порталов: {stats}")
+    return stats
+
+
+async def _save(
+    session_factory: async_sessionmaker[AsyncSession], table: str | None, batch: list[BaseModel], stats: TransferStats
+) -> None:
+    if not batch:
+        return
+    async with session_factory() as session:
+        await TABLES[table][1](session, batch)
+    stats.rows[table] += len(batch)
+
+
+def _get_table(item: BaseModel) -> str:
+    for table, (model, _) in TABLES.items():
+        if isinstance(item, model):
+            return table
+    raise TypeError(f"Неизвестная модель {type(item).__name__}")
+
+
+def _get_dump(fmt: str) -> Callable[[dict], bytes]:
+    if fmt == "msgpack":
+        return _import_msgpack().packb
+    if fmt == "ndjson":
+        return lambda record: json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+    raise ValueError(f"Формат {fmt} не поддерживается, допустимы: {', '.join(FORMATS)}")
+
+
+def _get_load(fmt: str) -> Callable[[BinaryIO], Iterator[dict]]:
+    if fmt == "msgpack":
+        return _import_msgpack().Unpacker
+    if fmt == "ndjson":
+        return lambda source: (json.loads(line) for line in source if line.strip())
+    raise ValueError(f"Формат {fmt} не поддерживается, допустимы: {', '.join(FORMATS)}")
+
+
+def _import_msgpack():
+    if not find_spec("msgpack"):
+        raise ImportError("Для формата msgpack необходимо установить пакет msgpack (pip install msgpack)")
+    import msgpack
+    return msgpack
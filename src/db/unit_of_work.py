@@ -0,0 +1,97 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+
+# Ключи session.info
+UNIT_OF_WORK = "unit_of_work"
+READ_ONLY = "read_only"
+AFTER_COMMIT = "after_commit"
+# Транзакция сессии открыта на соединении записи (см. RoutingSession)
+WRITING = "writing"
+
+
+class ReadOnlySessionError(Exception):
+    """
+    Попытка записи через сессию только для чтения
+    """
+
+
+@asynccontextmanager
+async def unit_of_work(factory: async_sessionmaker[AsyncSession]) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия, изменения которой фиксируются одной транзакцией при выходе из блока.
+    Функции src.db.requests в ней только отправляют изменения (flush),
+    при исключении все изменения откатываются
+    """
+    async with factory(info={UNIT_OF_WORK: True}) as session:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            session.info.pop(AFTER_COMMIT, None)
+            raise
+        await session.commit()
+        for callback in session.info.pop(AFTER_COMMIT, []):
+            await callback()
+
+
+@asynccontextmanager
+async def read_only(factory: async_sessionmaker[AsyncSession]) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия только для чтения: запись вызывает ReadOnlySessionError,
+    транзакция PostgreSQL открывается как READ ONLY, SQLite читает через пул чтения
+    """
+    async with factory(info={READ_ONLY: True}) as session:
+        yield session
+
+
+async def commit(session: AsyncSession) -> None:
+    """
+    Зафиксировать изменения функции src.db.requests.
+    В unit_of_work только flush: фиксация - при выходе из блока
+    """
+    if session.info.get(UNIT_OF_WORK):
+        await session.flush()
+    else:
+        await session.commit()
+
+
+async def after_commit(session: AsyncSession, callback: Callable[[], Awaitable[None]]) -> None:
+    """
+    Выполнить callback сейчас и, в unit_of_work, повторно после фиксации транзакции.
+    Для сброса кэша: до фиксации другие запросы могли снова закэшировать прежние данные
+    """
+    await callback()
+    if session.info.get(UNIT_OF_WORK):
+        session.info.setdefault(AFTER_COMMIT, []).append(callback)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _forbid_write_statements(orm_execute_state) -> None:
+    if orm_execute_state.session.info.get(READ_ONLY) and not orm_execute_state.is_select:
+        raise ReadOnlySessionError(f"Запись в сессии только для чтения: {orm_execute_state.statement}")
+
+
+@event.listens_for(Session, "before_flush")
+def _forbid_flush(session: Session, flush_context, instances) -> None:
+    if session.info.get(READ_ONLY) and (session.new or session.dirty or session.deleted):
+        raise ReadOnlySessionError("Изменение объектов в сессии только для чтения")
+
+
+@event.listens_for(Session, "after_begin")
+def _begin_read_only(session: Session, transaction, connection) -> None:
+    if session.info.get(READ_ONLY) and connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+    elif connection.engine is session.bind:
+        # Дальнейшие SELECT должны видеть изменения этой транзакции
+        session.info[WRITING] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _end_writing(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop(WRITING, None)
@@ -0,0 +1,240 @@
+import asyncio
+import collections
+import os
+import time
+from urllib.parse import quote
+
+from httpx import AsyncBaseTransport, AsyncClient, Limits, Response, Timeout, TransportError
+
+from crest.metrics import registry
+from crest.retry import RetryPolicy, get_response_json
+
+from src.models import KtalkSpaceModel
+from src.ktalk.models import MeetingModel, KTalkBackAnswerModel
+from src.ktalk.utils import get_back_answer
+
+from src.logger.custom_logger import logger
+
+
+KTALK_URL = "https://{space}.ktalk.ru"
+
+
+class KTalkError(Exception):
+    """
+    Ошибка API КТолк. status - код ответа, 0 - не удалось подключиться
+    """
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class KTalkClient:
+    """
+    Клиент API пространств КТолк (https://<space>.ktalk.ru/api).
+    Один HTTP клиент на процесс: keep-alive соединения к каждому пространству переиспользуются.
+
+    К одному пространству выполняется не больше concurrency запросов одновременно
+    и не больше rate запросов в секунду при запасе burst, чтобы рассылка встреч
+    одного портала не упиралась в ограничения КТолк и не задерживала другие порталы.
+    Ошибки соединения и 429 повторяются (RetryPolicy), создание встречи - только если
+    КТолк его точно не выполнял. Ответы с ошибкой не обязаны быть JSON.
+    Состояние пространства без запросов дольше, чем опустошается ведро (burst / rate), удаляется.
+
+    base_url - адрес пространства с подстановкой {space} (для тестов)
+    """
+
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        concurrency: int = 4,
+        rate: float = 5,
+        burst: int = 10,
+        retry_policy: RetryPolicy | None = None,
+        transport: AsyncBaseTransport | None = None,
+        base_url: str = KTALK_URL,
+    ) -> None:
+        self.timeout = Timeout(timeout, connect=connect_timeout)
+        self.limits = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.base_url = base_url
+
+        self._transport = transport
+        self._client: AsyncClient | None = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        # пространство -> (заполненность ведра, время последнего обновления)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._locks: dict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        # пространство -> число выполняемых запросов (ожидающих семафор и отправленных)
+        self._active: dict[str, int] = collections.defaultdict(int)
+        self._evicted_at = time.monotonic()
+        self._requests = registry.counter(
+            "ktalk_requests_total", "Запросы к API КТолк", ("operation", "status")
+        )
+
+    @property
+    def client(self) -> AsyncClient:
+        """
+        Общий HTTP клиент. Создаётся при первом обращении и пересоздаётся после close()
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient(timeout=self.timeout, limits=self.limits, transport=self._transport)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def create_meeting(self, ktalk_space: KtalkSpaceModel, meeting: MeetingModel) -> KTalkBackAnswerModel:
+        """
+        Создать встречу в календаре администратора пространства
+        """
+        meeting_temp = meeting.model_copy()
+        meeting_temp.start = str(meeting_temp.start_ktalk())
+        meeting_temp.end = str(meeting_temp.end_ktalk())
+        logger.debug(meeting_temp)
+
+        try:
+            response = await self._request(
+                ktalk_space, "create_meeting", "POST", f"/api/emailCalendar/{ktalk_space.admin_email}",
+                idempotent=False, json=meeting_temp.model_dump()
+            )
+        except KTalkError as e:
+            if e.status == 0:
+                return KTalkBackAnswerModel(error="Не удалось подключиться к КТолк, попробуйте позже")
+            if e.status == 403:
+                return KTalkBackAnswerModel(error="Неверный API ключ, либо тариф КТолк пространства")
+            return KTalkBackAnswerModel(error=f"Произошла ошибка при создании встречи: {e.message}")
+        body = get_response_json(response)
+        if not isinstance(body.get("room"), dict):
+            logger.error(f"Ответ КТолк без комнаты встречи: {body}")
+            return KTalkBackAnswerModel(error="Произошла ошибка при создании встречи: КТолк не вернул комнату")
+        return get_back_answer(body, ktalk_space)
+
+    async def get_room(self, ktalk_space: KtalkSpaceModel, room_name: str) -> dict | None:
+        """
+        Комната пространства, None - если её нет
+        """
+        try:
+            response = await self._request(ktalk_space, "get_room", "GET", f"/api/rooms/{quote(room_name, safe='')}")
+        except KTalkError as e:
+            if e.status == 404:
+                return None
+            raise
+        return get_response_json(response)
+
+    async def delete_room(self, ktalk_space: KtalkSpaceModel, room_name: str) -> bool:
+        """
+        Удалить комнату. False - комнаты уже нет
+        """
+        try:
+            await self._request(ktalk_space, "delete_room", "DELETE", f"/api/rooms/{quote(room_name, safe='')}")
+        except KTalkError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    async def _request(
+        self, ktalk_space: KtalkSpaceModel, operation: str, method: str, path: str,
+        idempotent: bool = True, **kwargs
+    ) -> Response:
+        """
+        Запрос к API пространства. Ответ не 2xx и ошибка соединения - KTalkError
+        """
+        space = ktalk_space.space
+        url = self.base_url.format(space=space) + path
+        self._evict_idle(time.monotonic())
+        self._active[space] += 1
+        try:
+            async with self._get_semaphore(space):
+                await self._acquire(space)
+                response = await self.retry_policy.run(
+                    lambda: self.client.request(
+                        method, url, headers={"X-Auth-Token": ktalk_space.api_key}, **kwargs
+                    ),
+                    idempotent=idempotent,
+                )
+        except TransportError as e:
+            self._requests.inc(operation=operation, status="connection_error")
+            logger.error(f"Не удалось подключиться к КТолк {space}: {e}")
+            raise KTalkError(0, str(e)) from e
+        finally:
+            self._active[space] -= 1
+            if not self._active[space]:
+                del self._active[space]
+
+        self._requests.inc(operation=operation, status=str(response.status_code))
+        if not response.is_success:
+            body = get_response_json(response)
+            message = body.get("errorMessage") or body.get("error_description") or body.get("error")
+            logger.error(f"Ошибка КТолк {space} {method} {path}: {response.status_code} {message}")
+            raise KTalkError(response.status_code, str(message))
+        return response
+
+    def _get_semaphore(self, space: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(space)
+        if semaphore is None:
+            semaphore = self._semaphores[space] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    def _evict_idle(self, now: float) -> None:
+        """
+        Удалить состояние пространств без выполняемых запросов, чьи ведра опустели.
+        Проверка не чаще, чем ведро опустошается
+        """
+        idle = self.burst / self.rate
+        if now - self._evicted_at < idle:
+            return
+        self._evicted_at = now
+        for space, (_, updated_at) in list(self._buckets.items()):
+            if now - updated_at >= idle and space not in self._active:
+                del self._buckets[space]
+                self._locks.pop(space, None)
+                self._semaphores.pop(space, None)
+
+    async def _acquire(self, space: str) -> None:
+        """
+        Дождаться возможности отправить запрос в пространство (leaky bucket)
+        """
+        async with self._locks[space]:
+            while True:
+                now = time.monotonic()
+                level, updated_at = self._buckets.get(space, (0, now))
+                level = max(0.0, level - (now - updated_at) * self.rate)
+                if level + 1 <= self.burst:
+                    self._buckets[space] = (level + 1, now)
+                    return
+                await asyncio.sleep((level + 1 - self.burst) / self.rate)
+
+
+def configure_ktalk(ktalk_client: KTalkClient) -> None:
+    """
+    Настройка клиента КТолк из переменных окружения:
+    KTALK_TIMEOUT, KTALK_CONNECT_TIMEOUT - таймауты запроса и подключения, сек.,
+    KTALK_CONCURRENCY - одновременных запросов к пространству,
+    KTALK_RATE_LIMIT, KTALK_BURST_LIMIT - запросов в секунду к пространству и запас
+    """
+    ktalk_client.timeout = Timeout(
+        float(os.getenv("KTALK_TIMEOUT", 30)), connect=float(os.getenv("KTALK_CONNECT_TIMEOUT", 10))
+    )
+    ktalk_client.concurrency = int(os.getenv("KTALK_CONCURRENCY", 4))
+    ktalk_client.rate = float(os.getenv("KTALK_RATE_LIMIT", 5))
+    ktalk_client.burst = int(os.getenv("KTALK_BURST_LIMIT", 10))
+
+
+# Клиент процесса, настраивается и закрывается в lifespan
+ktalk = KTalkClient()
@@ -4,7 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from src.middleware.lifespan import lifespan  # noqa: E402
 from src.middleware.middleware import LogRequestDataMiddleware, JWTAuthMiddleware  # noqa: E402, F401
-from src.router import handler, install, placement, create_external_meeting, create_internal_meeting, get_payload, set_settings  # noqa: E402
+from src.router import handler, install, placement, create_external_meeting, create_internal_meeting, get_payload, set_settings, metrics  # noqa: E402
 
 
 app = FastAPI(lifespan=lifespan)
@@ -29,3 +29,4 @@ app.include_router(create_external_meeting.router)
 app.include_router(create_internal_meeting.router)
 app.include_router(get_payload.router)
 app.include_router(set_settings.router)
+app.include_router(metrics.router)
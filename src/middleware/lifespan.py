@@ -4,26 +4,119 @@ from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from crest.crest import CRestBitrix24
+from crest.limits_manager import LimitsManager
+from crest.token_manager import TokenManager
+from crest.retry import RetryPolicy
 from src.logger.custom_logger import logger
 
-from src.db.database import run_db
+from src.db.database import run_db, close_db, session_factory
+from src.db.cache import cache, configure_cache
+from src.db.idempotency import idempotency, configure_idempotency
+from src.ktalk.client import ktalk, configure_ktalk
+from src.db.token_storage import UserAuthTokenStorage
+from src.tasks.token_refresh import TokenRefreshScheduler
+from src.tasks.user_sync import UserSyncScheduler
+from src.tasks.robot_jobs import RobotJobQueue
+from src.router.create_external_meeting import execute_robot
+
+
+def _get_http_options() -> dict:
+    """
+    Настройки пула соединений и лимитов порталов Bitrix24 из переменных окружения
+    """
+    return {
+        "timeout": float(os.getenv("BITRIX_TIMEOUT", 30)),
+        "connect_timeout": float(os.getenv("BITRIX_CONNECT_TIMEOUT", 10)),
+        "max_connections": int(os.getenv("BITRIX_MAX_CONNECTIONS", 100)),
+        "max_keepalive_connections": int(os.getenv("BITRIX_MAX_KEEPALIVE_CONNECTIONS", 20)),
+        "keepalive_expiry": float(os.getenv("BITRIX_KEEPALIVE_EXPIRY", 30)),
+        "batch_concurrency": int(os.getenv("BITRIX_BATCH_CONCURRENCY", 4)),
+        "http2": os.getenv("BITRIX_HTTP2", "false").lower() in ("1", "true", "yes"),
+        "transport_mode": os.getenv("BITRIX_TRANSPORT_MODE", "query"),
+        "max_batch_bytes": int(os.getenv("BITRIX_MAX_BATCH_BYTES", 0)) or None,
+        "retry_policy": RetryPolicy(
+            max_attempts=int(os.getenv("BITRIX_RETRY_ATTEMPTS", 4)),
+            deadline=float(os.getenv("BITRIX_RETRY_DEADLINE", 30)),
+        ),
+        "limits_manager": LimitsManager(
+            rate=float(os.getenv("BITRIX_RATE_LIMIT", 2)),
+            burst=int(os.getenv("BITRIX_BURST_LIMIT", 50)),
+        ),
+    }
+
+
+def _get_token_refresh_scheduler(crest: CRestBitrix24) -> TokenRefreshScheduler | None:
+    """
+    Фоновое обновление токенов из переменных окружения, None - если отключено
+    """
+    if os.getenv("TOKEN_REFRESH_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    active_within = os.getenv("TOKEN_REFRESH_ACTIVE_WITHIN")
+    return TokenRefreshScheduler(
+        crest=crest,
+        session_factory=session_factory,
+        interval=float(os.getenv("TOKEN_REFRESH_INTERVAL", 60)),
+        refresh_before=float(os.getenv("TOKEN_REFRESH_BEFORE", 600)),
+        batch_size=int(os.getenv("TOKEN_REFRESH_BATCH_SIZE", 10)),
+        batch_interval=float(os.getenv("TOKEN_REFRESH_BATCH_INTERVAL", 1)),
+        active_within=float(active_within) if active_within else None,
+    )
+
+
+def _get_user_sync_scheduler(crest: CRestBitrix24) -> UserSyncScheduler | None:
+    """
+    Синхронизация пользователей порталов из переменных окружения, None - если отключена
+    """
+    if os.getenv("USER_SYNC_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return UserSyncScheduler(
+        crest=crest,
+        session_factory=session_factory,
+        interval=float(os.getenv("USER_SYNC_INTERVAL", 3600)),
+    )
+
+
+def _get_robot_job_queue(crest: CRestBitrix24) -> RobotJobQueue | None:
+    """
+    Очередь выполнения робота из переменных окружения, None - если отключена
+    (робот выполняется в запросе Bitrix24)
+    """
+    if os.getenv("ROBOT_JOBS_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return RobotJobQueue(
+        crest=crest,
+        session_factory=session_factory,
+        handler=execute_robot,
+        concurrency=int(os.getenv("ROBOT_JOBS_CONCURRENCY", 4)),
+        max_attempts=int(os.getenv("ROBOT_JOBS_MAX_ATTEMPTS", 5)),
+        retry_delay=float(os.getenv("ROBOT_JOBS_RETRY_DELAY", 30)),
+    )
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Запуск сервера FastAPI")
     load_dotenv()
+    CRest: CRestBitrix24 | None = None
+    token_refresh: TokenRefreshScheduler | None = None
+    user_sync: UserSyncScheduler | None = None
+    robot_jobs: RobotJobQueue | None = None
     try:
         if os.getenv("CLIENT_ID") and os.getenv("CLIENT_SECRET"):
             logger.info("Активирован режим работы с приложениями")
             CRest = CRestBitrix24(
                 client_id=os.getenv("CLIENT_ID"),
                 client_secret=os.getenv("CLIENT_SECRET"),
+                token_manager=TokenManager(storage=UserAuthTokenStorage(session_factory)),
+                **_get_http_options()
             )
 
         elif os.getenv("CLIENT_WEBHOOK"):
             logger.info("Активирован режим работы с вебхуками")
-            CRest = CRestBitrix24(client_webhook=os.getenv("CLIENT_WEBHOOK"))
+            CRest = CRestBitrix24(
+                client_webhook=os.getenv("CLIENT_WEBHOOK"),
+                **_get_http_options()
+            )
 
         else:
             raise Exception(
@@ -32,9 +125,33 @@ async def lifespan(app: FastAPI):
 
         app.state.CRest = CRest
 
+        configure_cache(cache)
+        configure_idempotency(idempotency, cache.backend)
+        configure_ktalk(ktalk)
+        app.state.ktalk = ktalk
         await run_db()
         logger.info("Успешное подключение к базе данных")
 
+        if CRest.CLIENT_ID:
+            token_refresh = _get_token_refresh_scheduler(CRest)
+        if token_refresh:
+            token_refresh.start()
+            app.state.token_refresh = token_refresh
+            logger.info("Запущено фоновое обновление токенов")
+
+        if CRest.CLIENT_ID:
+            user_sync = _get_user_sync_scheduler(CRest)
+        if user_sync:
+            user_sync.start()
+            app.state.user_sync = user_sync
+            logger.info("Запущена синхронизация пользователей порталов")
+
+        robot_jobs = _get_robot_job_queue(CRest)
+        if robot_jobs:
+            robot_jobs.start()
+            app.state.robot_jobs = robot_jobs
+            logger.info(f"Запущена очередь роботов: {robot_jobs.concurrency} обработчиков")
+
         yield
     except Exception as e:
         logger.exception(
@@ -42,4 +159,15 @@ async def lifespan(app: FastAPI):
         )
         raise
     finally:
+        if token_refresh:
+            await token_refresh.stop()
+        if user_sync:
+            await user_sync.stop()
+        if robot_jobs:
+            await robot_jobs.stop()
+        if CRest:
+            await CRest.close()
+            logger.info("Пул соединений CRest закрыт")
+        await ktalk.close()
+        await close_db()
         logger.info("Завершение работы сервера FastAPI")
@@ -10,7 +10,7 @@ from src.auth import verify_token
 
 
 EXCLUDED_PATHS = {
-    "/docs", "/redoc", "/handler", "/create-external-meeting", "/install", "/placement"
+    "/docs", "/redoc", "/handler", "/create-external-meeting", "/install", "/placement", "/metrics"
 }
 
 class JWTAuthMiddleware(BaseHTTPMiddleware):
@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from enum import Enum
 from pydantic import BaseModel, Field
 
 
@@ -51,6 +52,10 @@ class UserModel(BaseModel):
     is_admin: bool
 
 
+# Время жизни access_token Bitrix24
+ACCESS_TOKEN_LIFETIME = timedelta(hours=1)
+
+
 class UserAuthModel(BaseModel):
     """
     Данные  пользователя
@@ -60,8 +65,79 @@ class UserAuthModel(BaseModel):
     client_endpoint: str = Field(exclude=True)  # exclude необходим при преобразовании из модели в схему. У схемы нет такого поля.
     access_token: str
     refresh_token: str
-    updated_at: datetime = Field(default=datetime.now())
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Истечение access_token. Если не задано, при записи считается как updated_at + ACCESS_TOKEN_LIFETIME
+    expires_at: datetime | None = None
 
     def dict_with_excluded_fields(self):
         return {**self.model_dump(mode="json"), "client_endpoint": self.client_endpoint}
-    
\ No newline at end of file
+    
+
+
+class MeetingContextMiss(str, Enum):
+    """
+    Чего не хватает в базе данных для создания встречи
+    """
+    PORTAL = "portal"
+    USER = "user"
+    USER_AUTH = "user_auth"
+    KTALK_SPACE = "ktalk_space"
+
+
+class MeetingContextModel(BaseModel):
+    """
+    Данные для создания встречи: портал, пространство КТолк, пользователь и его авторизация.
+    missing - отсутствующие части
+    """
+    portal: PortalModel | None = None
+    ktalk_space: KtalkSpaceModel | None = None
+    user: UserModel | None = None
+    user_auth: UserAuthModel | None = None
+    missing: list[MeetingContextMiss] = []
+
+
+class MeetingStepStatus(str, Enum):
+    OK = "ok"
+    FAILED = "failed"
+    # Не выполнялся: не выполнен шаг, от которого он зависит
+    SKIPPED = "skipped"
+
+
+class MeetingStepModel(BaseModel):
+    """
+    Результат шага создания встречи
+    """
+    status: MeetingStepStatus
+    error: str = ""
+
+
+class InternalMeetingAnswerModel(BaseModel):
+    """
+    Результат создания внутренней встречи: ссылка КТолк и результат каждого шага
+    (ktalk_meeting, calendar, calendar_event, blogpost)
+    """
+    url: str = ""
+    steps: dict[str, MeetingStepModel] = {}
+
+
+class RobotJobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class RobotJobModel(BaseModel):
+    """
+    Вызов робота Bitrix24 в очереди выполнения (src/tasks/robot_jobs.py)
+    """
+    id: int | None = None
+    event_token: str
+    member_id: str
+    user_id: int
+    payload: dict
+    status: RobotJobStatus = RobotJobStatus.QUEUED
+    attempts: int = 0
+    result: dict | None = None
+    error: str | None = None
+    run_after: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
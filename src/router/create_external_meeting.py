@@ -1,18 +1,21 @@
-from typing import AsyncGenerator
-from src.db.database import get_session
-from src.db.requests import get_portal, get_user_auth_without_model, get_ktalk_space
+from typing import AsyncGenerator, Awaitable, Callable
+from src.db.database import get_read_session
+from src.db.requests import get_meeting_context, get_user_auth_without_model
+from src.db.idempotency import ROBOT, idempotency
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 from crest.crest import CRestBitrix24
+from crest.exceptions import BitrixError
 from src.router.utils import get_crest
 
 from src.ktalk.requests import create_meeting
-from src.models import PortalModel, KtalkSpaceModel, UserAuthModel
+from src.models import KtalkSpaceModel, UserAuthModel, MeetingContextMiss
 from src.ktalk.models import MeetingModel, KTalkBackAnswerModel
 from src.middleware.utils import parse_form_data
 
-from src.bitrix_requests import add_todo_activity
+from src.bitrix_requests import add_todo_activity, send_robot_result
 
 from src.logger.custom_logger import logger
 
@@ -25,10 +28,11 @@ router = APIRouter()
 async def handler(
     request: Request,
     CRest: CRestBitrix24 = Depends(get_crest),
-    session: AsyncGenerator = Depends(get_session),
+    session: AsyncGenerator = Depends(get_read_session),
 ) -> KTalkBackAnswerModel:
     """
-    Создание встречи КТолк и дела CRest.
+    Робот создания встречи КТолк и дела CRest. Если запущена очередь роботов
+    (src/tasks/robot_jobs.py), вызов выполняется в фоне.
     form:
         "workflow_id": "681b6392a30743.60451827",
         "code": "ktalk_robot",
@@ -64,6 +68,52 @@ async def handler(
         "auth[application_token]": "XXX"
     """
     form_json = form_to_json(await request.form())
+
+    robot_jobs = getattr(request.app.state, "robot_jobs", None)
+    if robot_jobs:
+        # Ответ сразу: не дождавшись ответа, Bitrix24 повторяет вызов робота.
+        # Результат отправляется бизнес-процессу через bizproc.event.send
+        await robot_jobs.enqueue(form_json)
+        return KTalkBackAnswerModel()
+
+    # Повтор вызова робота Bitrix24 приходит с тем же event_token и может прийти до ответа на первый
+    answer, _ = await idempotency.run(
+        ROBOT,
+        form_json["event_token"],
+        request={name: value for name, value in form_json.items() if name not in ("auth", "ts")},
+        execute=lambda: execute_robot(CRest, session, form_json),
+        model=KTalkBackAnswerModel,
+        store=lambda answer: not answer.error,
+    )
+    # Не доставленный результат бизнес-процесс ждал бы бесконечно: ошибка ответа
+    # заставляет Bitrix24 повторить вызов, созданная встреча при этом берётся из idempotency
+    user_auth = await get_user_auth_without_model(
+        session, member_id=form_json["auth"]["member_id"], user_id=form_json["auth"]["user_id"]
+    )
+    if not user_auth:
+        logger.error(f"Нет данных авторизации для отправки результата робота {form_json['event_token']}")
+        raise HTTPException(503, "Не удалось отправить результат робота")
+    try:
+        await send_robot_result(CRest, user_auth, form_json["event_token"], answer)
+    except BitrixError as e:
+        logger.error(f"Не удалось отправить результат робота {form_json['event_token']}: {e}")
+        raise HTTPException(503, "Не удалось отправить результат робота")
+    return answer
+
+
+async def execute_robot(
+    CRest: CRestBitrix24,
+    session: AsyncSession,
+    form_json: dict,
+    created_meeting: KTalkBackAnswerModel | None = None,
+    on_meeting_created: Callable[[KTalkBackAnswerModel], Awaitable[None]] | None = None,
+) -> KTalkBackAnswerModel:
+    """
+    Создание встречи КТолк и дела CRest по данным формы робота.
+    created_meeting - встреча, созданная предыдущей попыткой: повторно не создаётся.
+    on_meeting_created - вызывается до создания дела (очередь роботов сохраняет встречу,
+    создание встречи КТолк не идемпотентно)
+    """
     auth = form_json.get("auth")
     properties = form_json.get("properties")
 
@@ -72,10 +122,18 @@ async def handler(
 
     member_id = auth['member_id']
 
-    user_auth: UserAuthModel = await get_user_auth_without_model(session, member_id=member_id, user_id=user_id)
-    if not user_auth:
+    context = await get_meeting_context(session, member_id=member_id, user_id=user_id)
+    if MeetingContextMiss.PORTAL in context.missing:
+        logger.error(f"Ошибка при получении портала: {member_id}")
+        return KTalkBackAnswerModel(error='Портал не найден')
+    if MeetingContextMiss.USER_AUTH in context.missing:
         logger.error(f"Ошибка при получении пользователя: {member_id} - {user_id}")
         return KTalkBackAnswerModel(error='Пользователь не найден')
+    if MeetingContextMiss.KTALK_SPACE in context.missing:
+        logger.error(f"Ошибка при получении пространства КТолк для портала: {member_id}")
+        return KTalkBackAnswerModel(error='Не удалось получить настройки пространства КТолк')
+    user_auth: UserAuthModel = context.user_auth
+    ktalk_space: KtalkSpaceModel = context.ktalk_space
     
     msk_offset = properties['timezone']
     gmt_timezone = format_timezone_from_offset(msk_offset_hours=msk_offset)
@@ -90,25 +148,21 @@ async def handler(
     logger.debug(meeting.start_ktalk())
     logger.debug(meeting.start_ktalk(False))
 
-    portal: PortalModel = await get_portal(session, member_id)
-    if not portal:
-        logger.error(f"Ошибка при получении портала: {member_id}")
-        return KTalkBackAnswerModel(error='Портал не найден')
-
-    ktalk_space: KtalkSpaceModel = await get_ktalk_space(session=session, portal=portal)
-    if not ktalk_space:
-        logger.error(f"Ошибка при получении пространства КТолк для портала: {member_id}")
-        return KTalkBackAnswerModel(error='Не удалось получить настройки пространства КТолк')
-
     # === Создание встречи КТолк ===
-    ktalk_response: KTalkBackAnswerModel = await create_meeting(
-        meeting=meeting,
-        ktalk_space=ktalk_space
-    )
-    if ktalk_response.error:
-        logger.error(f"Ошибка при создании встречи КТолк: {ktalk_response.error}")
-        return ktalk_response
-    logger.info(f'Была создана встреча: {ktalk_response}')
+    if created_meeting:
+        ktalk_response = created_meeting
+        logger.info(f'Встреча уже создана: {ktalk_response}')
+    else:
+        ktalk_response: KTalkBackAnswerModel = await create_meeting(
+            meeting=meeting,
+            ktalk_space=ktalk_space
+        )
+        if ktalk_response.error:
+            logger.error(f"Ошибка при создании встречи КТолк: {ktalk_response.error}")
+            return ktalk_response
+        logger.info(f'Была создана встреча: {ktalk_response}')
+        if on_meeting_created:
+            await on_meeting_created(ktalk_response)
     # ======
 
     # === Создание дела CRest ===
@@ -1,15 +1,26 @@
-from typing import AsyncGenerator
-from src.db.database import get_session
-from src.db.requests import get_portal, get_user_auth_without_model, get_ktalk_space
+import asyncio
+from typing import Annotated, AsyncGenerator, Awaitable, TypeVar
+from src.db.database import get_read_session
+from src.db.requests import get_meeting_context
+from src.db.idempotency import INTERNAL_MEETING, IdempotencyKeyReusedError, idempotency
 
-from fastapi import APIRouter, Depends, Query, Body, Response, HTTPException
+from fastapi import APIRouter, Depends, Query, Body, Header, HTTPException, Response
 
 from crest.crest import CRestBitrix24
 from src.router.utils import get_crest
 
-from src.models import PortalModel, UserAuthModel
+from src.models import (
+    BitrixCalendarModel,
+    InternalMeetingAnswerModel,
+    KtalkSpaceModel,
+    MeetingContextMiss,
+    MeetingStepModel,
+    MeetingStepStatus,
+    UserAuthModel,
+)
 
 from src.bitrix_requests import create_ktalk_calendar_event, get_ktalk_company_calendar, send_notification_to_blogpost
+from src.bitrix_requests import call_batch_results, get_blogpost_request, get_calendar_event_request
 from src.ktalk.requests import create_meeting
 from src.ktalk.models import MeetingModel, KTalkBackAnswerModel
 
@@ -18,6 +29,11 @@ from src.logger.custom_logger import logger
 
 router = APIRouter()
 
+T = TypeVar("T")
+
+# Встреч в одном запросе /create-internal-meetings
+MAX_BULK_MEETINGS = 500
+
 
 @router.post("/create-internal-meeting")
 async def handler(
@@ -27,64 +43,192 @@ async def handler(
     meeting: MeetingModel = Body(),
     # participants: ParticipantsModel,
     CRest: CRestBitrix24 = Depends(get_crest),
-    session: AsyncGenerator = Depends(get_session),
-) -> KTalkBackAnswerModel:
+    session: AsyncGenerator = Depends(get_read_session),
+    response: Response = None,
+    idempotency_key: Annotated[str | None, Header(alias="Idempotency-Key")] = None,
+) -> InternalMeetingAnswerModel:
     """
     Создание внутренней видеоконференции КТолк для сотрудников.
-    Создает встречу на платформе КТолк,
-    создает встречу в календаре компании,
-    отправляет уведомление в ленту о созданной встрече.
+    Создает встречу на платформе КТолк и одновременно ищет календарь компании,
+    затем параллельно создает встречу в календаре и уведомление в ленту.
+    Ошибка шага не прерывает независимые от него шаги, результат каждого - в steps ответа.
+    Повтор запроса с тем же заголовком Idempotency-Key получает ответ первого запроса
+    (заголовок ответа Idempotent-Replayed), если встреча КТолк была создана.
 
     params:
         user_auth: UserAuthModel - данные авторизации пользователя.
         meeting: MeetingModel - данные встречи.
         participants: ParticipantsModel - участники встречи (задел на будущее).
     """
-    portal: PortalModel = await get_portal(
-        session=session, member_id=member_id
-    )
-    logger.debug(portal)
+    user_auth, ktalk_space = await _get_context(session, member_id, user_id)
+
+    if not idempotency_key:
+        return await _create_internal_meeting(CRest, meeting, user_auth, ktalk_space)
+    try:
+        answer, replayed = await idempotency.run(
+            INTERNAL_MEETING,
+            f"{member_id}:{user_id}:{idempotency_key}",
+            request=meeting.model_dump(mode="json"),
+            execute=lambda: _create_internal_meeting(CRest, meeting, user_auth, ktalk_space),
+            model=InternalMeetingAnswerModel,
+            store=lambda answer: bool(answer.url),
+        )
+    except IdempotencyKeyReusedError as e:
+        raise HTTPException(422, str(e))
+    if replayed and response is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return answer
+
+
+@router.post("/create-internal-meetings")
+async def bulk_handler(
+    user_id: int = Query(alias="creatorId"),
+    member_id: str = Query(alias="memberId"),
+    meetings: list[MeetingModel] = Body(),
+    CRest: CRestBitrix24 = Depends(get_crest),
+    session: AsyncGenerator = Depends(get_read_session),
+) -> list[InternalMeetingAnswerModel]:
+    """
+    Создание серии внутренних видеоконференций КТолк (не больше MAX_BULK_MEETINGS за запрос).
+    Встречи КТолк создаются параллельно (одновременных запросов к пространству
+    не больше KTALK_CONCURRENCY), события календаря и уведомления в ленту
+    для всех встреч отправляются в Bitrix24 через batch.
+    Результат каждой встречи - в элементе ответа с тем же индексом, шаги как у /create-internal-meeting.
 
-    user_auth: UserAuthModel = await get_user_auth_without_model(
-        session=session, member_id=member_id, user_id=user_id
+    params:
+        meetings: list[MeetingModel] - данные встреч.
+    """
+    if not meetings:
+        return []
+    if len(meetings) > MAX_BULK_MEETINGS:
+        raise HTTPException(422, f"Не больше {MAX_BULK_MEETINGS} встреч за запрос")
+
+    user_auth, ktalk_space = await _get_context(session, member_id, user_id)
+
+    steps: list[dict[str, MeetingStepModel]] = [{} for _ in meetings]
+    calendar_steps: dict[str, MeetingStepModel] = {}
+    ktalk_calendar, *created_meetings = await asyncio.gather(
+        _run_step(calendar_steps, "calendar", _get_calendar(crest=CRest, user_auth=user_auth)),
+        *(
+            _run_step(steps[index], "ktalk_meeting", _create_ktalk_meeting(meeting=meeting, ktalk_space=ktalk_space))
+            for index, meeting in enumerate(meetings)
+        )
     )
-    logger.debug(user_auth)
+    for meeting_steps in steps:
+        meeting_steps["calendar"] = calendar_steps["calendar"]
+
+    # Для каждой созданной встречи два запроса подряд: событие календаря и пост
+    created = [index for index, information in enumerate(created_meetings) if information]
+    requests = []
+    for index in created if ktalk_calendar else ():
+        requests.append(get_calendar_event_request(
+            calendar_id=ktalk_calendar.id,
+            meeting=meetings[index],
+            created_meeting_information=created_meetings[index]
+        ))
+        requests.append(get_blogpost_request(
+            meeting=meetings[index],
+            created_meeting_information=created_meetings[index],
+            client_endpoint=user_auth.client_endpoint
+        ))
+
+    try:
+        results = await call_batch_results(crest=CRest, requests=requests, user_auth=user_auth)
+    except Exception as e:
+        logger.error(f"Ошибка batch при создании внутренних встреч: {e}")
+        results = [(None, str(e))] * len(requests)
+
+    for number, (name, (_, error)) in enumerate(zip(("calendar_event", "blogpost") * len(created), results)):
+        steps[created[number // 2]][name] = MeetingStepModel(
+            status=MeetingStepStatus.FAILED if error else MeetingStepStatus.OK, error=error or ""
+        )
+    for meeting_steps in steps:
+        for name in ("calendar_event", "blogpost"):
+            meeting_steps.setdefault(name, MeetingStepModel(status=MeetingStepStatus.SKIPPED))
+
+    return [
+        InternalMeetingAnswerModel(url=information.url if information else "", steps=meeting_steps)
+        for information, meeting_steps in zip(created_meetings, steps)
+    ]
 
-    if not user_auth:
-        return HTTPException(400, f"Не найдены данные авторизации для пользователя: {member_id} - {user_id}")
 
-    ktalk_space = await get_ktalk_space(session=session, portal=portal)
-    logger.debug(ktalk_space)
-    if not ktalk_space:
+async def _get_context(
+    session: AsyncGenerator, member_id: str, user_id: int
+) -> tuple[UserAuthModel, KtalkSpaceModel]:
+    context = await get_meeting_context(session=session, member_id=member_id, user_id=user_id)
+    logger.debug(context)
+
+    if MeetingContextMiss.USER_AUTH in context.missing:
+        raise HTTPException(400, f"Не найдены данные авторизации для пользователя: {member_id} - {user_id}")
+
+    if MeetingContextMiss.KTALK_SPACE in context.missing:
         logger.error("Пространство КТолк не настроено")
-        return HTTPException(400, "Пространство КТолк не настроено")
+        raise HTTPException(400, "Пространство КТолк не настроено")
+
+    return context.user_auth, context.ktalk_space
 
-    created_meeting_information = await create_meeting(meeting=meeting, ktalk_space=ktalk_space)
-    logger.debug(created_meeting_information)
 
-    ktalk_calendar = await get_ktalk_company_calendar(
-        crest=CRest,
-        user_auth=user_auth
+async def _create_internal_meeting(
+    CRest: CRestBitrix24, meeting: MeetingModel, user_auth: UserAuthModel, ktalk_space: KtalkSpaceModel
+) -> InternalMeetingAnswerModel:
+    # Поиск календаря не зависит от КТолк, событие и пост - друг от друга
+    steps: dict[str, MeetingStepModel] = {}
+    created_meeting_information, ktalk_calendar = await asyncio.gather(
+        _run_step(steps, "ktalk_meeting", _create_ktalk_meeting(meeting=meeting, ktalk_space=ktalk_space)),
+        _run_step(steps, "calendar", _get_calendar(crest=CRest, user_auth=user_auth)),
     )
+    logger.debug(created_meeting_information)
     logger.debug(ktalk_calendar)
-    if ktalk_calendar:
-        await create_ktalk_calendar_event(
-            crest=CRest,
-            calendar_id=ktalk_calendar.id,
-            meeting=meeting,
-            created_meeting_information=created_meeting_information,
-            user_auth=user_auth
-        )
-        logger.debug("Успешно создано событие в календаре компании")
 
-        await send_notification_to_blogpost(
-            crest=CRest,
-            meeting=meeting,
-            created_meeting_information=created_meeting_information,
-            user_auth=user_auth
+    if created_meeting_information and ktalk_calendar:
+        await asyncio.gather(
+            _run_step(steps, "calendar_event", create_ktalk_calendar_event(
+                crest=CRest,
+                calendar_id=ktalk_calendar.id,
+                meeting=meeting,
+                created_meeting_information=created_meeting_information,
+                user_auth=user_auth
+            )),
+            _run_step(steps, "blogpost", send_notification_to_blogpost(
+                crest=CRest,
+                meeting=meeting,
+                created_meeting_information=created_meeting_information,
+                user_auth=user_auth
+            )),
         )
-        logger.debug("Успешно создан пост в ленте")
     else:
-        logger.warning("Календарь компании не был найден")
+        for name in ("calendar_event", "blogpost"):
+            steps[name] = MeetingStepModel(status=MeetingStepStatus.SKIPPED)
+
+    return InternalMeetingAnswerModel(
+        url=created_meeting_information.url if created_meeting_information else "",
+        steps=steps
+    )
+
+
+async def _create_ktalk_meeting(meeting: MeetingModel, ktalk_space: KtalkSpaceModel) -> KTalkBackAnswerModel:
+    answer = await create_meeting(meeting=meeting, ktalk_space=ktalk_space)
+    if answer.error:
+        raise RuntimeError(answer.error)
+    return answer
+
 
-    return Response(status_code=200)
+async def _get_calendar(crest: CRestBitrix24, user_auth: UserAuthModel) -> BitrixCalendarModel:
+    calendar = await get_ktalk_company_calendar(crest=crest, user_auth=user_auth)
+    if not calendar:
+        raise LookupError("Календарь компании не был найден")
+    return calendar
+
+
+async def _run_step(steps: dict[str, MeetingStepModel], name: str, step: Awaitable[T]) -> T | None:
+    """
+    Выполнить шаг и записать результат в steps. Ошибка шага не прерывает остальные
+    """
+    try:
+        result = await step
+    except Exception as e:
+        logger.error(f"Ошибка шага {name} при создании внутренней встречи: {e}")
+        steps[name] = MeetingStepModel(status=MeetingStepStatus.FAILED, error=str(e))
+        return None
+    steps[name] = MeetingStepModel(status=MeetingStepStatus.OK)
+    return result
@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timezone
 from typing import AsyncGenerator
 
 from fastapi import APIRouter, Depends, Form, Request
@@ -60,6 +61,8 @@ async def handler(
         )
 
     (user_auth.access_token, user_auth.refresh_token) = (full_auth['access_token'], full_auth['refresh_token'])
+    # Время истечения пересчитывается от момента получения новой пары
+    (user_auth.updated_at, user_auth.expires_at) = (datetime.now(timezone.utc), None)
     await set_user_auth(session=session, auth=user_auth)
 
     token = create_jwt(user=user)
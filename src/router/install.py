@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 
 from typing import AsyncGenerator
 from fastapi import APIRouter, Depends, Form, Request
@@ -91,10 +91,18 @@ async def install(
             access_token="temp_access_token",
             refresh_token="temp_refresh_token"
         )
-    (admin_user_auth.access_token, admin_user_auth.refresh_token, admin_user_auth.updated_at) = (admin_request['access_token'], admin_request['refresh_token'], datetime.now())
+    (admin_user_auth.access_token, admin_user_auth.refresh_token, admin_user_auth.updated_at, admin_user_auth.expires_at) = (admin_request['access_token'], admin_request['refresh_token'], datetime.now(timezone.utc), None)
     
     await set_user_auth(session=session, auth=admin_user_auth)
 
+    # Остальные пользователи портала загружаются в фоне, чтобы их первый вход
+    # не тратил время на запросы user.current и user.admin
+    user_sync = getattr(request.app.state, "user_sync", None)
+    if user_sync:
+        # Синхронизация читает портал своей сессией: фиксируем установку до её запуска
+        await session.commit()
+        user_sync.trigger(admin_user_auth.member_id)
+
     admin_tokens = AuthTokens(
         access_token=admin_user_auth.access_token, refresh_token=admin_user_auth.refresh_token
     )
@@ -144,7 +152,7 @@ async def install(
         user_auth=admin_user_auth,
         application_domain=env.str("APPLICATION_DOMAIN")
     )
-    if not 'error' in created_robot.keys():
+    if 'error' in created_robot.keys():
         logger.warning(f"Ошибка при создании робота: {created_robot}")
 
     return HTMLResponse(content=html_content, status_code=200)
@@ -0,0 +1,26 @@
+import hmac
+import os
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+from crest.metrics import registry
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request):
+    """
+    Метрики процесса в формате Prometheus. Путь исключён из проверки JWT
+    и требует заголовок Authorization: Bearer <METRICS_TOKEN>.
+    Без METRICS_TOKEN метрики отключены: метка portal раскрывает список порталов клиентов
+    """
+    token = os.getenv("METRICS_TOKEN")
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Сравнение байтов: compare_digest не принимает строки не из ASCII
+    authorization = request.headers.get("Authorization", "").encode()
+    if not hmac.compare_digest(authorization, f"Bearer {token}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
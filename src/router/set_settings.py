@@ -3,7 +3,7 @@ from typing import AsyncGenerator
 from fastapi import APIRouter, Depends, Response, HTTPException
 
 from src.db.database import get_session
-from src.db.requests import get_portal, refresh_ktalk_space, get_ktalk_space, add_ktalk_space
+from src.db.requests import get_portal, upsert_ktalk_spaces
 from src.models import PortalModel, KtalkSpaceModel
 
 router = APIRouter()
@@ -20,16 +20,6 @@ async def handler(
     if not portal:
         return HTTPException(400, f"Портал {ktalk_space.member_id} не существует")
     
-    current_ktalk_space: KtalkSpaceModel = await get_ktalk_space(
-        session=session, portal=portal
-    )
-    if current_ktalk_space:
-        await refresh_ktalk_space(
-            session=session, ktalk_space=ktalk_space
-        )
-    else:
-        await add_ktalk_space(
-            session=session,ktalk_space=ktalk_space
-        )
+    await upsert_ktalk_spaces(session=session, ktalk_spaces=[ktalk_space])
 
     return Response(status_code=200)
@@ -0,0 +1,216 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from crest.crest import CRestBitrix24
+from src.bitrix_requests import send_robot_result
+from src.ktalk.models import KTalkBackAnswerModel
+from src.models import RobotJobModel, RobotJobStatus
+from src.db.requests import (
+    add_robot_job,
+    claim_robot_job,
+    delete_robot_jobs,
+    finish_robot_job,
+    get_user_auth_without_model,
+    retry_robot_job,
+    set_robot_job_result,
+)
+from src.db.schemes import utcnow
+from src.logger.custom_logger import logger
+
+
+# handler(crest, session, payload, created_meeting, on_meeting_created) - см. execute_robot
+RobotHandler = Callable[..., Awaitable[KTalkBackAnswerModel]]
+
+# Данные авторизации из формы робота в очереди не хранятся: задача выполняется
+# с токенами пользователя из user_auth, которые обновляет TokenManager
+AUTH_FIELDS = ("member_id", "user_id", "domain", "client_endpoint")
+
+
+class RobotJobLeaseLost(Exception):
+    """
+    Аренда задачи истекла, и её взял другой обработчик
+    """
+
+
+class RobotJobQueue:
+    """
+    Очередь вызовов робота в таблице robot_job: вызов сохраняется и сразу подтверждается,
+    concurrency обработчиков выполняют его через handler и возвращают результат
+    бизнес-процессу через bizproc.event.send.
+
+    Повтор вызова с тем же event_token в очередь не попадает. Ошибка выполнения
+    повторяется до max_attempts раз с паузой retry_delay, удваивающейся с каждой попыткой.
+    Задача обработчика, не завершившего её за lease секунд (например, процесс остановлен),
+    выполняется заново, а прежний обработчик больше не может её изменить.
+    Созданная встреча КТолк сохраняется в result до создания дела CRM,
+    поэтому повтор задачи встречу заново не создаёт.
+    Завершённые задачи удаляются через retention секунд.
+
+    result задачи: {"meeting": ответ КТолк, "done": выполнен ли handler целиком}
+    """
+
+    def __init__(
+        self,
+        crest: CRestBitrix24,
+        session_factory: async_sessionmaker[AsyncSession],
+        handler: RobotHandler,
+        concurrency: int = 4,
+        poll_interval: float = 1,
+        max_attempts: int = 5,
+        retry_delay: float = 30,
+        lease: float = 300,
+        retention: float = 7 * 24 * 3600,
+    ) -> None:
+        self.crest = crest
+        self.session_factory = session_factory
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = timedelta(seconds=lease)
+        self.retention = timedelta(seconds=retention)
+
+        self._jobs = crest.metrics.registry.counter(
+            "robot_jobs_total", "Вызовы робота в очереди выполнения", ("result",)
+        )
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+        self._purged_at = 0.0
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        for task in self._workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    async def enqueue(self, form_json: dict) -> bool:
+        """
+        Поставить вызов робота в очередь. False - вызов с этим event_token уже был
+        """
+        auth = form_json["auth"]
+        payload = {**form_json, "auth": {name: auth[name] for name in AUTH_FIELDS if name in auth}}
+        job = RobotJobModel(
+            event_token=form_json["event_token"],
+            member_id=auth["member_id"],
+            user_id=int(auth["user_id"]),
+            payload=payload,
+        )
+        async with self.session_factory() as session:
+            added = await add_robot_job(session, job)
+        if added:
+            self._jobs.inc(result="queued")
+            self._wakeup.set()
+        else:
+            self._jobs.inc(result="duplicate")
+            logger.info(f"Повторный вызов робота {job.event_token} пропущен")
+        return added
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.purge()
+                if await self.run_next():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка обработчика очереди роботов: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_next(self) -> bool:
+        """
+        Выполнить очередную задачу. False - задач нет
+        """
+        self._wakeup.clear()
+        async with self.session_factory() as session:
+            job = await claim_robot_job(session, self.lease)
+        if not job:
+            return False
+        await self.process(job)
+        return True
+
+    async def process(self, job: RobotJobModel) -> None:
+        result = job.result or {}
+        try:
+            if not result.get("done"):
+                created_meeting = KTalkBackAnswerModel(**result["meeting"]) if "meeting" in result else None
+
+                async def on_meeting_created(meeting: KTalkBackAnswerModel) -> None:
+                    await self._save_result(job, {"meeting": meeting.model_dump(), "done": False})
+
+                async with self.session_factory() as session:
+                    answer = await self.handler(self.crest, session, job.payload, created_meeting, on_meeting_created)
+                await self._save_result(job, {"meeting": answer.model_dump(), "done": True})
+            else:
+                answer = KTalkBackAnswerModel(**result["meeting"])
+            await self._send_result(job, answer)
+        except asyncio.CancelledError:
+            raise
+        except RobotJobLeaseLost:
+            logger.warning(f"Вызов робота {job.event_token} выполняется другим обработчиком")
+            return
+        except Exception as e:
+            await self._retry(job, e)
+            return
+
+        status = RobotJobStatus.FAILED if answer.error else RobotJobStatus.DONE
+        async with self.session_factory() as session:
+            finished = await finish_robot_job(session, job, status, answer.error or None)
+        if finished:
+            self._jobs.inc(result=status.value)
+
+    async def purge(self) -> None:
+        if time.monotonic() - self._purged_at < min(self.retention.total_seconds(), 3600):
+            return
+        self._purged_at = time.monotonic()
+        async with self.session_factory() as session:
+            deleted = await delete_robot_jobs(session, utcnow() - self.retention)
+        if deleted:
+            logger.info(f"Удалено завершённых вызовов робота: {deleted}")
+
+    async def _save_result(self, job: RobotJobModel, result: dict) -> None:
+        async with self.session_factory() as session:
+            saved = await set_robot_job_result(session, job, result)
+        if not saved:
+            raise RobotJobLeaseLost(job.event_token)
+
+    async def _send_result(self, job: RobotJobModel, answer: KTalkBackAnswerModel) -> None:
+        async with self.session_factory() as session:
+            user_auth = await get_user_auth_without_model(session, job.member_id, job.user_id)
+        if not user_auth:
+            raise LookupError(f"Нет данных авторизации пользователя {job.member_id} - {job.user_id}")
+        await send_robot_result(self.crest, user_auth, job.event_token, answer)
+
+    async def _retry(self, job: RobotJobModel, error: Exception) -> None:
+        logger.error(f"Ошибка выполнения робота {job.event_token}, попытка {job.attempts}: {error}")
+        if job.attempts < self.max_attempts:
+            run_after = utcnow() + timedelta(seconds=self.retry_delay * 2 ** (job.attempts - 1))
+            async with self.session_factory() as session:
+                if await retry_robot_job(session, job, run_after, str(error)):
+                    self._jobs.inc(result="retry")
+            return
+
+        async with self.session_factory() as session:
+            if not await finish_robot_job(session, job, RobotJobStatus.FAILED, str(error)):
+                return
+        self._jobs.inc(result=RobotJobStatus.FAILED.value)
+        # Бизнес-процесс не должен ждать результат, которого не будет
+        try:
+            await self._send_result(job, KTalkBackAnswerModel(error="Не удалось создать встречу КТолк"))
+        except Exception as e:
+            logger.error(f"Не удалось отправить ошибку робота {job.event_token}: {e}")
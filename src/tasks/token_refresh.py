@@ -0,0 +1,142 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from crest.crest import CRestBitrix24
+from crest.models import AuthTokens
+from src.models import ACCESS_TOKEN_LIFETIME, UserAuthModel
+from src.db.requests import get_expiring_user_auths
+from src.utils import as_utc
+from src.logger.custom_logger import logger
+
+
+# Время жизни refresh_token Bitrix24 (access_token - ACCESS_TOKEN_LIFETIME)
+REFRESH_TOKEN_LIFETIME = timedelta(days=28)
+
+
+@dataclass
+class TokenRefreshStats:
+    """
+    Статистика фонового обновления токенов.
+    lag - насколько позже запланированного момента обновлён токен
+    """
+    refreshed: int = 0
+    failed: int = 0
+    skipped_inactive: int = 0
+    last_lag: float = 0
+    max_lag: float = 0
+    sweeps: int = 0
+
+
+class TokenRefreshScheduler:
+    """
+    Фоновое обновление токенов пользователей до истечения их срока.
+    Раз в interval секунд выбирает из user_auth токены, которые истекут
+    в ближайшие refresh_before секунд, и обновляет их пачками по batch_size
+    с паузой batch_interval, чтобы обработчики запросов не тратили время на обновление.
+
+    active_within - обновлять только пользователей, чьи токены этот процесс
+    использовал за последние active_within секунд (None - всех)
+    """
+
+    def __init__(
+        self,
+        crest: CRestBitrix24,
+        session_factory: async_sessionmaker[AsyncSession],
+        interval: float = 60,
+        refresh_before: float = 600,
+        batch_size: int = 10,
+        batch_interval: float = 1,
+        active_within: float | None = None,
+    ) -> None:
+        self.crest = crest
+        self.session_factory = session_factory
+        self.interval = interval
+        self.refresh_before = timedelta(seconds=refresh_before)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.active_within = active_within
+
+        self.stats = TokenRefreshStats()
+        metrics_registry = crest.metrics.registry
+        self._refreshes = metrics_registry.counter(
+            "token_refresh_total", "Фоновые обновления токенов пользователей", ("result",)
+        )
+        self._lag = metrics_registry.histogram(
+            "token_refresh_lag_seconds", "Задержка фонового обновления относительно запланированного момента"
+        )
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка при фоновом обновлении токенов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> None:
+        now = datetime.now(timezone.utc)
+        async with self.session_factory() as session:
+            user_auths = await get_expiring_user_auths(
+                session=session,
+                expires_before=now + self.refresh_before,
+                updated_after=now - REFRESH_TOKEN_LIFETIME
+            )
+
+        due = [user_auth for user_auth in user_auths if self._is_active(user_auth)]
+        self.stats.skipped_inactive += len(user_auths) - len(due)
+        self._refreshes.inc(len(user_auths) - len(due), result="skipped_inactive")
+        self.stats.sweeps += 1
+
+        for start in range(0, len(due), self.batch_size):
+            if start:
+                await asyncio.sleep(self.batch_interval)
+            await asyncio.gather(*(
+                self._refresh(user_auth) for user_auth in due[start:start + self.batch_size]
+            ))
+
+        if due:
+            logger.info(
+                f"Фоновое обновление токенов: обновлено {self.stats.refreshed}, "
+                f"ошибок {self.stats.failed}, задержка {self.stats.last_lag:.1f} с"
+            )
+
+    async def _refresh(self, user_auth: UserAuthModel) -> None:
+        try:
+            await self.crest.token_manager.refresh(self.crest, AuthTokens(**user_auth.model_dump()))
+        except Exception as e:
+            self.stats.failed += 1
+            self._refreshes.inc(result="failed")
+            logger.error(f"Не удалось обновить токены {user_auth.member_id} - {user_auth.user_id}: {e}")
+            return
+
+        expires_at = user_auth.expires_at or as_utc(user_auth.updated_at) + ACCESS_TOKEN_LIFETIME
+        due_at = as_utc(expires_at) - self.refresh_before
+        lag = max(0.0, (datetime.now(timezone.utc) - due_at).total_seconds())
+        self.stats.refreshed += 1
+        self.stats.last_lag = lag
+        self.stats.max_lag = max(self.stats.max_lag, lag)
+        self._refreshes.inc(result="refreshed")
+        self._lag.observe(lag)
+
+    def _is_active(self, user_auth: UserAuthModel) -> bool:
+        if self.active_within is None:
+            return True
+        return self.crest.token_manager.is_active(user_auth.member_id, user_auth.user_id, self.active_within)
@@ -0,0 +1,166 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from crest.crest import CRestBitrix24
+from crest.models import AuthTokens
+from src.models import UserModel
+from src.db.requests import (
+    UPSERT_CHUNK_SIZE,
+    get_portals,
+    get_portal_user_auth,
+    get_users_synced_at,
+    set_users_synced_at,
+    upsert_users,
+)
+from src.utils import as_utc
+from src.logger.custom_logger import logger
+
+
+@dataclass
+class UserSyncStats:
+    """
+    Результат синхронизации пользователей портала.
+    full - загружены все пользователи, иначе только изменённые после прошлой синхронизации
+    """
+    member_id: str
+    full: bool = True
+    fetched: int = 0
+    failed: bool = False
+
+
+class UserSyncScheduler:
+    """
+    Синхронизация пользователей порталов с таблицей user.
+    Раз в interval секунд постранично загружает пользователей через user.get
+    (страницы после первой - одним batch) и записывает их пачками по chunk_size.
+    Повторно загружаются только пользователи, изменённые (TIMESTAMP_X) после начала
+    прошлой синхронизации с запасом overlap секунд на расхождение часов.
+
+    Права администратора user.get не отдаёт: новые пользователи добавляются с is_admin=False,
+    у существующих is_admin не меняется
+    """
+
+    def __init__(
+        self,
+        crest: CRestBitrix24,
+        session_factory: async_sessionmaker[AsyncSession],
+        interval: float = 3600,
+        chunk_size: int = UPSERT_CHUNK_SIZE,
+        overlap: float = 300,
+    ) -> None:
+        self.crest = crest
+        self.session_factory = session_factory
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.overlap = timedelta(seconds=overlap)
+
+        self._users = crest.metrics.registry.counter(
+            "user_sync_users_total", "Пользователи, загруженные синхронизацией", ("mode",)
+        )
+        self._task: asyncio.Task | None = None
+        self._triggered: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        tasks = [task for task in (self._task, *self._triggered) if task]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._triggered.clear()
+
+    def trigger(self, member_id: str) -> None:
+        """
+        Запустить синхронизацию портала, не дожидаясь периода (например, после установки)
+        """
+        task = asyncio.create_task(self._sync_portal_safe(member_id))
+        self._triggered.add(task)
+        task.add_done_callback(self._triggered.discard)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка при синхронизации пользователей: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> list[UserSyncStats]:
+        async with self.session_factory() as session:
+            portals = await get_portals(session)
+        return [await self._sync_portal_safe(portal.member_id) for portal in portals]
+
+    async def sync_portal(self, member_id: str, full: bool = False) -> UserSyncStats:
+        """
+        Синхронизировать пользователей портала. full - загрузить всех пользователей
+        """
+        started_at = datetime.now(timezone.utc)
+        async with self.session_factory() as session:
+            user_auth = await get_portal_user_auth(session, member_id)
+            synced_at = None if full else await get_users_synced_at(session, member_id)
+
+        stats = UserSyncStats(member_id=member_id, full=synced_at is None)
+        if not user_auth:
+            logger.warning(f"Нет авторизованных пользователей для синхронизации портала {member_id}")
+            return stats
+
+        params = {"FILTER": {"ACTIVE": True}, "sort": "ID", "order": "ASC"}
+        if synced_at is not None:
+            params["FILTER"][">TIMESTAMP_X"] = (as_utc(synced_at) - self.overlap).isoformat()
+
+        users: list[UserModel] = []
+        async for item in self.crest.iterate(
+            "user.get",
+            params,
+            client_endpoint=user_auth.client_endpoint,
+            auth_tokens=AuthTokens(**user_auth.model_dump()),
+            prefetch=True,
+        ):
+            users.append(UserModel(
+                member_id=member_id,
+                user_id=int(item["ID"]),
+                name=item.get("NAME") or "",
+                last_name=item.get("LAST_NAME") or "",
+                is_admin=False,
+            ))
+            if len(users) >= self.chunk_size:
+                await self._save(users, stats)
+                users = []
+        await self._save(users, stats)
+
+        async with self.session_factory() as session:
+            await set_users_synced_at(session, member_id, started_at)
+        logger.info(
+            f"Синхронизация пользователей портала {member_id}: "
+            f"{'полная' if stats.full else 'изменения'}, загружено {stats.fetched}"
+        )
+        return stats
+
+    async def _save(self, users: list[UserModel], stats: UserSyncStats) -> None:
+        if not users:
+            return
+        async with self.session_factory() as session:
+            await upsert_users(session, users, update_admin=False)
+        stats.fetched += len(users)
+        self._users.inc(len(users), mode="full" if stats.full else "incremental")
+
+    async def _sync_portal_safe(self, member_id: str) -> UserSyncStats:
+        try:
+            return await self.sync_portal(member_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Не удалось синхронизировать пользователей портала {member_id}: {e}")
+            return UserSyncStats(member_id=member_id, failed=True)
+
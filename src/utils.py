@@ -1,4 +1,5 @@
 import re
+from datetime import datetime, timezone
 
 
 def get_offset_sec(gmt_timezone: str) -> int:
@@ -7,3 +8,10 @@ def get_offset_sec(gmt_timezone: str) -> int:
         raise ValueError("Неверный GMT формат")
     offset_hours = int(match.group(1))
     return offset_hours * 3600
+
+
+def as_utc(value: datetime) -> datetime:
+    """
+    Время в UTC. Время без часового пояса считается записанным в UTC
+    """
+    return value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
@@ -1,11 +1,14 @@
 import pytest
 from typing import AsyncGenerator
-from sqlalchemy import event
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import sessionmaker
 from src.auth import create_jwt
 from src.models import PortalModel, UserAuthModel, KtalkSpaceModel, UserModel
 from src.db.schemes import Base
+from src.db.database import create_engine, get_session as get_app_session, get_read_session
+from src.db.migrations import upgrade, version_metadata
+from src.db.unit_of_work import read_only, unit_of_work
 
 from httpx import AsyncClient, ASGITransport
 from src.main import app
@@ -23,26 +26,21 @@ env.read_env(path='.env.test', override=True)
 """
 Настройки базы данных
 """
-TEST_URI = "sqlite+aiosqlite:///data/test.sqlite3"
+# TEST_DATABASE_URI=postgresql+asyncpg://... запускает тесты на PostgreSQL (docker-compose.yml)
+TEST_URI = env.str("TEST_DATABASE_URI", "") or "sqlite+aiosqlite:///data/test.sqlite3"
 
-engine_test = create_async_engine(TEST_URI)
+# Соединения asyncpg привязаны к циклу событий, а у каждого теста он свой
+engine_test = create_engine(TEST_URI) if TEST_URI.startswith("sqlite") else create_engine(TEST_URI, poolclass=NullPool)
 async_session_maker = sessionmaker(
     engine_test, class_=AsyncSession, expire_on_commit=False)
 # Base.metadata.bind = engine_test
 
-@event.listens_for(engine_test.sync_engine, 'connect')
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute('pragma foreign_keys=ON')
-    cursor.close()
-
 
 @pytest.fixture(autouse=True, scope='session')
 async def prepare_database():
-    async with engine_test.begin() as conn:
-        print("Preparing database...")
-        await conn.run_sync(Base.metadata.create_all)
-        print("Database is ready")
+    print("Preparing database...")
+    await upgrade(engine_test)
+    print("Database is ready")
 
     async with async_session_maker() as session:
         await prepare_tables(session=session)
@@ -51,6 +49,7 @@ async def prepare_database():
 
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(version_metadata.drop_all)
 
 
 @pytest.fixture()
@@ -146,7 +145,12 @@ def get_ktalk_space(get_admin_auth: UserAuthModel) -> KtalkSpaceModel:
 Настройки fastapi приложения
 """
 async def override_get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_session_maker() as session:
+    async with unit_of_work(async_session_maker) as session:
+        yield session
+
+
+async def override_get_read_session() -> AsyncGenerator[AsyncSession, None]:
+    async with read_only(async_session_maker) as session:
         yield session
 
 
@@ -161,7 +165,8 @@ def add_crest() -> CRestBitrix24:
 
 
 add_crest()
-app.dependency_overrides[get_session] = override_get_session
+app.dependency_overrides[get_app_session] = override_get_session
+app.dependency_overrides[get_read_session] = override_get_read_session
 
 
 @pytest.fixture(scope="session")
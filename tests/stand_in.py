@@ -0,0 +1,309 @@
+import asyncio
+import fnmatch
+import re
+import time
+from typing import Callable
+from urllib.parse import parse_qsl, unquote
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from httpx import ASGITransport
+
+from src.middleware.utils import parse_form_data
+
+
+STAND_IN_ENDPOINT = "http://bitrix.test/rest/"
+
+
+def stand_in_endpoint(portal: str) -> str:
+    return f"http://{portal}.bitrix.test/rest/"
+
+
+class BitrixStandIn:
+    """
+    Локальная замена порталов Bitrix24 для тестов crest.
+    Отвечает на POST http://<portal>.bitrix.test/rest/<method> в формате REST Bitrix24.
+    Обработчики методов регистрируются через add_method, все запросы
+    сохраняются в self.requests.
+
+    При заданных rate и burst эмулирует лимиты портала и отвечает
+    503 QUERY_LIMIT_EXCEEDED, как это делает Bitrix24.
+
+    После issue_tokens проверяет параметр auth (401 expired_token для
+    неизвестных токенов) и обслуживает обновление токенов на oauth.bitrix.info
+    с аннулированием использованного refresh_token
+    """
+
+    def __init__(self, rate: float | None = None, burst: int | None = None, delay: float = 0) -> None:
+        self.app = FastAPI()
+        self.requests: list[tuple[str, dict]] = []
+        self.rejected: list[tuple[str, str]] = []
+        self.rate = rate
+        self.burst = burst
+        self.delay = delay
+        # Ограничение длины URL, как у веб-сервера портала (414 Request-URI Too Long)
+        self.max_url_length: int | None = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._methods: dict[str, Callable[[dict], dict | JSONResponse]] = {"batch": self._batch}
+        self._buckets: dict[str, tuple[float, float]] = {}
+        # refresh_token -> access_token действующих пар
+        self.tokens: dict[str, str] | None = None
+        # Ответы со сбоями для следующих запросов: (код, заголовки, выполнить ли метод)
+        self.failures: list[tuple[int, dict, bool]] = []
+        self.refreshes: list[str] = []
+        self._issued = 0
+
+        @self.app.post("/oauth/token/")
+        async def oauth_token(request: Request):
+            refresh_token = request.query_params.get("refresh_token")
+            self.refreshes.append(refresh_token)
+            await asyncio.sleep(self.delay)
+            if self.tokens is None or refresh_token not in self.tokens:
+                return JSONResponse(
+                    {"error": "invalid_grant", "error_description": "Invalid refresh token"},
+                    status_code=400
+                )
+            del self.tokens[refresh_token]
+            access_token, new_refresh_token = self.issue_tokens()
+            return {
+                "access_token": access_token,
+                "refresh_token": new_refresh_token,
+                "expires_in": 3600,
+                "client_endpoint": STAND_IN_ENDPOINT,
+            }
+
+        @self.app.post("/rest/{method}")
+        async def rest(method: str, request: Request):
+            portal = request.url.hostname
+            if self.max_url_length and len(str(request.url)) > self.max_url_length:
+                return PlainTextResponse("414 Request-URI Too Large", status_code=414)
+            if self._is_limit_exceeded(portal):
+                self.rejected.append((portal, method))
+                return JSONResponse(
+                    {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+                    status_code=503
+                )
+
+            params = await self._get_params(request)
+            if self.tokens is not None and str(params.get("auth")) not in self.tokens.values():
+                return JSONResponse(
+                    {"error": "expired_token", "error_description": "The access token provided has expired."},
+                    status_code=401
+                )
+            self.requests.append((method, params))
+
+            if self.failures:
+                status_code, headers, executed = self.failures.pop(0)
+                if executed:
+                    self._execute(method, params)
+                # Страница ошибки прокси перед порталом, не JSON
+                return HTMLResponse("<html><body>Bad Gateway</body></html>", status_code, headers)
+
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.delay)
+                response = self._execute(method, params)
+            finally:
+                self.in_flight -= 1
+
+            if isinstance(response, JSONResponse):
+                return response
+            return {"time": {"operating": 0, "processing": 0.001}, **response}
+
+    async def _get_params(self, request: Request) -> dict:
+        """
+        Параметры из строки запроса и тела (форма или JSON), как их принимает Bitrix24
+        """
+        params = parse_form_data(request.query_params)
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            params.update(await request.json())
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            body = (await request.body()).decode()
+            params.update(parse_form_data(dict(parse_qsl(body))))
+        return params
+
+    def fail_next(self, status_code: int, count: int = 1, headers: dict | None = None, executed: bool = False) -> None:
+        """
+        Ответить на следующие count запросов ошибкой status_code.
+        executed - метод успевает выполниться до ошибки (как при 502 от прокси)
+        """
+        self.failures.extend([(status_code, headers or {}, executed)] * count)
+
+    def add_method(self, method: str, handler: Callable[[dict], dict | JSONResponse]) -> None:
+        self._methods[method] = handler
+
+    def issue_tokens(self) -> tuple[str, str]:
+        """
+        Выдать новую действующую пару (access_token, refresh_token)
+        """
+        if self.tokens is None:
+            self.tokens = {}
+        self._issued += 1
+        access_token, refresh_token = f"access{self._issued}", f"refresh{self._issued}"
+        self.tokens[refresh_token] = access_token
+        return access_token, refresh_token
+
+    def transport(self) -> ASGITransport:
+        return ASGITransport(self.app)
+
+    def _execute(self, method: str, params: dict) -> dict | JSONResponse:
+        handler = self._methods.get(method)
+        if handler is None:
+            return JSONResponse(
+                {"error": "ERROR_METHOD_NOT_FOUND", "error_description": "Method not found!"},
+                status_code=404
+            )
+        return handler(params)
+
+    def _batch(self, params: dict) -> dict:
+        """
+        Метод batch: выполняет команды по порядку, подставляет $result[name] и учитывает halt
+        """
+        result = {key: {} for key in ("result", "result_error", "result_total", "result_next", "result_time")}
+        def substitute(value):
+            if isinstance(value, dict):
+                return {key: substitute(item) for key, item in value.items()}
+            return re.sub(
+                r"\$result\[(\w+)\]",
+                lambda match: str(result["result"].get(match.group(1), "")),
+                value
+            ) if isinstance(value, str) else value
+
+        for name, cmd in params.get("cmd", {}).items():
+            method, _, query = str(cmd).partition("?")
+            response = self._execute(method, substitute(parse_form_data(dict(parse_qsl(query)))))
+            if isinstance(response, JSONResponse) or "error" in response:
+                result["result_error"][name] = {"error": "ERROR_CORE"}
+                if params.get("halt"):
+                    break
+                continue
+            result["result"][name] = response["result"]
+            result["result_time"][name] = {"operating": 0}
+            for key in ("total", "next"):
+                if key in response:
+                    result[f"result_{key}"][name] = response[key]
+        # Как и Bitrix24, отдаём пустые ассоциативные массивы списками
+        return {"result": {key: value or [] for key, value in result.items()}}
+
+    def calls(self, method: str) -> list[dict]:
+        return [params for name, params in self.requests if name == method]
+
+    def _is_limit_exceeded(self, portal: str) -> bool:
+        if self.rate is None or self.burst is None:
+            return False
+        now = time.monotonic()
+        level, updated_at = self._buckets.get(portal, (0, now))
+        level = max(0.0, level - (now - updated_at) * self.rate)
+        if level + 1 > self.burst:
+            self._buckets[portal] = (level, now)
+            return True
+        self._buckets[portal] = (level + 1, now)
+        return False
+
+
+class RedisStandIn:
+    """
+    Минимальная замена redis.asyncio.Redis для тестов общего кэша:
+    get, set с px, delete и scan_iter по шаблону
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[str, tuple[str, float | None]] = {}
+
+    async def get(self, key: str) -> str | None:
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: str, px: int | None = None) -> None:
+        self.data[key] = (value, time.monotonic() + px / 1000 if px else None)
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def scan_iter(self, match: str = "*"):
+        for key in list(self.data):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+
+class KTalkStandIn:
+    """
+    Локальная замена пространств КТолк для тестов клиента:
+    создание встречи (POST /api/emailCalendar/<email>), получение и удаление комнаты
+    (GET, DELETE /api/rooms/<room>) на http://<space>.ktalk.test.
+    Проверяет заголовок X-Auth-Token (403 для ключа не из api_keys)
+    """
+
+    def __init__(self, api_keys: set[str], delay: float = 0) -> None:
+        self.app = FastAPI()
+        self.api_keys = api_keys
+        self.delay = delay
+        # пространство -> комнаты
+        self.rooms: dict[str, dict[str, dict]] = {}
+        self.requests: list[tuple[str, str, str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Ответы со сбоями для следующих запросов: (код, тело не JSON)
+        self.failures: list[tuple[int, str]] = []
+
+        @self.app.middleware("http")
+        async def check(request: Request, call_next):
+            space = request.url.hostname.split(".")[0]
+            self.requests.append((space, request.method, request.url.path))
+            if request.headers.get("X-Auth-Token") not in self.api_keys:
+                return JSONResponse({"errorCode": "Forbidden", "errorMessage": "Invalid API key"}, 403)
+            if self.failures:
+                status_code, content = self.failures.pop(0)
+                return HTMLResponse(content, status_code)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.delay)
+                return await call_next(request)
+            finally:
+                self.in_flight -= 1
+
+        @self.app.post("/api/emailCalendar/{email}")
+        async def create_meeting(email: str, request: Request):
+            meeting = await request.json()
+            room = {
+                "roomName": meeting.get("roomName") or f"room{len(self.requests)}",
+                "title": meeting.get("subject"),
+                "sipSettings": {"number": "100"},
+            }
+            self.rooms.setdefault(request.url.hostname.split(".")[0], {})[room["roomName"]] = room
+            return {"room": room}
+
+        @self.app.get("/api/rooms/{path:path}")
+        async def get_room(request: Request):
+            room_name = self._get_room_name(request)
+            room = self.rooms.get(request.url.hostname.split(".")[0], {}).get(room_name)
+            if room is None:
+                return JSONResponse({"errorCode": "NotFound", "errorMessage": "Room not found"}, 404)
+            return room
+
+        @self.app.delete("/api/rooms/{path:path}")
+        async def delete_room(request: Request):
+            room_name = self._get_room_name(request)
+            if self.rooms.get(request.url.hostname.split(".")[0], {}).pop(room_name, None) is None:
+                return JSONResponse({"errorCode": "NotFound", "errorMessage": "Room not found"}, 404)
+            return PlainTextResponse("", 204)
+
+    def _get_room_name(self, request: Request) -> str:
+        """
+        Имя комнаты - один сегмент исходного пути, как его разбирает КТолк
+        """
+        segments = request.scope["raw_path"].decode().split("/")
+        return unquote(segments[3]) if len(segments) == 4 else ""
+
+    def fail_next(self, status_code: int, count: int = 1, content: str = "<html><body>Bad Gateway</body></html>") -> None:
+        self.failures.extend([(status_code, content)] * count)
+
+    def transport(self) -> ASGITransport:
+        return ASGITransport(self.app)
@@ -1,3 +1,6 @@
+import uuid
+import asyncio
+import pytest
 from httpx import AsyncClient
 from src.models import UserModel, UserAuthModel, KtalkSpaceModel
 
@@ -9,7 +12,8 @@ from src.bitrix_requests import delete_robot_request, create_robot_request, add_
 
 from tests.conftest import crest_auth
 from crest.models import CallRequest, AuthTokens
-from src.models import BitrixCalendarModel
+from src.models import BitrixCalendarModel, MeetingContextModel, MeetingStepStatus
+from src.ktalk.models import KTalkBackAnswerModel
 
 from tests.data import KTalkTestData as ktalk_data
 from tests.data import BitrixTestData as bitrix_data
@@ -337,3 +341,221 @@ class Test4FastapiApplication:
         )
         print(result)
         assert result.status_code == 307
+
+
+class Test4FastapiInternalMeeting:
+    """
+    Шаги /create-internal-meeting без обращения к КТолк и Bitrix24
+    """
+    @pytest.fixture()
+    def steps(self, monkeypatch):
+        from src.router import create_internal_meeting as router
+
+        started = []
+
+        async def get_meeting_context(session, member_id, user_id):
+            return MeetingContextModel(
+                user_auth=UserAuthModel(
+                    user_id=user_id, member_id=member_id, client_endpoint="https://example.bitrix24.ru/rest/",
+                    access_token="", refresh_token=""
+                ),
+                ktalk_space=KtalkSpaceModel(member_id=member_id, space="", api_key="", admin_email=""),
+            )
+
+        async def create_meeting(meeting, ktalk_space):
+            started.append("ktalk_meeting")
+            await asyncio.sleep(0.01)
+            # Календарь ищется, пока создаётся встреча КТолк
+            assert "calendar" in started
+            return ktalk_data.meeting_information_back_answer
+
+        async def get_ktalk_company_calendar(crest, user_auth):
+            started.append("calendar")
+            return BitrixCalendarModel(ID=1, NAME=bitrix_data.calendar_name, DESCRIPTION="")
+
+        async def create_ktalk_calendar_event(**kwargs):
+            return 1
+
+        async def send_notification_to_blogpost(**kwargs):
+            raise RuntimeError("log.blogpost.add недоступен")
+
+        for function in (
+            get_meeting_context, create_meeting, get_ktalk_company_calendar,
+            create_ktalk_calendar_event, send_notification_to_blogpost
+        ):
+            monkeypatch.setattr(router, function.__name__, function)
+        return router
+
+    async def test_partial_failure(self, steps):
+        answer = await steps.handler(
+            user_id=1, member_id="member_id", meeting=ktalk_data.meeting_model, CRest=None, session=None
+        )
+        assert answer.url == ktalk_data.meeting_information_back_answer.url
+        assert {name: step.status for name, step in answer.steps.items()} == {
+            "ktalk_meeting": MeetingStepStatus.OK,
+            "calendar": MeetingStepStatus.OK,
+            "calendar_event": MeetingStepStatus.OK,
+            "blogpost": MeetingStepStatus.FAILED,
+        }
+        assert answer.steps["blogpost"].error == "log.blogpost.add недоступен"
+
+    async def test_bitrix_errors(self, steps, monkeypatch):
+        from fastapi.responses import JSONResponse
+        from crest.crest import CRestBitrix24
+        from src import bitrix_requests
+        from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT
+
+        # Bitrix24 возвращает ошибку в ответе, а не исключением crest
+        stand_in = BitrixStandIn()
+        stand_in.add_method("calendar.event.add", lambda params: JSONResponse(
+            {"error": "ERROR_CORE", "error_description": "Секция не найдена"}, status_code=400
+        ))
+        stand_in.add_method("log.blogpost.add", lambda params: JSONResponse(
+            {"error": "ACCESS_DENIED", "error_description": "Нет прав"}, status_code=403
+        ))
+        crest = CRestBitrix24(client_webhook=STAND_IN_ENDPOINT, transport=stand_in.transport())
+        for name in ("create_ktalk_calendar_event", "send_notification_to_blogpost"):
+            monkeypatch.setattr(steps, name, getattr(bitrix_requests, name))
+
+        answer = await steps.handler(
+            user_id=1, member_id="member_id", meeting=ktalk_data.meeting_model, CRest=crest, session=None
+        )
+        await crest.close()
+        assert answer.steps["calendar_event"].status == MeetingStepStatus.FAILED
+        assert "Секция не найдена" in answer.steps["calendar_event"].error
+        assert answer.steps["blogpost"].status == MeetingStepStatus.FAILED
+        assert "ACCESS_DENIED" in answer.steps["blogpost"].error
+
+    async def test_skip_dependent_steps(self, steps, monkeypatch):
+        async def create_meeting(meeting, ktalk_space):
+            return KTalkBackAnswerModel(error="Нет доступа к пространству")
+
+        monkeypatch.setattr(steps, "create_meeting", create_meeting)
+        answer = await steps.handler(
+            user_id=1, member_id="member_id", meeting=ktalk_data.meeting_model, CRest=None, session=None
+        )
+        assert answer.url == ""
+        assert answer.steps["ktalk_meeting"].error == "Нет доступа к пространству"
+        assert answer.steps["calendar"].status == MeetingStepStatus.OK
+        assert answer.steps["calendar_event"].status == MeetingStepStatus.SKIPPED
+        assert answer.steps["blogpost"].status == MeetingStepStatus.SKIPPED
+
+    async def test_bulk(self, steps, monkeypatch):
+        from fastapi.responses import JSONResponse
+        from crest.crest import CRestBitrix24
+        from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT
+
+        stand_in = BitrixStandIn()
+        stand_in.add_method("calendar.event.add", lambda params: {"result": 1})
+        stand_in.add_method("log.blogpost.add", lambda params: JSONResponse(
+            {"error": "ACCESS_DENIED", "error_description": "Нет прав"}, status_code=403
+        ) if "закрытая" in params["POST_TITLE"] else {"result": 2})
+        # Режим query по умолчанию: пакеты всё равно передаются в теле запроса
+        crest = CRestBitrix24(client_webhook=STAND_IN_ENDPOINT, transport=stand_in.transport())
+
+        async def create_meeting(meeting, ktalk_space):
+            if meeting.subject == "без КТолк":
+                return KTalkBackAnswerModel(error="Нет доступа к пространству")
+            return KTalkBackAnswerModel(url=f"https://space.ktalk.ru/{meeting.subject}")
+
+        monkeypatch.setattr(steps, "create_meeting", create_meeting)
+        subjects = [f"встреча {index}" for index in range(60)] + ["без КТолк", "закрытая"]
+        meetings = [ktalk_data.meeting_model.model_copy(update={"subject": subject}) for subject in subjects]
+        answers = await steps.bulk_handler(
+            user_id=1, member_id="member_id", meetings=meetings, CRest=crest, session=None
+        )
+        await crest.close()
+
+        assert [answer.url for answer in answers[:2]] == [
+            "https://space.ktalk.ru/встреча 0", "https://space.ktalk.ru/встреча 1"
+        ]
+        assert all(answer.steps["blogpost"].status == MeetingStepStatus.OK for answer in answers[:60])
+        assert answers[60].steps["ktalk_meeting"].status == MeetingStepStatus.FAILED
+        assert answers[60].steps["calendar_event"].status == MeetingStepStatus.SKIPPED
+        assert answers[61].steps["calendar_event"].status == MeetingStepStatus.OK
+        assert answers[61].steps["blogpost"].status == MeetingStepStatus.FAILED
+        assert answers[61].steps["blogpost"].error
+        # 122 запроса - три пакета batch по 50 команд, а не 122 вызова
+        assert len(stand_in.calls("batch")) == 3
+        assert len(stand_in.requests) == 3
+
+    async def test_bulk_batch_size(self, steps, monkeypatch):
+        from crest.crest import CRestBitrix24
+        from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT
+
+        stand_in = BitrixStandIn()
+        stand_in.add_method("calendar.event.add", lambda params: {"result": 1})
+        stand_in.add_method("log.blogpost.add", lambda params: {"result": 2})
+        crest = CRestBitrix24(client_webhook=STAND_IN_ENDPOINT, transport=stand_in.transport())
+
+        async def create_meeting(meeting, ktalk_space):
+            return KTalkBackAnswerModel(url=f"https://space.ktalk.ru/{uuid.uuid4()}?pinCode=123456")
+
+        monkeypatch.setattr(steps, "create_meeting", create_meeting)
+        # Реалистичная серия: кириллические тема и описание на несколько предложений
+        description = "Еженедельное обучение сотрудников отдела продаж работе с CRM и сделками. " * 5
+        meetings = [
+            ktalk_data.meeting_model.model_copy(update={
+                "subject": f"Обучение новых сотрудников, занятие {index}", "description": description
+            })
+            for index in range(steps.MAX_BULK_MEETINGS)
+        ]
+        answers = await steps.bulk_handler(
+            user_id=1, member_id="member_id", meetings=meetings, CRest=crest, session=None
+        )
+        await crest.close()
+
+        assert all(answer.steps["blogpost"].status == MeetingStepStatus.OK for answer in answers)
+        # 1000 команд - 20 пакетов по 50, а не сотни пакетов из 1-2 команд в URL
+        assert len(stand_in.calls("batch")) == 2 * steps.MAX_BULK_MEETINGS // 50
+
+    async def test_bulk_batch_failure(self, steps):
+        from crest.crest import CRestBitrix24
+        from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT
+
+        stand_in = BitrixStandIn()
+        stand_in.add_method("calendar.event.add", lambda params: {"result": 1})
+        stand_in.add_method("log.blogpost.add", lambda params: {"result": 2})
+        # Пакет не выполнен целиком: ошибка относится ко всем его командам
+        stand_in.fail_next(500)
+        crest = CRestBitrix24(client_webhook=STAND_IN_ENDPOINT, transport=stand_in.transport())
+
+        answers = await steps.bulk_handler(
+            user_id=1, member_id="member_id", meetings=[ktalk_data.meeting_model] * 2, CRest=crest, session=None
+        )
+        await crest.close()
+        for answer in answers:
+            for name in ("calendar_event", "blogpost"):
+                assert answer.steps[name].status == MeetingStepStatus.FAILED
+                assert answer.steps[name].error
+
+    async def test_bulk_limit(self, steps):
+        from fastapi import HTTPException
+
+        with pytest.raises(HTTPException) as e:
+            await steps.bulk_handler(
+                user_id=1, member_id="member_id", meetings=[ktalk_data.meeting_model] * (steps.MAX_BULK_MEETINGS + 1),
+                CRest=None, session=None
+            )
+        assert e.value.status_code == 422
+
+    async def test_idempotency_key(self, steps, monkeypatch):
+        from src.db.idempotency import IdempotencyStore
+
+        monkeypatch.setattr(steps, "idempotency", IdempotencyStore())
+        created = []
+
+        async def create_meeting(meeting, ktalk_space):
+            created.append(meeting)
+            return ktalk_data.meeting_information_back_answer
+
+        monkeypatch.setattr(steps, "create_meeting", create_meeting)
+        answers = [
+            await steps.handler(
+                user_id=1, member_id="member_id", meeting=ktalk_data.meeting_model, CRest=None, session=None,
+                idempotency_key="double-click"
+            )
+            for _ in range(2)
+        ]
+        assert len(created) == 1
+        assert answers[0] == answers[1]
@@ -0,0 +1,513 @@
+import asyncio
+import time
+import pytest
+from httpx import AsyncBaseTransport, ConnectError, Request, Response
+
+from crest.crest import CRestBitrix24
+from crest.exceptions import BitrixError
+from crest.limits_manager import LimitsManager
+from crest.models import CallRequest, AuthTokens
+from crest.retry import RetryPolicy
+from crest.metrics import CRestMetrics, MetricsRegistry
+from crest.token_manager import TokenManager
+from src.db.requests import add_user, set_user_auth, get_user_auth
+from src.db.token_storage import UserAuthTokenStorage
+from src.models import UserAuthModel
+
+from tests.conftest import async_session_maker
+from tests.data import DatabaseTestData
+
+from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT, stand_in_endpoint
+
+
+def _get_crest(stand_in: BitrixStandIn, **kwargs) -> CRestBitrix24:
+    kwargs.setdefault("limits_manager", LimitsManager())
+    return CRestBitrix24(
+        client_webhook=STAND_IN_ENDPOINT,
+        transport=stand_in.transport(),
+        **kwargs
+    )
+
+
+class Test5CRest:
+    async def test_shared_client(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("user.current", lambda params: {"result": {"ID": "1"}})
+        crest = _get_crest(stand_in)
+
+        client = crest.client
+        for _ in range(3):
+            result = await crest.call(CallRequest(method="user.current"))
+            assert result["result"]["ID"] == "1"
+        assert crest.client is client
+        assert len(stand_in.calls("user.current")) == 3
+
+        await crest.close()
+        assert client.is_closed
+        assert crest.client is not client
+        await crest.close()
+
+
+class Test5CallRequest:
+    def test_nested_params(self):
+        request = CallRequest(method="crm.deal.add", params={
+            "fields": {"TITLE": "Сделка 1", "CONTACT_IDS": [1, 2], "UF": {}},
+            "params": {"REGISTER_SONET_EVENT": "Y"},
+        })
+        assert request.get_path() == (
+            "crm.deal.add?fields[TITLE]=%D0%A1%D0%B4%D0%B5%D0%BB%D0%BA%D0%B0%201"
+            "&fields[CONTACT_IDS][0]=1&fields[CONTACT_IDS][1]=2&"
+            "&params[REGISTER_SONET_EVENT]=Y"
+        )
+        assert CallRequest(method="profile").get_path() == "profile?"
+
+    def test_auth_and_cache(self):
+        request = CallRequest(method="user.get", params={"ID": 1})
+        assert request.get_path(auth="token") == "user.get?ID=1&auth=token"
+        assert request.get_path(auth="new token") == "user.get?ID=1&auth=new%20token"
+        assert request.params == {"ID": 1}
+        assert CallRequest(method="profile").get_path(auth="token") == "profile?auth=token"
+
+        request.params = {"ID": 2}
+        assert request.get_path() == "user.get?ID=2"
+
+
+class Test5CRestLimits:
+    async def test_burst_is_queued(self):
+        stand_in = BitrixStandIn(rate=20, burst=5)
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        # Клиент держит скорость чуть ниже лимита портала, чтобы сетевые задержки не вызывали отказов
+        crest = _get_crest(stand_in, limits_manager=LimitsManager(rate=16, burst=5))
+
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(
+            crest.call(CallRequest(method="profile")) for _ in range(10)
+        ))
+        assert all("result" in result for result in results)
+        assert not stand_in.rejected
+        assert time.monotonic() - started_at >= (10 - 5) / 16 * 0.9
+        await crest.close()
+
+    async def test_noisy_portal_does_not_block_others(self):
+        stand_in = BitrixStandIn(rate=10, burst=2)
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        crest = CRestBitrix24(
+            client_id="client_id",
+            client_secret="client_secret",
+            transport=stand_in.transport(),
+            limits_manager=LimitsManager(rate=8, burst=2)
+        )
+        tokens = AuthTokens(access_token="access", refresh_token="refresh")
+
+        noisy = asyncio.gather(*(
+            crest.call(CallRequest(method="profile"), stand_in_endpoint("noisy"), tokens)
+            for _ in range(6)
+        ))
+        await asyncio.sleep(0.01)
+
+        quiet = await crest.call(CallRequest(method="profile"), stand_in_endpoint("quiet"), tokens)
+        assert quiet["result"]["ID"] == "1"
+        assert not noisy.done()
+
+        assert all("result" in result for result in await noisy)
+        assert not stand_in.rejected
+        await crest.close()
+
+    async def test_query_limit_exceeded_is_retried(self):
+        stand_in = BitrixStandIn(rate=20, burst=2)
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        # Запас портала уже израсходован другими процессами, клиент об этом не знает
+        crest = _get_crest(stand_in, limits_manager=LimitsManager(rate=20, burst=50))
+
+        results = await asyncio.gather(*(
+            crest.call(CallRequest(method="profile")) for _ in range(4)
+        ))
+        assert stand_in.rejected
+        assert all("result" in result for result in results)
+        await crest.close()
+
+    async def test_operating_budget(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.list", lambda params: {
+            "result": [], "time": {"operating": 1, "processing": 0.001}
+        })
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        crest = _get_crest(stand_in, limits_manager=LimitsManager(operating_limit=2, operating_window=0.3))
+
+        for _ in range(2):
+            await crest.call(CallRequest(method="crm.deal.list"))
+
+        # Исчерпан бюджет только метода crm.deal.list
+        started_at = time.monotonic()
+        await crest.call(CallRequest(method="profile"))
+        assert time.monotonic() - started_at < 0.2
+
+        await crest.call(CallRequest(method="crm.deal.list"))
+        assert time.monotonic() - started_at >= 0.25
+        await crest.close()
+
+    async def test_idle_portals_are_evicted(self):
+        limits_manager = LimitsManager(rate=100, burst=2, operating_window=0.05)
+        request = CallRequest(method="profile")
+        for index in range(10):
+            await limits_manager.acquire(f"portal{index}", request)
+            limits_manager.record(f"portal{index}", request, {"time": {"operating": 1}})
+        assert len(limits_manager._buckets) == 10
+
+        await asyncio.sleep(0.06)
+        await limits_manager.acquire("active", request)
+        assert list(limits_manager._buckets) == ["active"]
+        assert list(limits_manager._locks) == ["active"]
+        assert not limits_manager._operating
+
+
+class Test5CRestBatch:
+    async def test_chunks_are_sent_concurrently(self):
+        stand_in = BitrixStandIn(delay=0.05)
+        stand_in.add_method("user.get", lambda params: {"result": [{"ID": params["ID"]}]})
+        crest = _get_crest(stand_in, batch_concurrency=3)
+
+        requests = [CallRequest(method="user.get", params={"ID": index}) for index in range(120)]
+        response = await crest.call_batch(requests)
+
+        assert len(stand_in.calls("batch")) == 3
+        assert stand_in.max_in_flight == 3
+        result = response["result"]["result"]
+        assert list(result) == [f"request{index}" for index in range(120)]
+        assert result["request119"] == [{"ID": 119}]
+        await crest.close()
+
+    async def test_halt_stops_next_chunks(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("user.get", lambda params: {"result": []})
+        crest = _get_crest(stand_in, batch_size=2)
+
+        requests = [
+            CallRequest(method="user.get"),
+            CallRequest(method="unknown.method"),
+            CallRequest(method="user.get"),
+            CallRequest(method="user.get"),
+        ]
+        response = await crest.call_batch(requests, halt=True)
+
+        assert len(stand_in.calls("batch")) == 1
+        assert list(response["result"]["result_error"]) == ["request1"]
+        await crest.close()
+
+    async def test_references_stay_in_one_chunk(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.add", lambda params: {"result": 7})
+        stand_in.add_method("crm.deal.get", lambda params: {"result": {"ID": params["id"]}})
+        crest = _get_crest(stand_in, batch_size=3)
+
+        requests = [CallRequest(method="crm.deal.add") for _ in range(5)]
+        requests.append(CallRequest(method="crm.deal.get", params={"id": "$result[request1]"}))
+        response = await crest.call_batch(requests)
+
+        chunks = [list(params["cmd"]) for params in stand_in.calls("batch")]
+        assert any({"request1", "request5"} <= set(chunk) for chunk in chunks)
+        assert all(len(chunk) <= 3 for chunk in chunks)
+        assert response["result"]["result"]["request5"] == {"ID": "7"}
+        await crest.close()
+
+
+class Test5CRestTransport:
+    description = "Описание встречи " * 500
+
+    @pytest.mark.parametrize("transport_mode", ["form", "json"])
+    async def test_body_transport(self, transport_mode):
+        stand_in = BitrixStandIn()
+        stand_in.max_url_length = 2000
+        stand_in.add_method("crm.activity.add", lambda params: {"result": params["fields"]["DESCRIPTION"]})
+        crest = _get_crest(stand_in, transport_mode=transport_mode)
+
+        request = CallRequest(method="crm.activity.add", params={
+            "fields": {"DESCRIPTION": self.description, "COMMUNICATIONS": [{"ENTITY_ID": 1}]}
+        })
+        response = await crest.call(request)
+
+        assert response["result"] == self.description
+        assert stand_in.calls("crm.activity.add")[0]["fields"]["COMMUNICATIONS"] in ([{"ENTITY_ID": 1}], {"0": {"ENTITY_ID": 1}})
+        await crest.close()
+
+    async def test_long_query_is_reported(self):
+        stand_in = BitrixStandIn()
+        stand_in.max_url_length = 2000
+        crest = _get_crest(stand_in)
+
+        with pytest.raises(BitrixError) as error:
+            await crest.call(CallRequest(method="crm.activity.add", params={"DESCRIPTION": self.description}))
+        assert error.value.error == "REQUEST_TOO_LARGE"
+        await crest.close()
+
+    async def test_batch_byte_budget(self):
+        stand_in = BitrixStandIn()
+        stand_in.max_url_length = 4000
+        stand_in.add_method("crm.activity.add", lambda params: {"result": 1})
+        crest = _get_crest(stand_in, max_batch_bytes=3500)
+
+        requests = [
+            CallRequest(method="crm.activity.add", params={"DESCRIPTION": "a" * (300 if index % 2 else 1000)})
+            for index in range(10)
+        ]
+        response = await crest.call_batch(requests)
+
+        assert len(response["result"]["result"]) == 10
+        assert not response["result"]["result_error"]
+        # 5 длинных и 5 коротких команд плотно укладываются в два пакета
+        assert len(stand_in.calls("batch")) == 2
+        await crest.close()
+
+
+class _FlakyTransport(AsyncBaseTransport):
+    """
+    Транспорт, который первые failures запросов не может установить соединение
+    """
+
+    def __init__(self, transport: AsyncBaseTransport, failures: int) -> None:
+        self.transport = transport
+        self.failures = failures
+
+    async def handle_async_request(self, request: Request) -> Response:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectError("Connection refused", request=request)
+        return await self.transport.handle_async_request(request)
+
+
+class Test5CRestRetry:
+    policy = RetryPolicy(base_delay=0.01, max_delay=0.05)
+
+    async def test_transient_errors_are_retried(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("user.get", lambda params: {"result": [{"ID": "1"}]})
+        stand_in.fail_next(502)
+        stand_in.fail_next(503, headers={"Retry-After": "0"})
+        crest = _get_crest(stand_in, retry_policy=self.policy)
+
+        response = await crest.call(CallRequest(method="user.get"))
+        assert response["result"] == [{"ID": "1"}]
+        assert len(stand_in.calls("user.get")) == 3
+        await crest.close()
+
+    async def test_add_is_not_duplicated(self):
+        stand_in = BitrixStandIn()
+        created = []
+        stand_in.add_method("crm.deal.add", lambda params: created.append(params) or {"result": len(created)})
+        stand_in.fail_next(502, executed=True)
+        crest = _get_crest(stand_in, retry_policy=self.policy)
+
+        response = await crest.call(CallRequest(method="crm.deal.add", params={"fields": {"TITLE": "1"}}))
+        assert response["error"] == "HTTP_502"
+        assert len(created) == 1
+
+        # 429 - портал не выполнял запрос, повтор безопасен
+        stand_in.fail_next(429, headers={"Retry-After": "0"})
+        response = await crest.call(CallRequest(method="crm.deal.add", params={"fields": {"TITLE": "2"}}))
+        assert response["result"] == 2
+        await crest.close()
+
+    def test_only_reads_are_idempotent(self):
+        assert self.policy.is_idempotent(["crm.deal.list", "user.get", "crm.deal.fields", "user.current"])
+        # Обмен refresh_token - запрос без метода
+        assert not self.policy.is_idempotent([""])
+        for method in ("bizproc.event.send", "crm.deal.update", "crm.deal.delete", "im.message.add"):
+            assert not self.policy.is_idempotent([method])
+        batch = CallRequest(method="batch", params={"cmd": {"a": "user.get", "b": "calendar.event.add?name=1"}})
+        assert not self.policy.is_idempotent(batch.get_methods().values())
+
+    async def test_event_send_is_not_duplicated(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("bizproc.event.send", lambda params: {"result": True})
+        stand_in.fail_next(504, executed=True)
+        crest = _get_crest(stand_in, retry_policy=self.policy)
+
+        response = await crest.call(CallRequest(method="bizproc.event.send", params={"EVENT_TOKEN": "1"}))
+        assert response["error"] == "HTTP_504"
+        assert len(stand_in.calls("bizproc.event.send")) == 1
+        await crest.close()
+
+    async def test_connection_errors(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        crest = CRestBitrix24(
+            client_webhook=STAND_IN_ENDPOINT,
+            transport=_FlakyTransport(stand_in.transport(), failures=2),
+            limits_manager=LimitsManager(),
+            retry_policy=self.policy,
+        )
+        assert (await crest.call(CallRequest(method="profile")))["result"]["ID"] == "1"
+
+        crest._transport.failures = 10
+        response = await crest.call(CallRequest(method="profile"))
+        assert response["error"] == "CONNECTION_ERROR"
+        await crest.close()
+
+
+class Test5CRestMetrics:
+    async def test_call_metrics(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.list", lambda params: {
+            "result": [], "time": {"operating": 0.5, "processing": 0.01}
+        })
+        stand_in.fail_next(503)
+        metrics = CRestMetrics(MetricsRegistry())
+        crest = _get_crest(stand_in, metrics=metrics, retry_policy=RetryPolicy(base_delay=0.01))
+
+        await crest.call(CallRequest(method="crm.deal.list"))
+        await crest.call_batch([CallRequest(method="crm.deal.list"), CallRequest(method="unknown.method")])
+
+        labels = {"method": "crm.deal.list", "portal": "bitrix.test"}
+        assert metrics.requests.get(status=200, **labels) == 1
+        assert metrics.retries.get(**labels) == 1
+        assert metrics.operating.get_count(**labels) == 2
+        assert metrics.batch_size.get_count(portal="bitrix.test") == 1
+        assert metrics.errors.get(method="unknown.method", portal="bitrix.test", error="ERROR_CORE") == 1
+
+        text = metrics.registry.render()
+        assert "# TYPE bitrix_request_duration_seconds histogram" in text
+        assert 'bitrix_requests_total{method="batch",portal="bitrix.test",status="200"} 1' in text
+        assert 'bitrix_operating_seconds_bucket{method="crm.deal.list",portal="bitrix.test",le="+Inf"} 2' in text
+        await crest.close()
+
+    async def test_metrics_endpoint(self, ac, monkeypatch):
+        monkeypatch.delenv("METRICS_TOKEN", raising=False)
+        assert (await ac.get("/metrics")).status_code == 404
+
+        monkeypatch.setenv("METRICS_TOKEN", "metrics-token")
+        assert (await ac.get("/metrics")).status_code == 401
+        response = await ac.get("/metrics", headers={"Authorization": "Bearer metrics-token"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+
+
+def _deal_list(deals: list[dict]):
+    """
+    Обработчик crm.deal.list с постраничной навигацией Bitrix24
+    """
+    def handler(params: dict) -> dict:
+        items = deals
+        for key, value in params.get("filter", {}).items():
+            if key == ">ID":
+                items = [deal for deal in items if deal["ID"] > int(value)]
+        start = int(params.get("start", 0))
+        if start == -1:
+            return {"result": items[:50]}
+        response = {"result": items[start:start + 50], "total": len(items)}
+        if start + 50 < len(items):
+            response["next"] = start + 50
+        return response
+    return handler
+
+
+class Test5CRestIterate:
+    deals = [{"ID": index, "TITLE": f"Сделка {index}"} for index in range(1, 131)]
+
+    async def test_iterate_pages(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.list", _deal_list(self.deals))
+        crest = _get_crest(stand_in)
+
+        items = [deal async for deal in crest.iterate("crm.deal.list", {"select": ["ID"]})]
+        assert items == self.deals
+        assert [params.get("start", 0) for params in stand_in.calls("crm.deal.list")] == [0, 50, 100]
+        await crest.close()
+
+    async def test_iterate_fast(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.list", _deal_list(self.deals))
+        crest = _get_crest(stand_in)
+
+        items = [deal async for deal in crest.iterate("crm.deal.list", fast=True)]
+        assert items == self.deals
+        calls = stand_in.calls("crm.deal.list")
+        assert [params["filter"][">ID"] for params in calls] == [0, 50, 100]
+        assert all(params["start"] == -1 for params in calls)
+        await crest.close()
+
+    async def test_iterate_prefetch(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("crm.deal.list", _deal_list(self.deals))
+        crest = _get_crest(stand_in)
+
+        items = [deal async for deal in crest.iterate("crm.deal.list", prefetch=True)]
+        assert items == self.deals
+        assert len(stand_in.calls("batch")) == 1
+        await crest.close()
+
+    async def test_iterate_error(self):
+        stand_in = BitrixStandIn()
+        crest = _get_crest(stand_in)
+
+        with pytest.raises(BitrixError):
+            [item async for item in crest.iterate("crm.unknown.list")]
+        await crest.close()
+
+
+def _get_app_crest(stand_in: BitrixStandIn, **kwargs) -> CRestBitrix24:
+    kwargs.setdefault("limits_manager", LimitsManager())
+    return CRestBitrix24(
+        client_id="client_id",
+        client_secret="client_secret",
+        transport=stand_in.transport(),
+        **kwargs
+    )
+
+
+class Test5CRestTokens:
+    async def test_concurrent_refresh_is_single_flight(self):
+        stand_in = BitrixStandIn(delay=0.02)
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        stand_in.issue_tokens()
+        _, refresh_token = stand_in.issue_tokens()
+        crest = _get_app_crest(stand_in)
+
+        tokens = [
+            AuthTokens(access_token="expired", refresh_token=refresh_token, member_id="member", user_id=1)
+            for _ in range(5)
+        ]
+        results = await asyncio.gather(*(
+            crest.call(CallRequest(method="profile"), STAND_IN_ENDPOINT, auth_tokens) for auth_tokens in tokens
+        ))
+
+        assert all("result" in result for result in results)
+        assert stand_in.refreshes == [refresh_token]
+        assert len({auth_tokens.access_token for auth_tokens in tokens}) == 1
+        await crest.close()
+
+    async def test_refresh_is_shared_between_workers(self, get_session):
+        stand_in = BitrixStandIn(delay=0.02)
+        stand_in.add_method("profile", lambda params: {"result": {"ID": "1"}})
+        _, refresh_token = stand_in.issue_tokens()
+
+        user = DatabaseTestData.test_user_data_model_correct.model_copy()
+        user.user_id = 1000
+        await add_user(get_session, user)
+        user_auth = UserAuthModel(
+            user_id=user.user_id,
+            member_id=user.member_id,
+            client_endpoint=STAND_IN_ENDPOINT,
+            access_token="expired",
+            refresh_token=refresh_token
+        )
+        await set_user_auth(get_session, user_auth)
+        user_auth = await get_user_auth(get_session, user)
+
+        # Два процесса со своими менеджерами токенов и общей базой
+        workers = [
+            _get_app_crest(stand_in, token_manager=TokenManager(storage=UserAuthTokenStorage(async_session_maker)))
+            for _ in range(2)
+        ]
+        tokens = [AuthTokens(**user_auth.model_dump()) for _ in workers]
+        results = await asyncio.gather(*(
+            worker.call(CallRequest(method="profile"), STAND_IN_ENDPOINT, auth_tokens)
+            for worker, auth_tokens in zip(workers, tokens)
+        ))
+        assert all("result" in result for result in results)
+
+        get_session.expire_all()
+        stored = await get_user_auth(get_session, user)
+        assert stored.refresh_token in stand_in.tokens
+        assert all(auth_tokens.access_token == stored.access_token for auth_tokens in tokens)
+        for worker in workers:
+            await worker.close()
@@ -1,11 +1,17 @@
+import asyncio
 import uuid
 from datetime import datetime
+
+import pytest
 from environs import Env
+from crest.retry import RetryPolicy
+from src.ktalk.client import KTalkClient, KTalkError
 from src.ktalk.requests import create_meeting
 from src.models import KtalkSpaceModel
 from src.ktalk.models import MeetingModel, KTalkBackAnswerModel
 
 from tests.data import KTalkTestData as data
+from tests.stand_in import KTalkStandIn
 
 
 option_name = "ktalk_pytest"
@@ -84,6 +90,114 @@ class Test3KtalkApplication:
         print(created_meeting)
         assert isinstance(created_meeting, KTalkBackAnswerModel)
 
+
+class Test3KtalkClient:
+    space = KtalkSpaceModel(member_id="member", space="space1", api_key="key", admin_email="admin@example.com")
+
+    def _get_client(self, stand_in: KTalkStandIn, **kwargs) -> KTalkClient:
+        return KTalkClient(
+            transport=stand_in.transport(),
+            base_url="http://{space}.ktalk.test",
+            retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.01),
+            **kwargs
+        )
+
+    async def test_rooms(self):
+        stand_in = KTalkStandIn(api_keys={"key"})
+        client = self._get_client(stand_in)
+        meeting = data.meeting_model.model_copy()
+
+        answer = await client.create_meeting(self.space, meeting)
+        assert not answer.error
+        assert answer.url == f"https://space1.ktalk.ru/{meeting.roomName}"
+        assert answer.sipSettings == {"number": "100"}
+
+        room = await client.get_room(self.space, meeting.roomName)
+        assert room["title"] == meeting.subject
+        assert await client.delete_room(self.space, meeting.roomName)
+        assert await client.get_room(self.space, meeting.roomName) is None
+        assert not await client.delete_room(self.space, meeting.roomName)
+
+        # Соединение переиспользуется между запросами
+        http_client = client.client
+        await client.get_room(self.space, "missing")
+        assert client.client is http_client
+        await client.close()
+
+    async def test_room_name_is_escaped(self):
+        stand_in = KTalkStandIn(api_keys={"key"})
+        client = self._get_client(stand_in)
+        room_name = "план/встречи?a=1#b%20"
+        meeting = data.meeting_model.model_copy(update={"roomName": room_name})
+
+        assert not (await client.create_meeting(self.space, meeting)).error
+        assert (await client.get_room(self.space, room_name))["roomName"] == room_name
+        assert await client.delete_room(self.space, room_name)
+        assert await client.get_room(self.space, room_name) is None
+        await client.close()
+
+    async def test_errors(self):
+        stand_in = KTalkStandIn(api_keys={"key"})
+        client = self._get_client(stand_in)
+        meeting = data.meeting_model.model_copy()
+
+        # Страница ошибки прокси вместо JSON: чтение повторяется, создание встречи - нет
+        stand_in.fail_next(502)
+        assert await client.get_room(self.space, "missing") is None
+        stand_in.fail_next(502)
+        answer = await client.create_meeting(self.space, meeting)
+        assert answer.error and not answer.url
+        assert [method for _, method, _ in stand_in.requests].count("POST") == 1
+
+        stand_in.fail_next(500, content="Internal Server Error")
+        with pytest.raises(KTalkError) as e:
+            await client.get_room(self.space, "missing")
+        assert e.value.status == 500
+
+        wrong_key = self.space.model_copy(update={"api_key": "wrong"})
+        answer = await client.create_meeting(wrong_key, meeting)
+        assert answer.error == "Неверный API ключ, либо тариф КТолк пространства"
+        await client.close()
+
+    async def test_concurrency_per_space(self):
+        stand_in = KTalkStandIn(api_keys={"key"}, delay=0.05)
+        client = self._get_client(stand_in, concurrency=2, rate=1000, burst=1000)
+        other_space = self.space.model_copy(update={"space": "space2"})
+
+        await asyncio.gather(*(client.get_room(self.space, f"room{i}") for i in range(6)))
+        assert stand_in.max_in_flight == 2
+
+        stand_in.max_in_flight = 0
+        await asyncio.gather(*(
+            client.get_room(space, f"room{i}") for i in range(4) for space in (self.space, other_space)
+        ))
+        assert stand_in.max_in_flight == 4
+        await client.close()
+
+    async def test_rate_per_space(self):
+        stand_in = KTalkStandIn(api_keys={"key"})
+        client = self._get_client(stand_in, rate=20, burst=2)
+
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(client.get_room(self.space, f"room{i}") for i in range(4)))
+        # 2 запроса из запаса, ещё 2 - по одному за 1/20 сек.
+        assert asyncio.get_running_loop().time() - started >= 0.09
+        await client.close()
+
+    async def test_idle_spaces_are_evicted(self):
+        stand_in = KTalkStandIn(api_keys={"key"})
+        client = self._get_client(stand_in, rate=100, burst=2)
+        for index in range(5):
+            await client.get_room(self.space.model_copy(update={"space": f"idle{index}"}), "room")
+        assert len(client._buckets) == 5
+
+        await asyncio.sleep(0.03)
+        await client.get_room(self.space, "room")
+        assert list(client._buckets) == [self.space.space]
+        assert list(client._semaphores) == [self.space.space]
+        assert not client._active
+        await client.close()
+
 # async def test_robot_create_meeting(get_portal: PortalModel):
 #     meeting = MeetingModel(**robot_body)
 #     print(meeting)
@@ -0,0 +1,313 @@
+from datetime import datetime, timedelta, timezone
+
+from fastapi.responses import JSONResponse
+
+from crest.crest import CRestBitrix24
+from crest.limits_manager import LimitsManager
+from crest.models import AuthTokens
+from crest.token_manager import TokenManager
+from src.bitrix_requests import create_robot_request
+from src.db.requests import add_user, set_user_auth, get_user_auth, get_user, upsert_portals, upsert_users
+from src.db.requests import claim_robot_job, finish_robot_job, retry_robot_job
+from src.db.token_storage import UserAuthTokenStorage
+from src.models import PortalModel, RobotJobStatus, UserModel, UserAuthModel
+from src.tasks.token_refresh import TokenRefreshScheduler
+from src.tasks.user_sync import UserSyncScheduler
+from src.tasks.robot_jobs import RobotJobQueue
+from src.ktalk.models import KTalkBackAnswerModel
+
+from tests.conftest import async_session_maker
+from tests.data import DatabaseTestData
+from tests.stand_in import BitrixStandIn, STAND_IN_ENDPOINT
+
+
+async def _add_user_auth(session, stand_in: BitrixStandIn, user_id: int, updated_at: datetime) -> UserAuthModel:
+    user = DatabaseTestData.test_user_data_model_correct.model_copy()
+    user.user_id = user_id
+    await add_user(session, user)
+    access_token, refresh_token = stand_in.issue_tokens()
+    user_auth = UserAuthModel(
+        user_id=user.user_id,
+        member_id=user.member_id,
+        client_endpoint=STAND_IN_ENDPOINT,
+        access_token=access_token,
+        refresh_token=refresh_token,
+        updated_at=updated_at
+    )
+    await set_user_auth(session, user_auth)
+    return user_auth
+
+
+class Test6Tasks:
+    async def test_token_refresh_sweep(self, get_session):
+        stand_in = BitrixStandIn()
+        crest = CRestBitrix24(
+            client_id="client_id",
+            client_secret="client_secret",
+            transport=stand_in.transport(),
+            limits_manager=LimitsManager(),
+            token_manager=TokenManager(storage=UserAuthTokenStorage(async_session_maker))
+        )
+        now = datetime.now(timezone.utc)
+        expiring = await _add_user_auth(get_session, stand_in, 2000, now - timedelta(minutes=55))
+        inactive = await _add_user_auth(get_session, stand_in, 2001, now - timedelta(minutes=55))
+        fresh = await _add_user_auth(get_session, stand_in, 2002, now - timedelta(minutes=5))
+        # inactive давно не обращался к приложению
+        for user_auth in (expiring, fresh):
+            crest.token_manager.touch(AuthTokens(**user_auth.model_dump()))
+
+        scheduler = TokenRefreshScheduler(crest, async_session_maker, active_within=60)
+        await scheduler.sweep()
+
+        assert stand_in.refreshes == [expiring.refresh_token]
+        assert scheduler.stats.refreshed == 1
+        assert scheduler.stats.failed == 0
+        assert scheduler.stats.skipped_inactive == 1
+
+        get_session.expire_all()
+        stored = await get_user_auth(get_session, expiring)
+        assert stored.refresh_token in stand_in.tokens
+        assert stored.access_token != expiring.access_token
+        assert _as_utc(stored.updated_at) > now
+        stored = await get_user_auth(get_session, inactive)
+        assert stored.access_token == inactive.access_token
+        await crest.close()
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class Test6UserSync:
+    async def test_full_and_incremental_sync(self, get_session):
+        stand_in = BitrixStandIn()
+        crest = CRestBitrix24(
+            client_id="client_id",
+            client_secret="client_secret",
+            transport=stand_in.transport(),
+            limits_manager=LimitsManager(),
+        )
+        portal = PortalModel(member_id="user_sync_portal", client_endpoint=STAND_IN_ENDPOINT, scope="user")
+        await upsert_portals(get_session, [portal])
+        admin = UserModel(user_id=1, member_id=portal.member_id, name="Admin", last_name="", is_admin=True)
+        await upsert_users(get_session, [admin])
+        access_token, refresh_token = stand_in.issue_tokens()
+        await set_user_auth(get_session, UserAuthModel(
+            user_id=1, member_id=portal.member_id, client_endpoint=STAND_IN_ENDPOINT,
+            access_token=access_token, refresh_token=refresh_token
+        ))
+
+        changed_at = datetime.now(timezone.utc) - timedelta(days=1)
+        users = {
+            user_id: {"ID": str(user_id), "NAME": f"Name{user_id}", "LAST_NAME": "", "TIMESTAMP_X": changed_at.isoformat()}
+            for user_id in range(1, 121)
+        }
+
+        def user_get(params: dict) -> dict:
+            changed_after = params.get("FILTER", {}).get(">TIMESTAMP_X", "")
+            items = [user for user in users.values() if user["TIMESTAMP_X"] > changed_after]
+            start = int(params.get("start", 0))
+            response = {"result": items[start:start + 50], "total": len(items)}
+            if start + 50 < len(items):
+                response["next"] = start + 50
+            return response
+
+        stand_in.add_method("user.get", user_get)
+        scheduler = UserSyncScheduler(crest, async_session_maker, chunk_size=40)
+
+        stats = await scheduler.sync_portal(portal.member_id)
+        assert (stats.full, stats.fetched) == (True, 120)
+        # Первая страница отдельным запросом, остальные - одним batch
+        assert len(stand_in.calls("user.get")) == 1
+        assert len(stand_in.calls("batch")) == 1
+        assert (await get_user(get_session, 120, portal.member_id)).name == "Name120"
+        assert (await get_user(get_session, 1, portal.member_id)).is_admin
+
+        users[7].update(NAME="Renamed", TIMESTAMP_X=datetime.now(timezone.utc).isoformat())
+        stats = await scheduler.sync_portal(portal.member_id)
+        assert (stats.full, stats.fetched) == (False, 1)
+        assert ">TIMESTAMP_X" in stand_in.calls("user.get")[-1]["FILTER"]
+        get_session.expire_all()
+        assert (await get_user(get_session, 7, portal.member_id)).name == "Renamed"
+        await crest.close()
+
+
+async def _robot_portal(session, stand_in: BitrixStandIn, member_id: str) -> tuple[CRestBitrix24, dict]:
+    """
+    Портал с авторизацией пользователя 1 и форма вызова робота от него
+    """
+    crest = CRestBitrix24(
+        client_id="client_id",
+        client_secret="client_secret",
+        transport=stand_in.transport(),
+        limits_manager=LimitsManager(),
+    )
+    portal = PortalModel(member_id=member_id, client_endpoint=STAND_IN_ENDPOINT, scope="bizproc")
+    await upsert_portals(session, [portal])
+    await upsert_users(session, [UserModel(user_id=1, member_id=member_id, name="", last_name="", is_admin=True)])
+    access_token, refresh_token = stand_in.issue_tokens()
+    await set_user_auth(session, UserAuthModel(
+        user_id=1, member_id=member_id, client_endpoint=STAND_IN_ENDPOINT,
+        access_token=access_token, refresh_token=refresh_token
+    ))
+    form = {
+        "event_token": f"{member_id}_event",
+        "document_id": {"0": "crm", "1": "CCrmDocumentDeal", "2": "DEAL_1"},
+        "properties": {"subject": "Встреча"},
+        "auth": {"member_id": member_id, "user_id": "1", "access_token": "secret"},
+    }
+    return crest, form
+
+
+class Test6RobotJobs:
+    async def test_queue_retry_and_result(self, get_session):
+        stand_in = BitrixStandIn()
+        crest, form = await _robot_portal(get_session, stand_in, "robot_jobs_portal")
+        stand_in.add_method("bizproc.event.send", lambda params: {"result": True})
+
+        forms = []
+
+        async def handler(crest, session, form_json, created_meeting=None, on_meeting_created=None):
+            forms.append(form_json)
+            if len(forms) == 1:
+                raise RuntimeError("КТолк недоступен")
+            return KTalkBackAnswerModel(url="https://space.ktalk.ru/meeting")
+
+        queue = RobotJobQueue(crest, async_session_maker, handler, retry_delay=0)
+        assert await queue.enqueue(form)
+        # Bitrix24 повторил вызов, не дождавшись ответа
+        assert not await queue.enqueue(form)
+
+        assert await queue.run_next()
+        assert stand_in.calls("bizproc.event.send") == []
+        assert await queue.run_next()
+        assert len(forms) == 2
+        assert "access_token" not in forms[1]["auth"]
+
+        sent = stand_in.calls("bizproc.event.send")
+        assert len(sent) == 1
+        assert sent[0]["EVENT_TOKEN"] == "robot_jobs_portal_event"
+        assert sent[0]["RETURN_VALUES"]["url"] == "https://space.ktalk.ru/meeting"
+        assert not await queue.run_next()
+        await crest.close()
+
+    async def test_send_error_is_retried(self, get_session):
+        stand_in = BitrixStandIn()
+        crest, form = await _robot_portal(get_session, stand_in, "robot_jobs_send_error")
+        # crest.call возвращает ошибку портала в ответе, а не исключением
+        stand_in.add_method("bizproc.event.send", lambda params: JSONResponse(
+            {"error": "ERROR_WRONG_TOKEN", "error_description": "Неверный токен события"}, status_code=400
+        ) if len(stand_in.calls("bizproc.event.send")) == 1 else {"result": True})
+        handled = []
+
+        async def handler(crest, session, form_json, created_meeting=None, on_meeting_created=None):
+            handled.append(form_json)
+            return KTalkBackAnswerModel(url="https://space.ktalk.ru/meeting")
+
+        queue = RobotJobQueue(crest, async_session_maker, handler, retry_delay=0)
+        await queue.enqueue(form)
+        assert await queue.run_next()
+        async with async_session_maker() as session:
+            job = await claim_robot_job(session, timedelta(seconds=300))
+        assert "ERROR_WRONG_TOKEN" in job.error
+        assert job.result["done"]
+
+        await queue.process(job)
+        assert len(handled) == 1
+        assert len(stand_in.calls("bizproc.event.send")) == 2
+        assert not await queue.run_next()
+        await crest.close()
+
+    async def test_meeting_is_not_created_twice(self, get_session):
+        stand_in = BitrixStandIn()
+        crest, form = await _robot_portal(get_session, stand_in, "robot_jobs_meeting_saved")
+        stand_in.add_method("bizproc.event.send", lambda params: {"result": True})
+        created = []
+
+        async def handler(crest, session, form_json, created_meeting=None, on_meeting_created=None):
+            if created_meeting is None:
+                created.append(form_json)
+                await on_meeting_created(KTalkBackAnswerModel(url="https://space.ktalk.ru/meeting"))
+                raise RuntimeError("crm.activity.todo.add недоступен")
+            return created_meeting
+
+        queue = RobotJobQueue(crest, async_session_maker, handler, retry_delay=0)
+        await queue.enqueue(form)
+        assert await queue.run_next()
+        assert await queue.run_next()
+        assert len(created) == 1
+        assert stand_in.calls("bizproc.event.send")[0]["RETURN_VALUES"]["url"] == "https://space.ktalk.ru/meeting"
+        await crest.close()
+
+    async def test_stale_worker_cannot_update_job(self, get_session):
+        stand_in = BitrixStandIn()
+        crest, form = await _robot_portal(get_session, stand_in, "robot_jobs_stale")
+
+        async def handler(crest, session, form_json, created_meeting=None, on_meeting_created=None):
+            return KTalkBackAnswerModel(url="https://space.ktalk.ru/meeting")
+
+        queue = RobotJobQueue(crest, async_session_maker, handler)
+        await queue.enqueue(form)
+        async with async_session_maker() as session:
+            # Аренда первого обработчика истекла сразу, задачу взял второй
+            stale = await claim_robot_job(session, timedelta(0))
+            current = await claim_robot_job(session, timedelta(seconds=300))
+        assert stale.id == current.id
+
+        async with async_session_maker() as session:
+            assert not await finish_robot_job(session, stale, RobotJobStatus.DONE)
+            assert not await retry_robot_job(session, stale, datetime.now(timezone.utc), "ошибка")
+            assert await finish_robot_job(session, current, RobotJobStatus.DONE)
+        await crest.close()
+
+    async def test_inline_result_not_delivered(self, get_session, ac, monkeypatch):
+        from src.main import app
+        from src.db.idempotency import IdempotencyStore
+        from src.router import create_external_meeting
+
+        stand_in = BitrixStandIn()
+        crest, form = await _robot_portal(get_session, stand_in, "robot_inline_send_error")
+        stand_in.add_method("bizproc.event.send", lambda params: JSONResponse(
+            {"error": "ERROR_WRONG_TOKEN", "error_description": "Неверный токен события"}, status_code=400
+        ))
+        created = []
+
+        async def execute_robot(crest, session, form_json):
+            created.append(form_json)
+            return KTalkBackAnswerModel(url="https://space.ktalk.ru/meeting")
+
+        monkeypatch.setattr(create_external_meeting, "execute_robot", execute_robot)
+        monkeypatch.setattr(create_external_meeting, "idempotency", IdempotencyStore())
+        monkeypatch.setattr(app.state, "CRest", crest, raising=False)
+        data = {
+            "event_token": form["event_token"],
+            "document_id[2]": "DEAL_1",
+            "properties[subject]": "Встреча",
+            "auth[member_id]": form["auth"]["member_id"],
+            "auth[user_id]": "1",
+        }
+        # Bitrix24 повторит вызов робота, встреча при этом заново не создаётся
+        for _ in range(2):
+            response = await ac.post("/create-external-meeting", data=data)
+            assert response.status_code == 503
+        assert len(created) == 1
+        await crest.close()
+
+    async def test_update_installed_robot(self):
+        stand_in = BitrixStandIn()
+        stand_in.add_method("bizproc.robot.add", lambda params: JSONResponse(
+            {"error": "ERROR_ACTIVITY_ALREADY_INSTALLED", "error_description": "Activity already installed"},
+            status_code=400
+        ))
+        stand_in.add_method("bizproc.robot.update", lambda params: {"result": True})
+        crest = CRestBitrix24(client_webhook=STAND_IN_ENDPOINT, transport=stand_in.transport())
+        user_auth = UserAuthModel(
+            user_id=1, member_id="member_id", client_endpoint=STAND_IN_ENDPOINT, access_token="", refresh_token=""
+        )
+
+        assert (await create_robot_request(crest, user_auth, "example.com"))["result"] is True
+        updated = stand_in.calls("bizproc.robot.update")
+        assert updated[0]["CODE"] == "ktalk_robot"
+        assert updated[0]["FIELDS"]["USE_SUBSCRIPTION"] == "Y"
+        assert set(updated[0]["FIELDS"]["RETURN_PROPERTIES"]) == {"url", "error"}
+        await crest.close()
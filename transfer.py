@@ -0,0 +1,65 @@
+"""
+Выгрузка и загрузка данных порталов (portal, ktalk_space, user, user_auth)
+для переноса между экземплярами и резервного копирования.
+
+    python transfer.py export -o backup.ndjson [--member-id ID ...] [--format msgpack]
+    python transfer.py import -i backup.ndjson [--format msgpack]
+
+--secret module:function - функция str -> str, через которую проходят api_key и токены
+(например, перешифрование ключом нового экземпляра)
+"""
+import argparse
+import asyncio
+import importlib
+import sys
+
+from environs import Env
+
+
+def get_secret(path: str | None):
+    if not path:
+        return None
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+async def main(args: argparse.Namespace) -> None:
+    # DATABASE_URI читается при импорте src.db.database
+    from src.db.database import session_factory, run_db, close_db
+    from src.db.transfer import export_tenants, import_tenants
+
+    secret = get_secret(args.secret)
+    try:
+        if args.command == "export":
+            with open(args.output, "wb") if args.output != "-" else sys.stdout.buffer as output:
+                stats = await export_tenants(
+                    session_factory, output, args.member_id, args.format, secret, args.batch_size
+                )
+        else:
+            await run_db()
+            with open(args.input, "rb") if args.input != "-" else sys.stdin.buffer as source:
+                stats = await import_tenants(session_factory, source, args.format, secret, args.batch_size)
+    finally:
+        await close_db()
+    print(stats, file=sys.stderr)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных порталов")
+    parser.add_argument("--format", choices=("ndjson", "msgpack"), default="ndjson")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--secret", help="module:function для преобразования секретов")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="выгрузить порталы")
+    export.add_argument("-o", "--output", default="-", help="файл, '-' - stdout")
+    export.add_argument("--member-id", action="append", help="портал, по умолчанию - все")
+
+    load = commands.add_parser("import", help="загрузить порталы")
+    load.add_argument("-i", "--input", default="-", help="файл, '-' - stdin")
+    return parser
+
+
+if __name__ == "__main__":
+    Env().read_env(".env")
+    asyncio.run(main(get_parser().parse_args()))